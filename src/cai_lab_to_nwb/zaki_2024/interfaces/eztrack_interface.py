@@ -4,7 +4,6 @@ import numpy as np
 import pandas as pd
 
 from pynwb import TimeSeries
-from pynwb.epoch import TimeIntervals
 from pynwb.file import NWBFile
 
 from neuroconv.basedatainterface import BaseDataInterface
@@ -12,12 +11,27 @@ from neuroconv.utils import DeepDict
 from pydantic import FilePath
 from typing import Optional, List
 
+from cai_lab_to_nwb.zaki_2024.utils.time_intervals import build_time_intervals
+from cai_lab_to_nwb.zaki_2024.utils.run_length_encoding import run_length_encode
+
 
 class EzTrackFreezingBehaviorInterface(BaseDataInterface):
     """Adds intervals of freezing behavior and motion series."""
 
     keywords = ["behavior", "freezing", "motion"]
 
+    # Only these columns of the ezTrack FreezingOutput csv are used, the parameter columns are constant per run
+    _freezing_output_columns = [
+        "File",
+        "Frame",
+        "Freezing",
+        "Motion",
+        "MotionCutoff",
+        "FreezeThresh",
+        "MinFreezeDuration",
+    ]
+    _freezing_output_dtypes = dict(Frame="int32", Freezing="uint8", Motion="float32")
+
     def __init__(self, file_path: FilePath, video_sampling_frequency: float, verbose: bool = False):
         # This should load the data lazily and prepare variables you need
 
@@ -27,6 +41,8 @@ class EzTrackFreezingBehaviorInterface(BaseDataInterface):
         self._start_times = None
         self._stop_times = None
         self._starting_time = None
+        self._time_shift = 0.0
+        self._freezing_behavior_df = None
 
     def get_metadata(self) -> DeepDict:
         # Automatically retrieve as much metadata as possible from the source files available
@@ -34,26 +50,46 @@ class EzTrackFreezingBehaviorInterface(BaseDataInterface):
 
         return metadata
 
+    def prefetch_data(self) -> None:
+        """Parse the FreezingOutput csv ahead of `add_to_nwbfile`."""
+        self.get_freezing_behavior_df()
+
+    def get_freezing_behavior_df(self) -> pd.DataFrame:
+        """Parse the ezTrack FreezingOutput csv once and return the cached table."""
+        if self._freezing_behavior_df is None:
+            self._freezing_behavior_df = pd.read_csv(
+                self.file_path, usecols=self._freezing_output_columns, dtype=self._freezing_output_dtypes
+            )
+        return self._freezing_behavior_df
+
     def get_interval_times(self):
         # Extract start and stop times of the freezing events
         # From the discussion wih the author, the freezing events are the frames where the freezing behavior is 100
-        freezing_behavior_df = pd.read_csv(self.file_path)
-        freezing_values = freezing_behavior_df["Freezing"].values
-        changes_in_freezing = np.diff(freezing_values)
-        freezing_start = np.where(changes_in_freezing == 100)[0] + 1
-        freezing_stop = np.where(changes_in_freezing == -100)[0] + 1
+        freezing_behavior_df = self.get_freezing_behavior_df()
+        is_freezing = freezing_behavior_df["Freezing"].values == 100
+        start_indices, stop_indices, run_is_freezing = run_length_encode(is_freezing)
 
-        start_frames = freezing_behavior_df["Frame"].values[freezing_start]
-        stop_frames = freezing_behavior_df["Frame"].values[freezing_stop]
+        # A freezing event stops at the first frame without freezing. Events still ongoing at the end of the file stop
+        # one frame after the last frame
+        frames = freezing_behavior_df["Frame"].values
+        frames = np.append(frames, frames[-1] + 1)
+        start_frames = frames[start_indices[run_is_freezing]]
+        stop_frames = frames[stop_indices[run_is_freezing]]
 
         start_times = (
-            self._start_times if self._start_times is not None else start_frames / self.video_sampling_frequency
+            self._start_times
+            if self._start_times is not None
+            else start_frames / self.video_sampling_frequency + self._time_shift
+        )
+        stop_times = (
+            self._stop_times
+            if self._stop_times is not None
+            else stop_frames / self.video_sampling_frequency + self._time_shift
         )
-        stop_times = self._stop_times if self._stop_times is not None else stop_frames / self.video_sampling_frequency
         return start_times, stop_times
 
     def get_starting_time(self) -> float:
-        freezing_behavior_df = pd.read_csv(self.file_path)
+        freezing_behavior_df = self.get_freezing_behavior_df()
         return freezing_behavior_df["Frame"].values[0] / self.video_sampling_frequency
 
     def set_aligned_interval_times(self, start_times: List[float], stop_times: List[float]) -> None:
@@ -63,15 +99,21 @@ class EzTrackFreezingBehaviorInterface(BaseDataInterface):
     def set_aligned_starting_time(self, aligned_start_time) -> None:
         self._starting_time = aligned_start_time
 
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
+
     def add_to_nwbfile(self, nwbfile: NWBFile, metadata: Optional[dict] = None, stub_test: bool = False):
 
-        freezing_behavior_df = pd.read_csv(self.file_path)
+        freezing_behavior_df = self.get_freezing_behavior_df()
 
         start_times, stop_times = self.get_interval_times()
 
         # Extract motion data
         motion_data = freezing_behavior_df["Motion"].values
-        starting_time = self._starting_time if self._starting_time is not None else self.get_starting_time()
+        starting_time = (
+            self._starting_time if self._starting_time is not None else self.get_starting_time() + self._time_shift
+        )
 
         motion_series = TimeSeries(
             name="MotionSeries",
@@ -99,9 +141,13 @@ class EzTrackFreezingBehaviorInterface(BaseDataInterface):
             - Motion cutoff: The level of pixel intensity change required to register as motion.
         """
 
-        freeze_intervals = TimeIntervals(name="FreezingIntervals", description=description)
-        for start_time, stop_time in zip(start_times, stop_times):
-            freeze_intervals.add_interval(start_time=start_time, stop_time=stop_time, timeseries=[motion_series])
+        freeze_intervals = build_time_intervals(
+            name="FreezingIntervals",
+            description=description,
+            start_times=start_times,
+            stop_times=stop_times,
+            timeseries=[motion_series],
+        )
 
         if "behavior" not in nwbfile.processing:
             behavior_module = nwbfile.create_processing_module(name="behavior", description="Contains behavior data")
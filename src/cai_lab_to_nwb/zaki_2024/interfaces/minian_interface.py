@@ -11,9 +11,12 @@ from roiextractors.segmentationextractor import SegmentationExtractor
 from roiextractors.imagingextractor import ImagingExtractor
 
 from typing import Optional
+from hdmf.data_utils import GenericDataChunkIterator
 from pynwb import NWBFile, TimeSeries
 from pynwb.ophys import MotionCorrection, CorrectedImageStack, OnePhotonSeries
 
+from cai_lab_to_nwb.zaki_2024.utils.block_prefetching import BlockPrefetcher
+
 
 class MinianSegmentationExtractor(SegmentationExtractor):
     """A SegmentationExtractor for Minian.
@@ -190,6 +193,13 @@ class MinianSegmentationExtractor(SegmentationExtractor):
         _roi_image_dict: dict
             dictionary with key, values representing different types of Images used in segmentation:
                 Mean, Correlation image
+
+        Notes
+        -----
+        Minian saves no mean or correlation image, so they are None and not written. The summary images computed by
+        the MiniscopeImaging interface with `compute_summary_statistics` are of the raw frames, which are not
+        registered to the motion corrected, and possibly cropped, field of view of the ROI masks, so they are not
+        used here.
         """
         return dict(
             mean=self._image_mean,
@@ -224,6 +234,11 @@ class MinianSegmentationInterface(BaseSegmentationExtractorInterface):
         """
         super().__init__(folder_path=folder_path)
         self.verbose = verbose
+        self._time_shift = 0.0
+
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
 
     def add_to_nwbfile(
         self,
@@ -238,18 +253,26 @@ class MinianSegmentationInterface(BaseSegmentationExtractorInterface):
         plane_segmentation_name: Optional[str] = None,
         iterator_options: Optional[dict] = None,
     ):
-        super().add_to_nwbfile(
-            nwbfile=nwbfile,
-            metadata=metadata,
-            stub_test=stub_test,
-            stub_frames=stub_frames,
-            include_background_segmentation=include_background_segmentation,
-            include_roi_centroids=include_roi_centroids,
-            include_roi_acceptance=include_roi_acceptance,
-            mask_type=mask_type,
-            plane_segmentation_name=plane_segmentation_name,
-            iterator_options=iterator_options,
-        )
+        # The time shift is applied only while the traces are added, so that the extractor keeps its original times
+        original_timestamps = self.get_timestamps() if self._time_shift else None
+        if original_timestamps is not None:
+            self.set_aligned_timestamps(original_timestamps + self._time_shift)
+        try:
+            super().add_to_nwbfile(
+                nwbfile=nwbfile,
+                metadata=metadata,
+                stub_test=stub_test,
+                stub_frames=stub_frames,
+                include_background_segmentation=include_background_segmentation,
+                include_roi_centroids=include_roi_centroids,
+                include_roi_acceptance=include_roi_acceptance,
+                mask_type=mask_type,
+                plane_segmentation_name=plane_segmentation_name,
+                iterator_options=iterator_options,
+            )
+        finally:
+            if original_timestamps is not None:
+                self.set_aligned_timestamps(original_timestamps)
 
 
 class _MinianMotionCorrectedVideoExtractor(ImagingExtractor):
@@ -376,6 +399,37 @@ class _MinianMotionCorrectedVideoExtractor(ImagingExtractor):
         return video
 
 
+class _MinianMotionCorrectedVideoDataChunkIterator(GenericDataChunkIterator):
+    """Iterator streaming the frames of a Minian motion corrected video, decoding the next buffers ahead of the write."""
+
+    def __init__(
+        self,
+        extractor: _MinianMotionCorrectedVideoExtractor,
+        end_frame: Optional[int] = None,
+        prefetch_blocks: int = 1,
+        **iterator_options,
+    ):
+        self._extractor = extractor
+        self._num_frames = min(end_frame or extractor.get_num_frames(), extractor.get_num_frames())
+        self._prefetcher = BlockPrefetcher(
+            read_block=lambda start_frame, end_frame: extractor.get_video(start_frame=start_frame, end_frame=end_frame),
+            num_samples=self._num_frames,
+            prefetch_blocks=prefetch_blocks,
+        )
+        super().__init__(**iterator_options)
+
+    def _get_data(self, selection: tuple[slice]) -> np.ndarray:
+        # The buffers may split the frames, the prefetcher keeps the frames of the last buffer to read the other parts
+        frames = self._prefetcher.get_block(selection[0].start, selection[0].stop)
+        return frames[(slice(None),) + tuple(selection[1:])]
+
+    def _get_dtype(self) -> np.dtype:
+        return np.dtype(self._extractor.get_dtype())
+
+    def _get_maxshape(self) -> tuple:
+        return (self._num_frames, *self._extractor.get_image_size())
+
+
 class MinianMotionCorrectionInterface(BaseDataInterface):
     """Data interface for adding the motion corrected image data produced by Minian software."""
 
@@ -406,7 +460,20 @@ class MinianMotionCorrectionInterface(BaseDataInterface):
         metadata: dict,
         corrected_image_stack_name: str = "CorrectedImageStack",
         stub_test: bool = False,
+        iterator_options: Optional[dict] = None,
+        prefetch_blocks: int = 1,
     ) -> None:
+        """
+        Add the motion corrected frames, with the x, y shifts of the motion correction, to the NWB file.
+
+        Parameters
+        ----------
+        iterator_options : dict, optional
+            Options of the iterator streaming the frames, e.g. `buffer_gb`.
+        prefetch_blocks : int, optional
+            Number of buffers of frames decoded in a background thread ahead of the buffer being written. With 0,
+            decoding and writing alternate. Default is 1.
+        """
 
         # extract xy_shift
         assert "/motion.zarr" in zarr.open(self.folder_path), f"Group '/motion.zarr' not found in the Zarr store."
@@ -424,7 +491,9 @@ class MinianMotionCorrectionInterface(BaseDataInterface):
         # extract corrected image stack
         extractor = _MinianMotionCorrectedVideoExtractor(file_path=str(self.video_file_path))
         end_frame = 100 if stub_test else None
-        motion_corrected_data = extractor.get_video(end_frame=end_frame)
+        motion_corrected_data = _MinianMotionCorrectedVideoDataChunkIterator(
+            extractor=extractor, end_frame=end_frame, prefetch_blocks=prefetch_blocks, **(iterator_options or dict())
+        )
 
         # add motion correction
         name_suffix = corrected_image_stack_name.replace("CorrectedImageStack", "")
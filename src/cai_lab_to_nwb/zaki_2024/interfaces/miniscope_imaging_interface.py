@@ -4,6 +4,7 @@ from roiextractors.extraction_tools import PathType, DtypeType, get_package
 
 import json
 import datetime
+import warnings
 
 from copy import deepcopy
 from typing import Union
@@ -12,11 +13,27 @@ from typing import Literal, Iterable, Optional
 
 import numpy as np
 from pydantic import DirectoryPath, validate_call
-from pynwb import NWBFile
+from hdmf.common import DynamicTable, VectorData
+from pynwb import NWBFile, TimeSeries
+from pynwb.base import Images
+from pynwb.image import GrayscaleImage
 
 from neuroconv.datainterfaces.ophys.baseimagingextractorinterface import BaseImagingExtractorInterface
+from neuroconv.tools import get_module
 from neuroconv.utils import DeepDict, dict_deep_update
 
+from cai_lab_to_nwb.zaki_2024.utils.block_prefetching import BlockPrefetcher
+from cai_lab_to_nwb.zaki_2024.utils.streaming_image_statistics import StreamingImageStatistics
+from cai_lab_to_nwb.zaki_2024.utils.timestamp_qc import (
+    DEFAULT_GAP_FACTOR,
+    DEFAULT_MIN_BOUT_GAP,
+    FRAME_TIMESTAMPS_QC_DESCRIPTIONS,
+    analyze_frame_timestamps,
+    describe_frame_timestamps_issues,
+    segment_recording_bouts,
+)
+from cai_lab_to_nwb.zaki_2024.utils.time_intervals import build_time_intervals
+
 
 def get_miniscope_folder_path(folder_path: Union[str, Path]):
     """
@@ -144,6 +161,64 @@ def get_miniscope_timestamps(file_path: Union[str, Path]):
     return np.asarray(timestamps_seconds)
 
 
+def _read_first_and_last_lines(file_path: Path, tail_num_bytes: int) -> tuple[str, str, str]:
+    """Read the header, the first data line and the last line of a text file, reading only its first line and a tail
+    block from the end of the file, doubled until it holds a complete line."""
+    with open(file_path, "rb") as file:
+        header = file.readline()
+        first_line = file.readline()
+        while first_line and not first_line.strip():
+            first_line = file.readline()
+        data_start = file.tell()
+
+        file_size = file.seek(0, 2)
+        while True:
+            block_start = max(data_start, file_size - tail_num_bytes)
+            file.seek(block_start)
+            lines = [line for line in file.read(file_size - block_start).splitlines() if line.strip()]
+            # The first line of the block is complete only if the block starts at the beginning of a line
+            if len(lines) > 1 or block_start == data_start:
+                break
+            tail_num_bytes *= 2
+    # Without lines after the first data line, the first data line is also the last one
+    last_line = lines[-1] if lines else first_line
+    return header.decode(), first_line.decode(), last_line.decode()
+
+
+def get_miniscope_first_and_last_timestamps(
+    file_path: Union[str, Path], tail_num_bytes: int = 4096
+) -> tuple[float, float]:
+    """
+    Retrieve the first and last Miniscope timestamps from a CSV file without parsing the whole file.
+
+    Only the header, the first data row and a block at the end of the file are read. The whole file is parsed with
+    `get_miniscope_timestamps` if they cannot be interpreted.
+
+    Parameters:
+    -----------
+    file_path : Union[str, Path]
+        Path to the Miniscope "timeStamps.csv" file, which includes timestamps in milliseconds.
+    tail_num_bytes : int, optional
+        Size of the block read from the end of the file, enlarged if it does not contain a complete row.
+
+    Returns:
+    --------
+    Tuple[float, float]
+        The first and last timestamps in seconds.
+    """
+    file_path = Path(file_path)
+    try:
+        header, first_line, last_line = _read_first_and_last_lines(file_path, tail_num_bytes=tail_num_bytes)
+        column_index = [column.strip() for column in header.split(",")].index("Time Stamp (ms)")
+        first_timestamp = float(first_line.split(",")[column_index])
+        last_timestamp = float(last_line.split(",")[column_index])
+    except (ValueError, IndexError, UnicodeDecodeError):
+        timestamps = get_miniscope_timestamps(file_path=file_path)
+        return float(timestamps[0]), float(timestamps[-1])
+
+    return first_timestamp / 1000.0, last_timestamp / 1000.0
+
+
 class MiniscopeImagingExtractor(MultiImagingExtractor):
 
     def __init__(self, folder_path: DirectoryPath):
@@ -167,10 +242,64 @@ class MiniscopeImagingExtractor(MultiImagingExtractor):
         self._sampling_frequency = self._imaging_extractors[0].get_sampling_frequency()
         self._image_size = self._imaging_extractors[0].get_image_size()
         self._dtype = self._imaging_extractors[0].get_dtype()
+        self._prefetcher = None
+        self._statistics = None
+
+    def set_prefetch_blocks(self, prefetch_blocks: int) -> None:
+        """
+        Decode the blocks of frames following each block read by `get_series` in a background thread.
+
+        The blocks are read across the boundaries of the .avi files, so the decoding of the next file starts while
+        the end of the current one is written.
+
+        Parameters
+        ----------
+        prefetch_blocks : int
+            Number of blocks, of the size of the last block read, decoded ahead. With 0, the frames are decoded when
+            they are read.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.close()
+        self._prefetcher = None
+        if prefetch_blocks > 0:
+            self._prefetcher = BlockPrefetcher(
+                read_block=self._read_series, num_samples=self.get_num_samples(), prefetch_blocks=prefetch_blocks
+            )
+
+    def set_statistics(self, statistics: Optional[StreamingImageStatistics]) -> None:
+        """
+        Accumulate statistics of the frames as they are decoded by `get_series`, in the prefetch thread if any.
+
+        Parameters
+        ----------
+        statistics : StreamingImageStatistics, optional
+            The statistics updated with every block of frames decoded. With None, no statistics are accumulated.
+        """
+        self._statistics = statistics
+
+    def _read_series(self, start_sample: int, end_sample: int) -> np.ndarray:
+        series = super().get_series(start_sample=start_sample, end_sample=end_sample)
+        if self._statistics is not None:
+            self._statistics.update(start_frame=start_sample, frames=series)
+        return series
+
+    def get_series(self, start_sample: Optional[int] = None, end_sample: Optional[int] = None) -> np.ndarray:
+        start_sample = start_sample or 0
+        end_sample = end_sample if end_sample is not None else self.get_num_samples()
+        if self._prefetcher is None:
+            return self._read_series(start_sample, end_sample)
+        return self._prefetcher.get_block(start_sample, end_sample)
 
     def get_num_samples(self) -> int:
         return self._num_samples
 
+    def get_file_frame_ranges(self) -> tuple[list[Path], np.ndarray, np.ndarray]:
+        """Return the .avi files in the order of their frames, with the index of their first and last (exclusive)
+        frame, read from the headers of the files."""
+        end_frames = np.cumsum([extractor.get_num_samples() for extractor in self._imaging_extractors])
+        start_frames = np.concatenate([[0], end_frames[:-1]])
+        return self._miniscope_avi_file_paths, start_frames, end_frames
+
     def get_num_channels(self) -> int:
         return 1
 
@@ -353,6 +482,9 @@ class MiniscopeImagingInterface(BaseImagingExtractorInterface):
         self._metadata_frame_rate = float(frame_rate_string.split("FPS")[0])
 
         self.photon_series_type = "OnePhotonSeries"
+        self._time_shift = 0.0
+        self.summary_statistics = None
+        self._summary_statistics_photon_series_name = None
 
     def get_metadata(self) -> DeepDict:
         from neuroconv.tools.roiextractors import get_nwb_imaging_metadata
@@ -394,6 +526,30 @@ class MiniscopeImagingInterface(BaseImagingExtractorInterface):
         timestamps_seconds = get_miniscope_timestamps(file_path=timestamps_file_path)
         return timestamps_seconds
 
+    def get_timestamps(self) -> np.ndarray:
+        """
+        Return the timestamps of the frames written to the NWB file, in seconds.
+
+        These are the timestamps of timeStamps.csv plus the time shift set by `set_aligned_time_shift`, whether or not
+        a time shift is set. Before the time shift engine, sessions that needed no shift were written with regular
+        timestamps computed from the sampling frequency instead of the recorded ones.
+
+        Returns
+        -------
+        np.ndarray
+            The timestamps of the frames, in seconds.
+        """
+        if self.imaging_extractor.has_time_vector():
+            return super().get_timestamps()
+        # The original timestamps are parsed into a new array, so the time shift can be added in place
+        timestamps = self.get_original_timestamps()
+        timestamps += self._time_shift
+        return timestamps
+
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
+
     def add_to_nwbfile(
         self,
         nwbfile: NWBFile,
@@ -403,21 +559,90 @@ class MiniscopeImagingInterface(BaseImagingExtractorInterface):
         stub_test: bool = False,
         stub_frames: int = 100,
         always_write_timestamps: bool = True,
+        iterator_options: Optional[dict] = None,
+        prefetch_blocks: int = 1,
+        compute_summary_statistics: bool = False,
+        frame_count_mismatch: Literal["raise", "trim"] = "raise",
+        min_bout_gap: Optional[float] = DEFAULT_MIN_BOUT_GAP,
     ):
+        """
+        Add the Miniscope device and the OnePhotonSeries streaming the frames to the NWB file.
+
+        Parameters
+        ----------
+        iterator_options : dict, optional
+            Options of the iterator streaming the frames, e.g. `buffer_gb`.
+        prefetch_blocks : int, optional
+            Number of buffers of frames decoded in a background thread ahead of the buffer being written, each
+            holding `buffer_gb` in memory. With 0, decoding and writing alternate. Default is 1.
+        compute_summary_statistics : bool, optional
+            If True, the summary images and per-frame statistics of the frames are accumulated in `summary_statistics`
+            while the frames are decoded for the write, to be added with `add_summary_statistics_to_nwbfile` once
+            the NWB file is written. Default is False.
+        frame_count_mismatch : {"raise", "trim"}, optional
+            What to do when the .avi files do not have as many frames as "timeStamps.csv" has rows, since frames and
+            timestamps are paired by position. With "raise", a ValueError is raised before anything is written. With
+            "trim", the frames and timestamps are both cut to the shorter of the two. Default is "raise".
+        min_bout_gap : float, optional
+            Shortest interval between two frames, in seconds, that separates two recording bouts, e.g. the bouts of
+            the TTL-gated offline sessions. When the frames span several bouts, they are added as the
+            "MiniscopeRecordingBouts" TimeIntervals table. With None, the frames are a single bout. Default is 60.
+
+        Notes
+        -----
+        The timestamps are checked against the frame count of the .avi headers, and for duplicates, gaps of dropped
+        frames and jitter, without decoding the video. The issues are reported as warnings and the summary of the
+        checks is added to the "miniscope_qc" processing module as the one-row "FrameTimestampsQC" table.
+
+        Each row of "MiniscopeRecordingBouts" references the frames of its bout in the photon series, and holds
+        the range of frames and the first and last .avi files of the bout, so that one bout can be read directly.
+        """
         from ndx_miniscope.utils import add_miniscope_device
 
         from neuroconv.tools.roiextractors import add_photon_series_to_nwbfile
 
         miniscope_timestamps = self.get_timestamps()
+        # The stub is sliced from the extractor, so its reads also go through the prefetcher
+        self.imaging_extractor.set_prefetch_blocks(prefetch_blocks)
         imaging_extractor = self.imaging_extractor
 
+        frame_timestamps_qc = analyze_frame_timestamps(
+            timestamps=miniscope_timestamps,
+            num_frames=imaging_extractor.get_num_samples(),
+            nominal_rate=self._metadata_frame_rate,
+            min_bout_gap=min_bout_gap,
+        )
+        issues = describe_frame_timestamps_issues(frame_timestamps_qc)
+        if issues:
+            warnings.warn(f"Miniscope timestamps of {self.miniscope_folder}: {'; '.join(issues)}.", UserWarning)
+        num_frames = min(frame_timestamps_qc["num_frames"], frame_timestamps_qc["num_timestamps"])
+        if frame_timestamps_qc["num_frames"] != frame_timestamps_qc["num_timestamps"]:
+            if frame_count_mismatch == "raise":
+                raise ValueError(
+                    f"The .avi files of {self.miniscope_folder} have {frame_timestamps_qc['num_frames']} frames but "
+                    f"timeStamps.csv has {frame_timestamps_qc['num_timestamps']} rows, set "
+                    "frame_count_mismatch='trim' to cut both to the shorter one."
+                )
+            if num_frames < imaging_extractor.get_num_samples():
+                imaging_extractor = imaging_extractor.frame_slice(start_frame=0, end_frame=num_frames)
+            miniscope_timestamps = miniscope_timestamps[:num_frames]
+
         if stub_test:
-            stub_frames = min([stub_frames, self.imaging_extractor.get_num_samples()])
+            stub_frames = min([stub_frames, num_frames])
             imaging_extractor = self.imaging_extractor.frame_slice(start_frame=0, end_frame=stub_frames)
             miniscope_timestamps = miniscope_timestamps[:stub_frames]
 
         imaging_extractor.set_times(times=miniscope_timestamps)
 
+        self.summary_statistics = None
+        if compute_summary_statistics:
+            self.summary_statistics = StreamingImageStatistics(
+                num_frames=imaging_extractor.get_num_samples(), frame_shape=self.imaging_extractor.get_image_size()
+            )
+            photon_series_metadata = metadata["Ophys"][photon_series_type][photon_series_index]
+            self._summary_statistics_photon_series_name = photon_series_metadata["name"]
+        self.imaging_extractor.set_statistics(self.summary_statistics)
+
         device_metadata = metadata["Ophys"]["Device"][0]
         # Cast to string because Miniscope extension requires so
         device_metadata["gain"] = str(device_metadata["gain"])
@@ -431,4 +656,128 @@ class MiniscopeImagingInterface(BaseImagingExtractorInterface):
             photon_series_type=photon_series_type,
             photon_series_index=photon_series_index,
             always_write_timestamps=always_write_timestamps,
+            iterator_options=iterator_options,
+        )
+
+        frame_timestamps_qc_description = (
+            f"Checks of the timestamps of the Miniscope frames against the frame count of the .avi files, "
+            f"before {frame_count_mismatch!r} was applied to a mismatch. Gaps are frame intervals longer than "
+            f"{DEFAULT_GAP_FACTOR} times the nominal interval."
+        )
+        if min_bout_gap is not None:
+            frame_timestamps_qc_description += (
+                f" Intervals longer than {min_bout_gap} s separate recording bouts and are not counted as gaps."
+            )
+        frame_timestamps_qc_table = DynamicTable(
+            name="FrameTimestampsQC",
+            description=frame_timestamps_qc_description,
+            columns=[
+                VectorData(name=name, description=description, data=[frame_timestamps_qc[name]])
+                for name, description in FRAME_TIMESTAMPS_QC_DESCRIPTIONS.items()
+            ],
+        )
+        qc_module = self._get_qc_module(nwbfile)
+        qc_module.add(frame_timestamps_qc_table)
+
+        if min_bout_gap is not None:
+            photon_series_name = metadata["Ophys"][photon_series_type][photon_series_index]["name"]
+            self.add_recording_bouts_to_nwbfile(
+                nwbfile=nwbfile,
+                timestamps=miniscope_timestamps,
+                photon_series=nwbfile.acquisition[photon_series_name],
+                min_bout_gap=min_bout_gap,
+            )
+
+    def add_recording_bouts_to_nwbfile(
+        self, nwbfile: NWBFile, timestamps: np.ndarray, photon_series: TimeSeries, min_bout_gap: float
+    ) -> None:
+        """Add the recording bouts of the frames as a TimeIntervals table, if the frames span more than one bout."""
+        start_frames, stop_frames = segment_recording_bouts(timestamps=timestamps, min_gap=min_bout_gap)
+        if len(start_frames) < 2:
+            return
+
+        file_paths, file_start_frames, _ = self.imaging_extractor.get_file_frame_ranges()
+        file_names = np.array([file_path.name for file_path in file_paths])
+        first_file_indices = np.searchsorted(file_start_frames, start_frames, side="right") - 1
+        last_file_indices = np.searchsorted(file_start_frames, stop_frames - 1, side="right") - 1
+        # The bouts end one frame interval after their last frame, so that they cover it in the photon series
+        stop_times = timestamps[stop_frames - 1] + 1.0 / self._metadata_frame_rate
+
+        recording_bouts = build_time_intervals(
+            name="MiniscopeRecordingBouts",
+            description=(
+                f"Recording bouts of the Miniscope, separated by more than {min_bout_gap} s without frames, detected "
+                "from the timestamps."
+            ),
+            start_times=timestamps[start_frames],
+            stop_times=stop_times,
+            columns=dict(
+                start_frame=("The index of the first frame of the bout in the photon series.", start_frames),
+                stop_frame=("The index after the last frame of the bout in the photon series.", stop_frames),
+                first_file=("The .avi file holding the first frame of the bout.", file_names[first_file_indices]),
+                first_file_start_frame=(
+                    "The index of the first frame of the bout in its .avi file.",
+                    start_frames - file_start_frames[first_file_indices],
+                ),
+                last_file=("The .avi file holding the last frame of the bout.", file_names[last_file_indices]),
+            ),
+            timeseries=[photon_series],
+        )
+        nwbfile.add_time_intervals(recording_bouts)
+
+    def add_summary_statistics_to_nwbfile(self, nwbfile: NWBFile) -> None:
+        """
+        Add the statistics accumulated while the frames were written to the NWB file, e.g. read back in append mode.
+
+        The mean image, maximum projection and local correlation image are added as `GrayscaleImage`, in the
+        orientation of the frames of the photon series, to a "SummaryImages" `Images` container, and the mean and
+        standard deviation of the intensity and the number of saturated pixels of each frame as `TimeSeries` with the
+        timestamps of the photon series. They are added to the "miniscope_qc" processing module.
+
+        Parameters
+        ----------
+        nwbfile : NWBFile
+            The NWB file holding the photon series written with `compute_summary_statistics=True`.
+        """
+        assert self.summary_statistics is not None, "The frames were written without compute_summary_statistics"
+        photon_series = nwbfile.acquisition[self._summary_statistics_photon_series_name]
+        frame_statistics = self.summary_statistics.get_frame_statistics()
+
+        # The frames of the photon series are written transposed, as (time, width, height)
+        summary_images = dict(
+            mean=self.summary_statistics.get_mean_image().T,
+            max_projection=self.summary_statistics.get_max_projection().T,
+            correlation=self.summary_statistics.get_correlation_image().T,
+        )
+        images = Images(
+            name="SummaryImages",
+            images=[GrayscaleImage(name=name, data=image) for name, image in summary_images.items()],
+            description=f"Summary images of the frames of {photon_series.name}.",
+        )
+
+        qc_module = self._get_qc_module(nwbfile)
+        qc_module.add(images)
+        frame_statistics_descriptions = dict(
+            FrameMeanIntensity=("mean", "The mean intensity of each frame.", "n.a."),
+            FrameStdIntensity=("std", "The standard deviation of the intensity of each frame.", "n.a."),
+            FrameNumSaturatedPixels=(
+                "num_saturated_pixels",
+                "The number of pixels of each frame at the maximum intensity of the frames dtype.",
+                "pixels",
+            ),
         )
+        for name, (statistic, description, unit) in frame_statistics_descriptions.items():
+            qc_module.add(
+                TimeSeries(
+                    name=name,
+                    data=frame_statistics[statistic],
+                    timestamps=photon_series,
+                    unit=unit,
+                    description=description,
+                )
+            )
+
+    @staticmethod
+    def _get_qc_module(nwbfile: NWBFile):
+        description = "Quality control of the Miniscope frames and of their timestamps."
+        return get_module(nwbfile, name="miniscope_qc", description=description)
@@ -5,8 +5,9 @@ from neuroconv.utils import DeepDict
 from typing import Optional
 from pathlib import Path
 from pynwb import NWBFile
-from hdmf.common.table import DynamicTable, VectorData
+from hdmf.common.table import DynamicTable, DynamicTableRegion, VectorData
 
+import numpy as np
 import pandas as pd
 
 
@@ -50,13 +51,16 @@ class Zaki2024CellRegistrationInterface(BaseDataInterface):
         for file_path in self.file_paths:
             offline_session_name = Path(file_path).stem.split(f"{subject_id}_")[-1]
             name = offline_session_name + "vsConditioningSessions"
-            data = pd.read_csv(file_path)
+            # Blank cells are read as NaN, they are stored as no correspondence like the other unregistered ROIs
+            data = pd.read_csv(file_path).fillna(-9999).astype(np.int32)
+            if stub_test:
+                data = data.iloc[:100]
 
             columns = [
                 VectorData(
                     name=col,
                     description=f"ROI indexes of plane segmentation of session {col}",
-                    data=data[col].tolist()[:100] if stub_test else data[col].tolist(),
+                    data=data[col].to_numpy(),
                 )
                 for col in data.columns
             ]
@@ -70,3 +74,50 @@ class Zaki2024CellRegistrationInterface(BaseDataInterface):
             )
 
             processing_module.add(dynamic_table)
+            processing_module.add(self._get_roi_lookup_table(data=data, cell_registration_table=dynamic_table))
+
+    @staticmethod
+    def _get_roi_lookup_table(data: pd.DataFrame, cell_registration_table: DynamicTable) -> DynamicTable:
+        """Build the inverse of a CellReg table: (session, local ROI id) -> global ROI id (row of the CellReg table).
+
+        The rows are sorted by session id and then by local ROI id, so a lookup is a binary search on both columns
+        instead of a full table scan. Entries without correspondence (-9999) are not included.
+        """
+        session_ids, local_roi_ids, global_roi_ids = [], [], []
+        for col in data.columns:
+            session_roi_ids = data[col].to_numpy()
+            global_rows = np.flatnonzero(session_roi_ids != -9999).astype(np.int32)
+            session_ids.append(np.full(len(global_rows), col))
+            local_roi_ids.append(session_roi_ids[global_rows])
+            global_roi_ids.append(global_rows)
+
+        session_ids = np.concatenate(session_ids) if session_ids else np.array([], dtype=str)
+        local_roi_ids = np.concatenate(local_roi_ids) if local_roi_ids else np.array([], dtype=np.int32)
+        global_roi_ids = np.concatenate(global_roi_ids) if global_roi_ids else np.array([], dtype=np.int32)
+        # The last key is the primary one: session blocks in session id order, local ROI ids increasing in each block
+        sort_order = np.lexsort((local_roi_ids, session_ids))
+
+        return DynamicTable(
+            name=f"{cell_registration_table.name}ROILookup",
+            description=f"Inverse index of {cell_registration_table.name}: maps the ROI id in the plane segmentation "
+            "of each cross-registered session to the global ROI id (row of the cell registration table). "
+            "Rows are sorted by session id, then by local ROI id, so the rows of a session are contiguous.",
+            columns=[
+                VectorData(
+                    name="session_id",
+                    description="ID of the cross-registered session",
+                    data=session_ids[sort_order].tolist(),
+                ),
+                VectorData(
+                    name="local_roi_id",
+                    description="ROI index in the plane segmentation of the session",
+                    data=local_roi_ids[sort_order],
+                ),
+                DynamicTableRegion(
+                    name="global_roi",
+                    description=f"Row of {cell_registration_table.name}, i.e. the global ROI id",
+                    data=global_roi_ids[sort_order],
+                    table=cell_registration_table,
+                ),
+            ],
+        )
@@ -12,6 +12,9 @@ import numpy as np
 
 
 class Zaki2024EDFInterface(BaseDataInterface):
+
+    channel_names = ["Temp", "EEG", "EMG", "Activity"]
+
     def __init__(
         self,
         file_path: Union[Path, str],
@@ -19,12 +22,32 @@ class Zaki2024EDFInterface(BaseDataInterface):
     ):
         self.file_path = Path(file_path)
         self._starting_time = None
+        self._time_shift = 0.0
+        self._edf_reader = None
+        self._edf_data = None
+        self._edf_times = None
         self.verbose = verbose
         super().__init__(file_path=file_path)
 
+    def prefetch_data(self) -> None:
+        """Decode the EDF channels ahead of `add_to_nwbfile`."""
+        self.get_edf_data()
+
+    def get_edf_data(self):
+        """Decode the EDF channels once and return the reader, the float32 data and the relative times."""
+        if self._edf_data is None:
+            edf_reader = read_raw_edf(input_fname=self.file_path, verbose=self.verbose)
+            data, times = edf_reader.get_data(picks=self.channel_names, return_times=True)
+            self._edf_reader, self._edf_data, self._edf_times = edf_reader, data.astype("float32"), times
+        return self._edf_reader, self._edf_data, self._edf_times
+
     def set_aligned_starting_time(self, aligned_starting_time: float):
         self._starting_time = aligned_starting_time
 
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
+
     def add_to_nwbfile(
         self,
         nwbfile: NWBFile,
@@ -81,9 +104,8 @@ class Zaki2024EDFInterface(BaseDataInterface):
             },
         }
 
-        edf_reader = read_raw_edf(input_fname=self.file_path, verbose=self.verbose)
-        data, times = edf_reader.get_data(picks=list(channels_dict.keys()), return_times=True)
-        data = data.astype("float32")
+        assert list(channels_dict.keys()) == self.channel_names
+        edf_reader, data, times = self.get_edf_data()
         if start_datetime_timestamp is not None:
             # Get edf start_time in datetime format
             edf_start_time = edf_reader.info["meas_date"]
@@ -106,7 +128,7 @@ class Zaki2024EDFInterface(BaseDataInterface):
         else:
             data = data[:, start_idx:end_idx]
 
-        starting_time = self._starting_time if self._starting_time is not None else starting_time
+        starting_time = self._starting_time if self._starting_time is not None else starting_time + self._time_shift
 
         for channel_index, channel_name in enumerate(channels_dict.keys()):
             time_series_kwargs = channels_dict[channel_name].copy()
@@ -134,11 +156,16 @@ class Zaki2024MultiEDFInterface(BaseDataInterface):
         self.file_paths = file_paths
         self.verbose = verbose
         self._starting_time = 0.0
+        self._time_shift = 0.0
         super().__init__(file_paths=file_paths)
 
     def set_aligned_starting_time(self, aligned_starting_time: float):
         self._starting_time = aligned_starting_time
 
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
+
     def add_to_nwbfile(
         self,
         nwbfile: NWBFile,
@@ -210,7 +237,9 @@ class Zaki2024MultiEDFInterface(BaseDataInterface):
         for channel_index, channel_name in enumerate(channels_dict.keys()):
             time_series_kwargs = channels_dict[channel_name].copy()
             time_series_kwargs.update(
-                data=concatenated_data[channel_index], starting_time=self._starting_time, rate=edf_reader.info["sfreq"]
+                data=concatenated_data[channel_index],
+                starting_time=self._starting_time + self._time_shift,
+                rate=edf_reader.info["sfreq"],
             )
             time_series = TimeSeries(**time_series_kwargs)
             nwbfile.add_acquisition(time_series)
@@ -1,11 +1,13 @@
 """Primary class for converting experiment-specific behavior."""
 
+import numpy as np
 from pynwb.file import NWBFile
 
 from neuroconv.basedatainterface import BaseDataInterface
 from neuroconv.utils import DeepDict
 from typing import Optional, List
-from pynwb.epoch import TimeIntervals
+
+from cai_lab_to_nwb.zaki_2024.utils.time_intervals import build_time_intervals
 
 
 class Zaki2024ShockStimuliInterface(BaseDataInterface):
@@ -39,12 +41,14 @@ class Zaki2024ShockStimuliInterface(BaseDataInterface):
             "All testing was done in Med Associates chambers. "
         )
 
-        shock_stimuli = TimeIntervals(name="ShockStimuli", description=description)
+        start_times = np.asarray(shock_times, dtype=float)
         column_description = "Shock amplitude in mA"
-        shock_stimuli.add_column(name="shock_amplitude", description=column_description)
-        for start_time in shock_times:
-            shock_stimuli.add_interval(
-                start_time=start_time, stop_time=start_time + shock_duration, shock_amplitude=shock_amplitude
-            )
+        shock_stimuli = build_time_intervals(
+            name="ShockStimuli",
+            description=description,
+            start_times=start_times,
+            stop_times=start_times + shock_duration,
+            columns=dict(shock_amplitude=(column_description, np.full(len(start_times), shock_amplitude))),
+        )
 
         nwbfile.add_stimulus(shock_stimuli)
@@ -1,14 +1,18 @@
 """Primary class for converting experiment-specific behavior."""
 
+import numpy as np
 import pandas as pd
 from pydantic import FilePath
 from typing import Optional, List
 
+from pynwb import TimeSeries
 from pynwb.file import NWBFile
-from pynwb.epoch import TimeIntervals
 from neuroconv.basedatainterface import BaseDataInterface
 from neuroconv.utils import DeepDict
 
+from cai_lab_to_nwb.zaki_2024.utils.time_intervals import build_time_intervals
+from cai_lab_to_nwb.zaki_2024.utils.run_length_encoding import run_length_encode
+
 
 class Zaki2024SleepClassificationInterface(BaseDataInterface):
     """Adds intervals of sleeping behavior."""
@@ -23,6 +27,9 @@ class Zaki2024SleepClassificationInterface(BaseDataInterface):
         self.sampling_frequency = sampling_frequency
         self._start_times = None
         self._stop_times = None
+        self._starting_time = None
+        self._time_shift = 0.0
+        self._sleep_behavior_df = None
 
     def get_metadata(self) -> DeepDict:
         # Automatically retrieve as much metadata as possible from the source files available
@@ -30,31 +37,78 @@ class Zaki2024SleepClassificationInterface(BaseDataInterface):
 
         return metadata
 
-    def get_sleep_states_times(self):
-        sleep_behavior_df = pd.read_csv(self.file_path)
-
-        import numpy as np
+    def prefetch_data(self) -> None:
+        """Parse the sleep classification csv ahead of `add_to_nwbfile`."""
+        self.get_sleep_behavior_df()
 
-        # Note this will have the first row as None
-        shifted_sleep_state = sleep_behavior_df["SleepState"].shift()
-        start_indices = np.where(sleep_behavior_df["SleepState"] != shifted_sleep_state)[0]
-        stop_indices = [i - 1 for i in start_indices[1:]]
-        stop_indices.append(len(sleep_behavior_df) - 1)
-        stop_indices = np.array(stop_indices)
+    def get_sleep_behavior_df(self) -> pd.DataFrame:
+        """Parse the sleep classification csv once and return the cached table."""
+        if self._sleep_behavior_df is None:
+            self._sleep_behavior_df = pd.read_csv(
+                self.file_path, usecols=["Frame", "SleepState"], dtype=dict(Frame="int32", SleepState="category")
+            )
+        return self._sleep_behavior_df
 
-        start_frames = sleep_behavior_df["Frame"][start_indices].values
-        start_times = self._start_times if self._start_times is not None else start_frames / self.sampling_frequency
-        stop_frames = sleep_behavior_df["Frame"][stop_indices].values
-        stop_times = self._stop_times if self._stop_times is not None else stop_frames / self.sampling_frequency
+    def get_sleep_states_times(self):
+        sleep_behavior_df = self.get_sleep_behavior_df()
+
+        # Consecutive epochs with the same categorical code form one sleep state interval
+        epoch_state_codes, state_labels = self.get_sleep_state_codes()
+        start_indices, stop_indices, state_codes = run_length_encode(epoch_state_codes)
+
+        frames = sleep_behavior_df["Frame"].values
+        start_frames = frames[start_indices]
+        start_times = (
+            self._start_times
+            if self._start_times is not None
+            else start_frames / self.sampling_frequency + self._time_shift
+        )
+        # The interval stops at the last epoch classified with the same state
+        stop_frames = frames[stop_indices - 1]
+        stop_times = (
+            self._stop_times
+            if self._stop_times is not None
+            else stop_frames / self.sampling_frequency + self._time_shift
+        )
 
-        sleep_state = sleep_behavior_df["SleepState"][start_indices].values
+        sleep_state = np.asarray(state_labels)[state_codes]
 
         return start_times, stop_times, sleep_state
 
+    def get_sleep_state_codes(self):
+        """Return the uint8 sleep state code of every epoch and the label of each code."""
+        sleep_behavior_df = self.get_sleep_behavior_df()
+        sleep_states = sleep_behavior_df["SleepState"].cat
+        state_codes = sleep_states.codes.values
+        # Missing values have code -1, they cannot be written to the string column of SleepIntervals either
+        missing_rows = np.flatnonzero(state_codes < 0)
+        if missing_rows.size > 0:
+            raise ValueError(
+                f"Missing SleepState values in {self.file_path} at rows {missing_rows.tolist()} "
+                f"(Frame {sleep_behavior_df['Frame'].values[missing_rows].tolist()})"
+            )
+        if len(sleep_states.categories) > np.iinfo(np.uint8).max:
+            raise ValueError(
+                f"Too many sleep states in {self.file_path} for uint8 codes: {len(sleep_states.categories)}"
+            )
+
+        return state_codes.astype(np.uint8), list(sleep_states.categories)
+
+    def get_starting_time(self) -> float:
+        sleep_behavior_df = self.get_sleep_behavior_df()
+        return sleep_behavior_df["Frame"].values[0] / self.sampling_frequency
+
     def set_aligned_interval_times(self, start_times: List[float], stop_times: List[float]) -> None:
         self._start_times = start_times
         self._stop_times = stop_times
 
+    def set_aligned_starting_time(self, aligned_starting_time: float) -> None:
+        self._starting_time = aligned_starting_time
+
+    def set_aligned_time_shift(self, time_shift: float) -> None:
+        """Shift all the times of this interface by a constant, applied lazily when the data is written."""
+        self._time_shift = time_shift
+
     def add_to_nwbfile(self, nwbfile: NWBFile, metadata: Optional[dict] = None):
 
         start_times, stop_times, sleep_state = self.get_sleep_states_times()
@@ -64,7 +118,6 @@ class Zaki2024SleepClassificationInterface(BaseDataInterface):
             "from the HD-X02 sensor (EEG, EMG, temperature, etc.)."
         )
 
-        sleep_intervals = TimeIntervals(name="SleepIntervals", description=description)
         column_description = """
             Sleep State Classification, it can be one of the following: 
             - 'quiet wake': The animal is awake and alert but at rest, without engaging in any voluntary movement or significant cognitive activity
@@ -72,10 +125,36 @@ class Zaki2024SleepClassificationInterface(BaseDataInterface):
             - 'sws':  Slow-Wave Sleep (SWS) is a stage of non-REM (NREM) sleep characterized by slow, high-amplitude brain waves
             - 'wake': State of full consciousness when the animal is alert, responsive to the environment, and capable of voluntary movement
         """
-        sleep_intervals.add_column(name="sleep_state", description=column_description)
+        sleep_intervals = build_time_intervals(
+            name="SleepIntervals",
+            description=description,
+            start_times=start_times,
+            stop_times=stop_times,
+            columns=dict(sleep_state=(column_description, sleep_state)),
+        )
 
-        for start_time, stop_time, state in zip(start_times, stop_times, sleep_state):
-            sleep_intervals.add_interval(start_time=start_time, stop_time=stop_time, sleep_state=state)
+        # Per-epoch state codes, so that the state at a given time is a single index into the data
+        state_codes, state_labels = self.get_sleep_state_codes()
+        code_to_label = ", ".join(f"{code}: '{label}'" for code, label in enumerate(state_labels))
+        starting_time = (
+            self._starting_time if self._starting_time is not None else self.get_starting_time() + self._time_shift
+        )
+        frames = self.get_sleep_behavior_df()["Frame"].values
+        time_series_kwargs = dict(
+            name="SleepStateSeries",
+            description=(
+                f"Sleep state of each epoch classified at {self.sampling_frequency} Hz, coded as unsigned integers. "
+                f"Code to sleep state mapping: {code_to_label}. The sleep states are described in SleepIntervals."
+            ),
+            data=state_codes,
+            unit="n.a.",
+        )
+        if np.all(np.diff(frames) == 1):
+            time_series_kwargs.update(starting_time=starting_time, rate=self.sampling_frequency)
+        else:
+            # Classified epochs are not contiguous, store the time of each epoch explicitly
+            time_series_kwargs.update(timestamps=(frames - frames[0]) / self.sampling_frequency + starting_time)
+        sleep_state_series = TimeSeries(**time_series_kwargs)
 
         if "sleep" not in nwbfile.processing:
             sleep_module = nwbfile.create_processing_module(name="sleep", description="Sleep data")
@@ -83,3 +162,4 @@ class Zaki2024SleepClassificationInterface(BaseDataInterface):
             sleep_module = nwbfile.processing["sleep"]
 
         sleep_module.add(sleep_intervals)
+        sleep_module.add(sleep_state_series)
@@ -12,3 +12,22 @@ from .source_data_path_resolver import (
 )
 from .define_conversion_parameters import update_conversion_parameters_yaml
 from .generate_session_description import generate_session_description
+from .time_intervals import build_time_intervals
+from .run_length_encoding import run_length_encode
+from .conversion_profiling import ConversionProfiler
+from .conversion_manifest import build_conversion_manifest, is_conversion_up_to_date, write_conversion_manifest
+from .session_scheduling import (
+    estimate_session_cost,
+    estimate_session_peak_memory,
+    estimate_week_session_cost,
+    estimate_week_session_peak_memory,
+    predict_makespan,
+)
+from .conversion_journal import ConversionJournal
+from .dataset_catalog import DatasetCatalog
+from .external_links import link_nwbfile_objects, consolidate_external_links, check_nwbfile_references
+from .zarr_writing import write_nwbfile_to_zarr
+from .hdf5_direct_chunk_writing import write_nwbfile_with_direct_chunks
+from .block_prefetching import BlockPrefetcher
+from .streaming_image_statistics import StreamingImageStatistics
+from .timestamp_qc import analyze_frame_timestamps, segment_recording_bouts
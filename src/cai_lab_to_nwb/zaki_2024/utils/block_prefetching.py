@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+import numpy as np
+
+
+class BlockPrefetcher:
+    """
+    Read the consecutive blocks of samples of a source ahead of the reader, in a background thread.
+
+    The writers of the NWB file read the imaging frames in consecutive blocks of the same size (the buffers of the
+    data chunk iterators), and decode each block only when the previous one is written. When a block is read, the
+    prefetcher starts decoding the next `prefetch_blocks` blocks in a background thread, so that decoding overlaps
+    with the write and compression of the current block. A read that does not continue the previous one (e.g. the
+    first read, or a seek) drops the blocks decoded ahead, and is decoded in the background thread as well, once the
+    block it may be decoding is done, while the calling thread waits. The last block is kept, so reading it again,
+    e.g. for another part of the frames, does not decode it twice.
+
+    At most `prefetch_blocks` blocks are held on top of the block being written. All the blocks are decoded by the
+    single background thread, one at a time and in the order they are requested, so `read_block` is never called
+    from two threads at once and needs not be thread-safe. With `prefetch_blocks=0`, it is called in the calling
+    thread.
+
+    Examples:
+    ---------
+    >>> prefetcher = BlockPrefetcher(read_block=extractor.get_series, num_samples=extractor.get_num_samples())
+    >>> first_block = prefetcher.get_block(0, 100)  # Then decodes frames 100 to 200 in the background
+    >>> second_block = prefetcher.get_block(100, 200)  # Waits for them, decodes frames 200 to 300
+    """
+
+    def __init__(self, read_block: Callable[[int, int], np.ndarray], num_samples: int, prefetch_blocks: int = 1):
+        """
+        Parameters:
+        -----------
+        read_block : Callable[[int, int], np.ndarray]
+            Function returning the samples of a block from its start (inclusive) and end (exclusive) sample.
+        num_samples : int
+            Number of samples of the source, no block is read past it.
+        prefetch_blocks : int, optional
+            Number of blocks decoded ahead of the reader. With 0, every block is decoded in the calling thread.
+            Defaults to 1.
+        """
+        self.read_block = read_block
+        self.num_samples = num_samples
+        self.prefetch_blocks = prefetch_blocks
+        self._pending_blocks = OrderedDict()
+        self._last_block = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def get_block(self, start_sample: int, end_sample: int) -> np.ndarray:
+        """Return the samples from `start_sample` (inclusive) to `end_sample` (exclusive)."""
+        key = (start_sample, end_sample)
+        with self._lock:
+            if self._last_block is not None and self._last_block[0] == key:
+                return self._last_block[1]
+
+            future = self._pending_blocks.pop(key, None)
+            if future is None:
+                self._drop_pending_blocks()
+                if self.prefetch_blocks > 0:
+                    # Queued after the block that may be decoding, so that the reads never overlap
+                    future = self._get_executor().submit(self.read_block, start_sample, end_sample)
+            else:
+                # Blocks before the one read are skipped by the reader
+                for pending_key in [pending_key for pending_key in self._pending_blocks if pending_key < key]:
+                    self._pending_blocks.pop(pending_key).cancel()
+            self._schedule_next_blocks(end_sample=end_sample, block_size=end_sample - start_sample)
+
+        block = self.read_block(start_sample, end_sample) if future is None else future.result()
+        with self._lock:
+            self._last_block = (key, block)
+        return block
+
+    def _schedule_next_blocks(self, end_sample: int, block_size: int) -> None:
+        next_start_sample = next(reversed(self._pending_blocks))[1] if self._pending_blocks else end_sample
+        while len(self._pending_blocks) < self.prefetch_blocks and next_start_sample < self.num_samples:
+            next_end_sample = min(next_start_sample + block_size, self.num_samples)
+            self._pending_blocks[(next_start_sample, next_end_sample)] = self._get_executor().submit(
+                self.read_block, next_start_sample, next_end_sample
+            )
+            next_start_sample = next_end_sample
+
+        # The source is read to the end, the thread is not needed anymore once it decoded the blocks queued
+        if not self._pending_blocks and self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="BlockPrefetcher")
+        return self._executor
+
+    def _drop_pending_blocks(self) -> None:
+        for future in self._pending_blocks.values():
+            future.cancel()
+        self._pending_blocks.clear()
+
+    def close(self) -> None:
+        """Drop the blocks decoded ahead and stop the background thread."""
+        with self._lock:
+            self._drop_pending_blocks()
+            self._last_block = None
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
@@ -0,0 +1,108 @@
+import itertools
+import math
+from typing import Iterator, Union
+
+import numpy as np
+from hdmf.data_utils import AbstractDataChunkIterator, GenericDataChunkIterator
+from pynwb import NWBFile, TimeSeries
+
+# Datasets smaller than this are written by the backend, splitting them across threads is not worth it
+DEFAULT_MIN_PARALLEL_DATASET_BYTES = 64e6
+
+
+class DeferredDataChunkIterator(AbstractDataChunkIterator):
+    """Iterator yielding no data, so that the backend creates a dataset of the full shape that is filled afterwards."""
+
+    def __init__(self, dtype: np.dtype, shape: tuple, chunk_shape: tuple):
+        self._dtype = np.dtype(dtype)
+        self._shape = tuple(shape)
+        self._chunk_shape = tuple(chunk_shape)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        raise StopIteration
+
+    def recommended_chunk_shape(self) -> tuple:
+        return self._chunk_shape
+
+    def recommended_data_shape(self) -> tuple:
+        return self._shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def maxshape(self) -> tuple:
+        return self._shape
+
+
+def pop_large_time_series_datasets(
+    nwbfile: NWBFile, backend_configuration, min_dataset_bytes: float = DEFAULT_MIN_PARALLEL_DATASET_BYTES
+) -> list[tuple]:
+    """
+    Remove the configurations of the large TimeSeries datasets from a backend configuration, to write them separately.
+
+    Parameters:
+    -----------
+    nwbfile : NWBFile
+        The in-memory NWB file.
+    backend_configuration : HDF5BackendConfiguration or ZarrBackendConfiguration
+        The backend configuration of the NWB file, from `get_default_backend_configuration`, modified in place.
+    min_dataset_bytes : float, optional
+        Size from which a dataset is removed from the configuration, in bytes.
+
+    Returns:
+    --------
+    list of tuple
+        The configuration of each removed dataset and its source data, an array or a GenericDataChunkIterator.
+    """
+    large_datasets = []
+    for key, dataset_configuration in list(backend_configuration.dataset_configurations.items()):
+        neurodata_object = nwbfile.objects[dataset_configuration.object_id]
+        if not isinstance(neurodata_object, TimeSeries):
+            continue
+        source = neurodata_object.fields.get(dataset_configuration.dataset_name)
+        # Linked TimeSeries and data already wrapped by an interface are left to the backend
+        if not isinstance(source, (np.ndarray, GenericDataChunkIterator)):
+            continue
+        num_bytes = math.prod(dataset_configuration.full_shape) * dataset_configuration.dtype.itemsize
+        if num_bytes < min_dataset_bytes:
+            continue
+
+        large_datasets.append((dataset_configuration, source))
+        backend_configuration.dataset_configurations.pop(key)
+    return large_datasets
+
+
+def iterate_source_blocks(
+    source: Union[np.ndarray, GenericDataChunkIterator], buffer_shape: tuple
+) -> Iterator[tuple[tuple[slice, ...], np.ndarray]]:
+    """
+    Yield the selection and data of consecutive blocks of a dataset source, one buffer at a time.
+
+    Parameters:
+    -----------
+    source : Union[np.ndarray, GenericDataChunkIterator]
+        An array, sliced in blocks of `buffer_shape`, or an iterator, whose buffers are read in order.
+    buffer_shape : tuple
+        Shape of the blocks of an array source.
+
+    Returns:
+    --------
+    Iterator[Tuple[Tuple[slice, ...], np.ndarray]]
+        The selection of each block in the dataset and its data.
+    """
+    if isinstance(source, GenericDataChunkIterator):
+        for data_chunk in source:
+            yield data_chunk.selection, data_chunk.data
+        return
+
+    block_starts = [range(0, length, step) for length, step in zip(source.shape, buffer_shape)]
+    for starts in itertools.product(*block_starts):
+        selection = tuple(
+            slice(start, min(start + step, length)) for start, step, length in zip(starts, buffer_shape, source.shape)
+        )
+        yield selection, np.asarray(source[selection])
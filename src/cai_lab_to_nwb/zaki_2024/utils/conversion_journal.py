@@ -0,0 +1,75 @@
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from typing import Union
+
+SESSION_STATUSES = ("pending", "running", "done", "failed")
+
+
+class ConversionJournal:
+    """
+    Append-only JSONL record of the status of each session of a batch conversion.
+
+    Every status change is appended as one line with the session key, the new status, the time and any additional
+    fields (attempt, duration, error file). The current status of a session is its last record, so a batch that
+    stopped at any point, even killed mid-write, can be resumed from the journal: a truncated last line is ignored.
+    Only the process scheduling the conversions writes to the journal.
+
+    Examples:
+    ---------
+    >>> journal = ConversionJournal(output_dir_path / "conversion_journal.jsonl")
+    >>> journal.record("sub-Ca_EEG3-4_ses-OfflineDay1Session1.nwb", status="running", attempt=1)
+    >>> journal.get_latest_records()["sub-Ca_EEG3-4_ses-OfflineDay1Session1.nwb"]["status"]
+    'running'
+    """
+
+    def __init__(self, file_path: Union[str, Path]):
+        self.file_path = Path(file_path)
+        self.file_path.parent.mkdir(parents=True, exist_ok=True)
+        # Terminate a line cut short by a crash, so that it does not swallow the next record
+        if self.file_path.is_file() and self.file_path.stat().st_size > 0:
+            with open(self.file_path, mode="rb+") as file:
+                file.seek(-1, os.SEEK_END)
+                if file.read(1) != b"\n":
+                    file.write(b"\n")
+
+    def record(self, session_key: str, status: str, **fields) -> dict:
+        """
+        Append a status change of a session to the journal.
+
+        Parameters:
+        -----------
+        session_key : str
+            Identifier of the session, e.g. the path of its NWB file relative to the output directory.
+        status : str
+            One of "pending", "running", "done" or "failed".
+        fields
+            Additional JSON-serializable fields stored in the record.
+
+        Returns:
+        --------
+        dict
+            The record appended to the journal.
+        """
+        assert status in SESSION_STATUSES, f"Unknown status '{status}', expected one of {SESSION_STATUSES}"
+        entry = dict(session=session_key, status=status, time=datetime.now().isoformat(), **fields)
+        with open(self.file_path, mode="a") as file:
+            file.write(json.dumps(entry, default=str) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        return entry
+
+    def get_latest_records(self) -> dict:
+        """Return the last record of each session in the journal, keyed by session."""
+        latest_records = dict()
+        if not self.file_path.is_file():
+            return latest_records
+        with open(self.file_path, mode="r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Line cut short by a crash while it was being written
+                latest_records[entry["session"]] = entry
+        return latest_records
@@ -0,0 +1,169 @@
+import hashlib
+import json
+import os
+from functools import lru_cache
+from importlib.metadata import PackageNotFoundError, version
+from pathlib import Path
+from typing import Optional, Union
+
+# Packages whose version changes the content of the NWB files
+_MANIFEST_PACKAGES = ["cai-lab-to-nwb", "neuroconv", "pynwb", "roiextractors"]
+
+# Arguments of `session_to_nwb` that do not change the content of the NWB file, only how fast it is written
+_IGNORED_PARAMETERS = [
+    "output_dir_path",
+    "overwrite",
+    "verbose",
+    "max_workers",
+    "profile",
+    "imaging_prefetch_blocks",
+    "parallel_compression",
+]
+
+# Source files of the conversion, whose changes change the content of the NWB files. The version of the package is
+# not bumped on every change of the converter, so the sources themselves are hashed. The conversion parameters of
+# the sessions are already in the manifest, so a new session in them does not change the others.
+_SOURCE_DIR_PATH = Path(__file__).parent.parent
+_SOURCE_SUFFIXES = [".py", ".yaml"]
+_IGNORED_SOURCE_FILE_NAMES = ["conversion_parameters.yaml"]
+
+
+def _get_package_versions() -> dict:
+    package_versions = dict()
+    for package_name in _MANIFEST_PACKAGES:
+        try:
+            package_versions[package_name] = version(package_name)
+        except PackageNotFoundError:
+            package_versions[package_name] = None
+    return package_versions
+
+
+@lru_cache(maxsize=None)
+def _get_source_hash() -> str:
+    """Return the SHA-256 of the source files of the conversion, read once per process."""
+    source_hash = hashlib.sha256()
+    for file_path in sorted(_SOURCE_DIR_PATH.rglob("*")):
+        if file_path.suffix not in _SOURCE_SUFFIXES or file_path.name in _IGNORED_SOURCE_FILE_NAMES:
+            continue
+        source_hash.update(file_path.relative_to(_SOURCE_DIR_PATH).as_posix().encode("utf-8"))
+        source_hash.update(file_path.read_bytes())
+    return source_hash.hexdigest()
+
+
+def _get_file_stats(path: Path) -> list[dict]:
+    """Return the path, size and modification time of a file, or of all the files under a directory."""
+    if path.is_file():
+        stat_result = path.stat()
+        return [dict(path=str(path), size=stat_result.st_size, mtime_ns=stat_result.st_mtime_ns)]
+    if not path.is_dir():
+        return [dict(path=str(path), size=None, mtime_ns=None)]
+
+    file_stats = []
+    for dir_path, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_stats.extend(_get_file_stats(Path(dir_path) / file_name))
+    return file_stats
+
+
+def build_conversion_manifest(
+    session_to_nwb_kwargs: dict, input_paths: Optional[list[Union[str, Path]]] = None
+) -> dict:
+    """
+    Build the manifest of the inputs of one session conversion.
+
+    The manifest records the size and modification time of every input file (all the files under the folders given
+    as input), the conversion parameters, the versions of the packages writing the file and the hash of the source
+    files of the conversion. Its fingerprint is the SHA-256 of all of them, so it changes whenever any of them
+    changes. The contents of the input files are not read.
+
+    Parameters:
+    -----------
+    session_to_nwb_kwargs : dict
+        The arguments of `session_to_nwb`. Arguments ending in `_path`, other than `output_dir_path`, are input files
+        or folders.
+    input_paths : list of Union[str, Path], optional
+        Input files or folders of the conversion, for conversions whose arguments point to a broader folder than
+        their inputs (e.g. the whole data share). Defaults to the arguments ending in `_path`.
+
+    Returns:
+    --------
+    dict
+        The manifest, with the `fingerprint`, `inputs`, `parameters`, `package_versions` and `source_hash` fields.
+    """
+    parameters = {
+        key: value
+        for key, value in session_to_nwb_kwargs.items()
+        if key not in _IGNORED_PARAMETERS and value is not None
+    }
+    if input_paths is None:
+        input_paths = [value for key, value in parameters.items() if key.endswith("_path")]
+    input_paths = sorted({Path(input_path) for input_path in input_paths})
+    inputs = sorted(
+        (file_stats for input_path in input_paths for file_stats in _get_file_stats(input_path)),
+        key=lambda file_stats: file_stats["path"],
+    )
+    manifest = dict(
+        inputs=inputs,
+        parameters=json.loads(json.dumps(parameters, sort_keys=True, default=str)),
+        package_versions=_get_package_versions(),
+        source_hash=_get_source_hash(),
+    )
+    manifest_json = json.dumps(manifest, sort_keys=True).encode("utf-8")
+    return dict(fingerprint=hashlib.sha256(manifest_json).hexdigest(), **manifest)
+
+
+def get_manifest_file_path(nwbfile_path: Union[str, Path]) -> Path:
+    """Return the path of the manifest stored next to an NWB file."""
+    return Path(nwbfile_path).with_suffix(".manifest.json")
+
+
+def write_conversion_manifest(nwbfile_path: Union[str, Path], manifest: dict) -> Path:
+    """
+    Write the manifest next to the NWB file.
+
+    The file is written to a temporary path and then renamed, so an interrupted write never leaves a partial
+    manifest behind.
+
+    Parameters:
+    -----------
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file converted from the inputs of the manifest.
+    manifest : dict
+        The manifest returned by `build_conversion_manifest`.
+
+    Returns:
+    --------
+    Path
+        The path of the manifest.
+    """
+    manifest_file_path = get_manifest_file_path(nwbfile_path)
+    temporary_file_path = manifest_file_path.with_name(manifest_file_path.name + ".tmp")
+    temporary_file_path.write_text(json.dumps(manifest, indent=2))
+    os.replace(temporary_file_path, manifest_file_path)
+    return manifest_file_path
+
+
+def is_conversion_up_to_date(nwbfile_path: Union[str, Path], manifest: dict) -> bool:
+    """
+    Check whether an NWB file was converted from the inputs described by the manifest.
+
+    Parameters:
+    -----------
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file.
+    manifest : dict
+        The manifest of the current inputs, returned by `build_conversion_manifest`.
+
+    Returns:
+    --------
+    bool
+        True if the NWB file exists and the manifest stored next to it has the same fingerprint.
+    """
+    manifest_file_path = get_manifest_file_path(nwbfile_path)
+    if not Path(nwbfile_path).is_file() or not manifest_file_path.is_file():
+        return False
+    try:
+        stored_manifest = json.loads(manifest_file_path.read_text())
+    except (OSError, json.JSONDecodeError):
+        return False
+    return stored_manifest.get("fingerprint") == manifest["fingerprint"]
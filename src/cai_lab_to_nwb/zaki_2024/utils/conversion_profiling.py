@@ -0,0 +1,146 @@
+import json
+import os
+import platform
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import Optional, Union
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+_PROC_SELF_IO = Path("/proc/self/io")
+_PROC_SELF_STATUS = Path("/proc/self/status")
+_PROC_SELF_CLEAR_REFS = Path("/proc/self/clear_refs")
+
+
+def _read_io_counters() -> dict:
+    """Return the I/O counters of the current process, or an empty dict where /proc is not available."""
+    try:
+        lines = _PROC_SELF_IO.read_text().splitlines()
+    except OSError:
+        return dict()
+    counters = dict(line.split(": ") for line in lines)
+    # rchar/wchar count every byte passed to read/write calls, read_bytes/write_bytes only those reaching the storage
+    return dict(
+        io_bytes_read=int(counters["rchar"]),
+        io_bytes_written=int(counters["wchar"]),
+        storage_bytes_read=int(counters["read_bytes"]),
+        storage_bytes_written=int(counters["write_bytes"]),
+    )
+
+
+def _reset_peak_rss() -> bool:
+    """Reset the peak resident set size of the current process, which is only supported by Linux."""
+    try:
+        _PROC_SELF_CLEAR_REFS.write_text("5")
+    except OSError:
+        return False
+    return True
+
+
+def _read_peak_rss() -> Optional[int]:
+    """Return the peak resident set size of the current process in bytes."""
+    try:
+        for line in _PROC_SELF_STATUS.read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    return max_rss if platform.system() == "Darwin" else max_rss * 1024
+
+
+class ConversionProfiler:
+    """
+    Record the wall time, CPU time, peak memory and I/O of the stages of a conversion.
+
+    Each stage is measured with the `stage` context manager and the measurements are written as a JSON report with
+    `write_report`. The CPU time accounts for all the threads of the process. The peak RSS is the high-water mark
+    reached during the stage where the kernel allows resetting it (Linux), otherwise the high-water mark of the
+    process up to the end of the stage. The I/O counters are only available on Linux.
+
+    Examples:
+    ---------
+    >>> profiler = ConversionProfiler()
+    >>> with profiler.stage("get_metadata"):
+    >>>     metadata = converter.get_metadata()
+    >>> profiler.write_report("sub-Ca_EEG3-4_ses-OfflineDay1Session1.profile.json")
+    """
+
+    def __init__(self):
+        self.stages = []
+        self._start_datetime = datetime.now()
+        self._start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Measure the code run inside the context as a stage of the conversion.
+
+        Parameters:
+        -----------
+        name : str
+            Name of the stage in the report.
+        """
+        peak_rss_is_per_stage = _reset_peak_rss()
+        io_counters_start = _read_io_counters()
+        wall_time_start = time.perf_counter()
+        cpu_time_start = time.process_time()
+        try:
+            yield
+        finally:
+            cpu_time = time.process_time() - cpu_time_start
+            wall_time = time.perf_counter() - wall_time_start
+            io_counters_stop = _read_io_counters()
+
+            stage = dict(
+                name=name,
+                wall_time_seconds=wall_time,
+                cpu_time_seconds=cpu_time,
+                peak_rss_bytes=_read_peak_rss(),
+                peak_rss_scope="stage" if peak_rss_is_per_stage else "process",
+            )
+            for counter_name, counter_stop in io_counters_stop.items():
+                stage[counter_name] = counter_stop - io_counters_start[counter_name]
+            self.stages.append(stage)
+
+    def get_report(self) -> dict:
+        """Return the measurements of all the stages recorded so far."""
+        return dict(
+            start_datetime=self._start_datetime.isoformat(),
+            total_wall_time_seconds=time.perf_counter() - self._start_time,
+            peak_rss_bytes=max((stage["peak_rss_bytes"] or 0 for stage in self.stages), default=None),
+            hostname=platform.node(),
+            platform=platform.platform(),
+            python_version=platform.python_version(),
+            cpu_count=os.cpu_count(),
+            stages=self.stages,
+        )
+
+    def write_report(self, file_path: Union[str, Path], **extra_fields) -> Path:
+        """
+        Write the report as JSON.
+
+        Parameters:
+        -----------
+        file_path : Union[str, Path]
+            Path of the JSON report.
+        extra_fields
+            Additional fields stored at the top level of the report, e.g. the path of the NWB file.
+
+        Returns:
+        --------
+        Path
+            The path of the JSON report.
+        """
+        file_path = Path(file_path)
+        report = dict(extra_fields, **self.get_report())
+        file_path.write_text(json.dumps(report, indent=2, default=str))
+        return file_path
@@ -0,0 +1,234 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+# Top-level folders of the data share holding the source data of the conversion
+CATALOG_ROOT_FOLDERS = ["Ca_EEG_Calcium", "Ca_EEG_EDF", "Ca_EEG_Experiment", "Ca_EEG_Sleep"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalog (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime_ns INTEGER);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+"""
+
+
+def _scan_directory(directory_path: str, cached_mtime_ns: Optional[int]) -> tuple:
+    """
+    List a directory, unless its modification time shows that its entries did not change since the last scan.
+
+    Returns the modification time of the directory and, when it was listed, its files with their size and
+    modification time and its subdirectories. The listing is None when the directory was not listed, and the
+    modification time is None when the directory was removed since its parent was listed.
+    """
+    try:
+        mtime_ns = os.stat(directory_path).st_mtime_ns
+    except FileNotFoundError:
+        return None, None
+    if mtime_ns == cached_mtime_ns:
+        return mtime_ns, None
+
+    files, subdirectories = [], []
+    with os.scandir(directory_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(entry.name)
+            elif entry.is_file():
+                stat_result = entry.stat()
+                files.append((entry.name, stat_result.st_size, stat_result.st_mtime_ns))
+    return mtime_ns, (files, subdirectories)
+
+
+class DatasetCatalog:
+    """
+    SQLite catalog of every file and folder of the data share used by the conversion, with their size and mtime.
+
+    The catalog is built by crawling `CATALOG_ROOT_FOLDERS` once, listing the folders of each level of the tree in
+    parallel, and the path resolvers of `source_data_path_resolver` query it instead of probing the filesystem. On
+    a network share this replaces one round trip per probe by a local query.
+
+    `refresh` updates the catalog incrementally: a folder is listed again only if its modification time changed,
+    which happens when entries are added, removed or renamed in it. Files rewritten in place inside an unchanged
+    folder keep their old size and mtime in the catalog.
+
+    Queries are thread-safe, so the catalog can be shared by resolvers running in a thread pool.
+
+    Examples:
+    ---------
+    >>> catalog = DatasetCatalog(data_dir_path=Path("D:/Cai-CN-data-share/"))
+    >>> catalog.refresh()
+    >>> get_video_file_path("Ca_EEG3-4", "FC", data_dir_path, catalog=catalog)
+    """
+
+    def __init__(
+        self,
+        data_dir_path: Union[str, Path],
+        catalog_file_path: Optional[Union[str, Path]] = None,
+        max_workers: int = 16,
+    ):
+        """
+        Open the catalog of a data share, creating it if needed. Call `refresh` to crawl the share.
+
+        Parameters:
+        -----------
+        data_dir_path : Union[str, Path]
+            Path to the base data directory.
+        catalog_file_path : Union[str, Path], optional
+            Path of the SQLite file of the catalog. Defaults to `dataset_catalog_<hash of data_dir_path>.sqlite` in
+            the user cache directory (`$XDG_CACHE_HOME/cai_lab_to_nwb`, by default `~/.cache/cai_lab_to_nwb`).
+            A catalog file built from another data directory is emptied, so it must be refreshed before use.
+        max_workers : int, optional
+            Number of folders listed concurrently during `refresh`. Defaults to 16.
+        """
+        self.data_dir_path = Path(data_dir_path)
+        root_path = self.data_dir_path.absolute().as_posix()
+        if catalog_file_path is None:
+            cache_dir_path = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "cai_lab_to_nwb"
+            cache_dir_path.mkdir(parents=True, exist_ok=True)
+            root_hash = hashlib.sha256(root_path.encode()).hexdigest()[:16]
+            catalog_file_path = cache_dir_path / f"dataset_catalog_{root_hash}.sqlite"
+        self.catalog_file_path = Path(catalog_file_path)
+        self.max_workers = max_workers
+        self._connection = sqlite3.connect(self.catalog_file_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._connection.executescript(_SCHEMA)
+
+        # The entries are relative to the data directory, so those of another share (e.g. a stub copy) would answer
+        # the queries with its files until the next refresh
+        with self._connection:
+            rows = self._connection.execute("SELECT value FROM catalog WHERE key = 'data_dir_path'").fetchall()
+            if rows != [(root_path,)]:
+                self._connection.execute("DELETE FROM files")
+                self._connection.execute("DELETE FROM directories")
+                self._connection.execute("INSERT OR REPLACE INTO catalog VALUES ('data_dir_path', ?)", (root_path,))
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _to_key(self, path: Union[str, Path]) -> Optional[str]:
+        """Return the path relative to the data directory, as stored in the catalog, or None if outside of it."""
+        try:
+            return Path(path).relative_to(self.data_dir_path).as_posix()
+        except ValueError:
+            return None
+
+    def refresh(self) -> dict:
+        """
+        Crawl the data share and update the catalog with the folders whose content changed.
+
+        Returns:
+        --------
+        dict
+            The number of folders visited, of folders listed and of files in the catalog.
+        """
+        cached_mtimes = dict(self._query("SELECT path, mtime_ns FROM directories", ()))
+        directory_keys = [key for key in CATALOG_ROOT_FOLDERS if (self.data_dir_path / key).is_dir()]
+        num_visited_directories, num_listed_directories = 0, 0
+        seen_directory_keys = set()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while directory_keys:
+                scans = executor.map(
+                    lambda key: _scan_directory(str(self.data_dir_path / key), cached_mtimes.get(key)),
+                    directory_keys,
+                )
+                next_directory_keys = []
+                with self._lock, self._connection:
+                    for directory_key, (mtime_ns, listing) in zip(directory_keys, scans):
+                        if mtime_ns is None:
+                            self._remove_tree(directory_key)
+                            continue
+                        seen_directory_keys.add(directory_key)
+                        num_visited_directories += 1
+                        if listing is None:
+                            subdirectory_keys = [
+                                row[0]
+                                for row in self._connection.execute(
+                                    "SELECT path FROM directories WHERE parent = ?", (directory_key,)
+                                )
+                            ]
+                        else:
+                            num_listed_directories += 1
+                            files, subdirectories = listing
+                            subdirectory_keys = [f"{directory_key}/{name}" for name in subdirectories]
+                            self._update_directory(directory_key, mtime_ns, files, subdirectory_keys)
+                        next_directory_keys.extend(subdirectory_keys)
+                directory_keys = next_directory_keys
+
+        # Remove the root folders that no longer exist and everything under them
+        with self._lock, self._connection:
+            for directory_key in set(cached_mtimes) - seen_directory_keys:
+                if "/" not in directory_key:
+                    self._remove_tree(directory_key)
+        num_files = self._query("SELECT COUNT(*) FROM files", ())[0][0]
+        return dict(
+            num_visited_directories=num_visited_directories,
+            num_listed_directories=num_listed_directories,
+            num_files=num_files,
+        )
+
+    def _update_directory(self, directory_key: str, mtime_ns: int, files: list, subdirectory_keys: list) -> None:
+        parent_key = directory_key.rpartition("/")[0] or None
+        self._connection.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory_key, parent_key, mtime_ns)
+        )
+        self._connection.execute("DELETE FROM files WHERE directory = ?", (directory_key,))
+        self._connection.executemany(
+            "INSERT INTO files VALUES (?, ?, ?, ?)",
+            [(f"{directory_key}/{name}", directory_key, size, file_mtime_ns) for name, size, file_mtime_ns in files],
+        )
+        # Subdirectories removed from the listing are dropped with their whole tree, new ones are listed next
+        cached_subdirectory_keys = {
+            row[0]
+            for row in self._connection.execute("SELECT path FROM directories WHERE parent = ?", (directory_key,))
+        }
+        for removed_subdirectory_key in cached_subdirectory_keys - set(subdirectory_keys):
+            self._remove_tree(removed_subdirectory_key)
+
+    def _remove_tree(self, directory_key: str) -> None:
+        pattern = directory_key.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%"
+        self._connection.execute(
+            "DELETE FROM files WHERE directory = ? OR path LIKE ? ESCAPE '\\'", (directory_key, pattern)
+        )
+        self._connection.execute(
+            "DELETE FROM directories WHERE path = ? OR path LIKE ? ESCAPE '\\'", (directory_key, pattern)
+        )
+
+    def _query(self, sql: str, parameters: tuple) -> list:
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def is_file(self, path: Union[str, Path]) -> bool:
+        """Whether the path is a file of the catalog. Paths outside of the data directory are checked on disk."""
+        key = self._to_key(path)
+        if key is None:
+            return Path(path).is_file()
+        return self._query("SELECT 1 FROM files WHERE path = ?", (key,)) != []
+
+    def is_dir(self, path: Union[str, Path]) -> bool:
+        """Whether the path is a folder of the catalog. Paths outside of the data directory are checked on disk."""
+        key = self._to_key(path)
+        if key is None:
+            return Path(path).is_dir()
+        return self._query("SELECT 1 FROM directories WHERE path = ?", (key,)) != []
+
+    def get_subdirectories(self, path: Union[str, Path]) -> list[Path]:
+        """Return the subfolders of a folder, sorted by name."""
+        key = self._to_key(path)
+        if key is None:
+            return sorted(child for child in Path(path).iterdir() if child.is_dir())
+        rows = self._query("SELECT path FROM directories WHERE parent = ? ORDER BY path", (key,))
+        return [self.data_dir_path / row[0] for row in rows]
+
+    def get_file_stats(self, path: Union[str, Path]) -> Optional[tuple[int, int]]:
+        """Return the size in bytes and the modification time in nanoseconds of a file, or None if not found."""
+        key = self._to_key(path)
+        if key is None:
+            return None
+        rows = self._query("SELECT size, mtime_ns FROM files WHERE path = ?", (key,))
+        return tuple(rows[0]) if rows else None
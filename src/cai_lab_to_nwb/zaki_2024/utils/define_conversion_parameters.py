@@ -1,19 +1,23 @@
+import os
 import re
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 
 from cai_lab_to_nwb.zaki_2024.utils.source_data_path_resolver import *
 from cai_lab_to_nwb.zaki_2024.utils.generate_session_description import generate_session_description
+from cai_lab_to_nwb.zaki_2024.utils.dataset_catalog import DatasetCatalog
 
 
-def update_conversion_parameters_yaml(
+def get_session_to_nwb_kwargs_per_session(
     subject_id: str,
     data_dir_path: Union[str, Path],
     output_dir_path: Union[str, Path],
-    experiment_design_file_path: Union[str, Path],
+    subjects_df: pd.DataFrame,
     session_ids: list = (),
-):
+    catalog: Optional[DatasetCatalog] = None,
+) -> dict:
     """
-    Update a YAML file with parameters required for session-to-NWB conversion.
+    Resolve the parameters required for session-to-NWB conversion of every session of a subject.
 
     Parameters:
     -----------
@@ -23,36 +27,46 @@ def update_conversion_parameters_yaml(
         Path to the base data directory.
     output_dir_path : Union[str, Path]
         Path to the output directory for NWB files.
-    experiment_design_file_path : Union[str, Path]
-        Path to the experiment design file.
+    subjects_df : pd.DataFrame
+        The experiment design table, as read from the experiment design file.
     session_ids : list, optional
         List of session types to process. Defaults to an empty list.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory used to resolve the source data paths without probing the filesystem.
 
     Returns:
     --------
-    None
+    dict
+        The arguments of `session_to_nwb` for each session, keyed by session ID.
     """
-    yaml_file_path = Path(__file__).parent / "conversion_parameters.yaml"
-    subjects_df = pd.read_excel(experiment_design_file_path)
-    session_times_df = get_session_times_df(subject_id=subject_id, data_dir_path=data_dir_path, session_ids=session_ids)
+    session_times_df = get_session_times_df(
+        subject_id=subject_id, data_dir_path=data_dir_path, session_ids=session_ids, catalog=catalog
+    )
+    session_to_nwb_kwargs_per_session = {}
     for session_id in session_times_df["Session"]:
         session_row = session_times_df[session_times_df["Session"] == session_id].iloc[0]
         date_str = session_row["Date"]
         time_str = session_row["Time"]
-        experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path)
+        experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path, catalog=catalog)
         if "Offline" in session_id:
             if date_str is None:
-                date_str = get_date_str_from_experiment_dir_path(experiment_dir_path=experiment_dir_path)
-            edf_file_path = get_edf_file_path(subject_id, date_str, data_dir_path)
-            sleep_classification_file_path = get_sleep_classification_file_path(subject_id, session_id, data_dir_path)
+                date_str = get_date_str_from_experiment_dir_path(
+                    experiment_dir_path=experiment_dir_path, catalog=catalog
+                )
+            edf_file_path = get_edf_file_path(subject_id, date_str, data_dir_path, catalog=catalog)
+            sleep_classification_file_path = get_sleep_classification_file_path(
+                subject_id, session_id, data_dir_path, catalog=catalog
+            )
             video_file_path = None
             freezing_output_file_path = None
             shock_stimulus = None
         else:
             edf_file_path = None
             sleep_classification_file_path = None
-            video_file_path = get_video_file_path(subject_id, session_id, data_dir_path)
-            freezing_output_file_path = get_freezing_output_file_path(subject_id, session_id, data_dir_path)
+            video_file_path = get_video_file_path(subject_id, session_id, data_dir_path, catalog=catalog)
+            freezing_output_file_path = get_freezing_output_file_path(
+                subject_id, session_id, data_dir_path, catalog=catalog
+            )
             if session_id == "FC":
                 shock_amplitude = subjects_df["Amplitude"][subjects_df["Mouse"] == subject_id].to_numpy()[0]
                 shock_amplitude = float(re.findall(r"[-+]?\d*\.\d+|\d+", shock_amplitude)[0])
@@ -61,49 +75,164 @@ def update_conversion_parameters_yaml(
                 )
             else:
                 shock_stimulus = None
-        imaging_folder_path = get_imaging_folder_path(subject_id, session_id, data_dir_path, time_str, date_str)
-        minian_folder_path = get_miniscope_folder_path(subject_id, session_id, data_dir_path)
+        imaging_folder_path = get_imaging_folder_path(
+            subject_id, session_id, data_dir_path, time_str, date_str, catalog=catalog
+        )
+        minian_folder_path = get_miniscope_folder_path(subject_id, session_id, data_dir_path, catalog=catalog)
 
         session_description = generate_session_description(
-            experiment_design_file_path=experiment_design_file_path, subject_id=subject_id, session_id=session_id
+            experiment_design_file_path=None, subject_id=subject_id, session_id=session_id, subjects_df=subjects_df
         )
-        session_to_nwb_kwargs_per_session = {
-            session_id: {
-                "output_dir_path": str(output_dir_path),
-                "subject_id": subject_id,
-                "session_id": session_id,
-                "date_str": date_str,
-                "time_str": time_str,
-                "session_description": session_description,
-                "experiment_dir_path": str(experiment_dir_path),
-                "imaging_folder_path": str(imaging_folder_path) if imaging_folder_path else None,
-                "minian_folder_path": str(minian_folder_path) if minian_folder_path else None,
-                "video_file_path": str(video_file_path) if video_file_path else None,
-                "freezing_output_file_path": str(freezing_output_file_path) if freezing_output_file_path else None,
-                "edf_file_path": str(edf_file_path) if edf_file_path else None,
-                "sleep_classification_file_path": (
-                    str(sleep_classification_file_path) if sleep_classification_file_path else None
-                ),
-                "shock_stimulus": shock_stimulus,
-            }
+        session_to_nwb_kwargs_per_session[session_id] = {
+            "output_dir_path": str(output_dir_path),
+            "subject_id": subject_id,
+            "session_id": session_id,
+            "date_str": date_str,
+            "time_str": time_str,
+            "session_description": session_description,
+            "experiment_dir_path": str(experiment_dir_path),
+            "imaging_folder_path": str(imaging_folder_path) if imaging_folder_path else None,
+            "minian_folder_path": str(minian_folder_path) if minian_folder_path else None,
+            "video_file_path": str(video_file_path) if video_file_path else None,
+            "freezing_output_file_path": str(freezing_output_file_path) if freezing_output_file_path else None,
+            "edf_file_path": str(edf_file_path) if edf_file_path else None,
+            "sleep_classification_file_path": (
+                str(sleep_classification_file_path) if sleep_classification_file_path else None
+            ),
+            "shock_stimulus": shock_stimulus,
         }
+    return session_to_nwb_kwargs_per_session
+
+
+def _update_yaml_file(yaml_file_path: Path, session_to_nwb_kwargs_per_subject: dict) -> None:
+    """Merge the parameters of each subject into the YAML file, replacing it atomically."""
+    try:
+        with open(yaml_file_path, "r") as file:
+            yaml_content = yaml.safe_load(file) or {}
+    except FileNotFoundError:
+        yaml_content = {}
+
+    for subject_id, session_to_nwb_kwargs_per_session in session_to_nwb_kwargs_per_subject.items():
+        yaml_content.setdefault(subject_id, {}).update(session_to_nwb_kwargs_per_session)
 
-        try:
-            with open(yaml_file_path, "r") as file:
-                yaml_content = yaml.safe_load(file) or {}
-        except FileNotFoundError:
-            yaml_content = {}
+    # Write to a temporary file first, so that an interrupted write never leaves a truncated YAML file
+    temporary_file_path = yaml_file_path.with_name(yaml_file_path.name + ".tmp")
+    with open(temporary_file_path, "w") as file:
+        yaml.dump(yaml_content, file, default_flow_style=False)
+    os.replace(temporary_file_path, yaml_file_path)
 
-        if subject_id not in yaml_content:
-            yaml_content[subject_id] = {}
 
-        yaml_content[subject_id].update(session_to_nwb_kwargs_per_session)
+def update_conversion_parameters_yaml(
+    subject_id: str,
+    data_dir_path: Union[str, Path],
+    output_dir_path: Union[str, Path],
+    experiment_design_file_path: Union[str, Path],
+    session_ids: list = (),
+    catalog: Optional[DatasetCatalog] = None,
+):
+    """
+    Update a YAML file with parameters required for session-to-NWB conversion.
+
+    Parameters:
+    -----------
+    subject_id : str
+        The ID of the subject.
+    data_dir_path : Union[str, Path]
+        Path to the base data directory.
+    output_dir_path : Union[str, Path]
+        Path to the output directory for NWB files.
+    experiment_design_file_path : Union[str, Path]
+        Path to the experiment design file.
+    session_ids : list, optional
+        List of session types to process. Defaults to an empty list.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory used to resolve the source data paths without probing the filesystem.
+        Refresh it before resolving the parameters of a batch of subjects.
 
-        with open(yaml_file_path, "w") as file:
-            yaml.dump(yaml_content, file, default_flow_style=False)
+    Returns:
+    --------
+    None
+    """
+    yaml_file_path = Path(__file__).parent / "conversion_parameters.yaml"
+    subjects_df = pd.read_excel(experiment_design_file_path)
+    session_to_nwb_kwargs_per_session = get_session_to_nwb_kwargs_per_session(
+        subject_id=subject_id,
+        data_dir_path=data_dir_path,
+        output_dir_path=output_dir_path,
+        subjects_df=subjects_df,
+        session_ids=session_ids,
+        catalog=catalog,
+    )
+    _update_yaml_file(yaml_file_path, {subject_id: session_to_nwb_kwargs_per_session})
     return
 
 
+def update_conversion_parameters_yaml_for_subjects(
+    data_dir_path: Union[str, Path],
+    output_dir_path: Union[str, Path],
+    experiment_design_file_path: Union[str, Path],
+    subject_ids: Optional[list] = None,
+    session_ids: list = (),
+    catalog: Optional[DatasetCatalog] = None,
+    max_workers: int = 8,
+) -> dict:
+    """
+    Update the YAML file with parameters required for session-to-NWB conversion of many subjects at once.
+
+    The experiment design file is read once, the sessions of the subjects are resolved in parallel and the YAML file
+    is written once, atomically.
+
+    Parameters:
+    -----------
+    data_dir_path : Union[str, Path]
+        Path to the base data directory.
+    output_dir_path : Union[str, Path]
+        Path to the output directory for NWB files.
+    experiment_design_file_path : Union[str, Path]
+        Path to the experiment design file.
+    subject_ids : list, optional
+        IDs of the subjects to process. Defaults to all the subjects of the experiment design file.
+    session_ids : list, optional
+        List of session types to process. Defaults to an empty list, which processes all the sessions.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory used to resolve the source data paths without probing the filesystem.
+    max_workers : int, optional
+        Number of subjects resolved concurrently. Defaults to 8.
+
+    Returns:
+    --------
+    dict
+        The arguments of `session_to_nwb` of each session, keyed by subject ID and session ID. Subjects whose
+        sessions could not be resolved are reported and left out.
+    """
+    yaml_file_path = Path(__file__).parent / "conversion_parameters.yaml"
+    subjects_df = pd.read_excel(experiment_design_file_path)
+    if subject_ids is None:
+        subject_ids = subjects_df["Mouse"].tolist()
+
+    def resolve_subject(subject_id: str) -> dict:
+        return get_session_to_nwb_kwargs_per_session(
+            subject_id=subject_id,
+            data_dir_path=data_dir_path,
+            output_dir_path=output_dir_path,
+            subjects_df=subjects_df,
+            session_ids=session_ids,
+            catalog=catalog,
+        )
+
+    session_to_nwb_kwargs_per_subject = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {subject_id: executor.submit(resolve_subject, subject_id) for subject_id in subject_ids}
+        for subject_id, future in futures.items():
+            try:
+                session_to_nwb_kwargs_per_subject[subject_id] = future.result()
+            except Exception as exception:
+                print(f"Conversion parameters for subject {subject_id} could not be resolved: {exception!r}")
+
+    _update_yaml_file(yaml_file_path, session_to_nwb_kwargs_per_subject)
+    return session_to_nwb_kwargs_per_subject
+
+
 if __name__ == "__main__":
     session_ids = [
         "NeutralExposure",
@@ -114,10 +243,15 @@ if __name__ == "__main__":
         "Recall2",
         "Recall3",
     ]
+    data_dir_path = Path("D:/Cai-CN-data-share/")
+    # Crawl the data share once, only the folders changed since the last run are listed again
+    catalog = DatasetCatalog(data_dir_path=data_dir_path)
+    catalog.refresh()
     update_conversion_parameters_yaml(
         subject_id="Ca_EEG3-4",
-        data_dir_path=Path("D:/Cai-CN-data-share/"),
+        data_dir_path=data_dir_path,
         output_dir_path=Path("D:/cai_lab_conversion_nwb/"),
         experiment_design_file_path=Path("D:/Cai-CN-data-share/Ca_EEG_Design.xlsx"),
         session_ids=session_ids,
+        catalog=catalog,
     )
@@ -3,7 +3,7 @@ from typing import Union
 from datetime import timedelta
 
 from cai_lab_to_nwb.zaki_2024.interfaces.miniscope_imaging_interface import (
-    get_miniscope_timestamps,
+    get_miniscope_first_and_last_timestamps,
     get_recording_start_time,
 )
 
@@ -33,10 +33,11 @@ def get_session_slicing_time_range(miniscope_metadata_json: Union[str, Path], ti
     if miniscope_metadata_json.is_file() and timestamps_file_path.is_file():
 
         session_start_time = get_recording_start_time(file_path=miniscope_metadata_json)
-        miniscope_timestamps = get_miniscope_timestamps(file_path=timestamps_file_path)
+        # Only the first and last timestamps are needed, so the file is not parsed entirely
+        first_timestamp, last_timestamp = get_miniscope_first_and_last_timestamps(file_path=timestamps_file_path)
 
-        start_datetime_timestamp = session_start_time + timedelta(seconds=miniscope_timestamps[0])
-        stop_datetime_timestamp = session_start_time + timedelta(seconds=miniscope_timestamps[-1])
+        start_datetime_timestamp = session_start_time + timedelta(seconds=first_timestamp)
+        stop_datetime_timestamp = session_start_time + timedelta(seconds=last_timestamp)
 
         return start_datetime_timestamp, stop_datetime_timestamp
 
@@ -0,0 +1,239 @@
+import os
+from pathlib import Path
+from typing import Union
+
+import h5py
+import numpy as np
+from hdmf.container import AbstractContainer
+from pynwb import NWBHDF5IO
+from pynwb.base import TimeSeriesReferenceVectorData
+
+# Groups of an NWB file whose children are linked from the files written by modality. Processing modules are linked
+# whole, so each of them must be written by a single modality.
+LINKED_GROUP_PATHS = [
+    "acquisition",
+    "analysis",
+    "intervals",
+    "processing",
+    "stimulus/presentation",
+    "stimulus/templates",
+    "general/devices",
+    "general/optophysiology",
+]
+# Groups holding the session metadata, written identically by every modality that uses it (e.g. the Miniscope device
+# and imaging plane are written with the imaging and with the segmentation). The NWB file links the first copy, and
+# the copy of every other modality is replaced by a link to it, so that all the data share the same objects.
+SHARED_GROUP_PATHS = ["general/devices", "general/optophysiology"]
+
+
+def link_nwbfile_objects(nwbfile_path: Union[str, Path], linked_nwbfile_paths: list[Union[str, Path]]) -> list[str]:
+    """
+    Link the data objects of other NWB files of the same session into an NWB file, with HDF5 external links.
+
+    The NWB file must already hold the session metadata (e.g. written from the same metadata with no data interface).
+    The links are relative, so the files can be moved together. The specifications of the extensions cached in the
+    linked files are copied, so that the NWB file can be read on its own.
+
+    The objects of `SHARED_GROUP_PATHS` found in several linked files are replaced in all but the first one by links
+    to the first one, so the linked files are modified.
+
+    Parameters:
+    -----------
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file receiving the links.
+    linked_nwbfile_paths : list of Union[str, Path]
+        Paths of the NWB files holding the data, in the same folder as the NWB file or below it.
+
+    Returns:
+    --------
+    list of str
+        The paths of the objects linked in the NWB file.
+    """
+    nwbfile_path = Path(nwbfile_path)
+    linked_object_paths = []
+    # The linked file holding each shared object
+    shared_object_file_paths = dict()
+    with h5py.File(nwbfile_path, mode="r+") as nwbfile:
+        for linked_nwbfile_path in linked_nwbfile_paths:
+            linked_nwbfile_path = Path(linked_nwbfile_path)
+            relative_file_path = linked_nwbfile_path.resolve().relative_to(nwbfile_path.parent.resolve()).as_posix()
+            with h5py.File(linked_nwbfile_path, mode="r+") as linked_nwbfile:
+                for group_path in LINKED_GROUP_PATHS:
+                    if group_path not in linked_nwbfile:
+                        continue
+                    group = nwbfile.require_group(group_path)
+                    linked_group = linked_nwbfile[group_path]
+                    for name in list(linked_group):
+                        object_path = f"/{group_path}/{name}"
+                        if group_path in SHARED_GROUP_PATHS and object_path in shared_object_file_paths:
+                            # The soft links of the data to the shared object, e.g. from the plane segmentation to
+                            # its imaging plane, now resolve to the object linked by the NWB file
+                            shared_object_file_path = os.path.relpath(
+                                shared_object_file_paths[object_path], linked_nwbfile_path.resolve().parent
+                            )
+                            del linked_group[name]
+                            linked_group[name] = h5py.ExternalLink(
+                                Path(shared_object_file_path).as_posix(), object_path
+                            )
+                            continue
+                        if name in group:
+                            raise ValueError(
+                                f"'{group_path}/{name}' is written by more than one file: {relative_file_path} and "
+                                f"{group.get(name, getlink=True)}"
+                            )
+                        group[name] = h5py.ExternalLink(relative_file_path, object_path)
+                        linked_object_paths.append(f"{group_path}/{name}")
+                        if group_path in SHARED_GROUP_PATHS:
+                            shared_object_file_paths[object_path] = linked_nwbfile_path.resolve()
+
+                if "specifications" in linked_nwbfile:
+                    specifications = nwbfile.require_group("specifications")
+                    for namespace in linked_nwbfile["specifications"]:
+                        if namespace not in specifications:
+                            linked_nwbfile.copy(linked_nwbfile["specifications"][namespace], specifications)
+    return linked_object_paths
+
+
+def consolidate_external_links(nwbfile_path: Union[str, Path], remove_linked_files: bool = True) -> list[Path]:
+    """
+    Replace the external links created by `link_nwbfile_objects` by copies of the objects they point to.
+
+    The objects are copied chunk by chunk with their compression, without decoding them, and the result is a single
+    self-contained NWB file. The object references of the copies, e.g. from the ROIs of a fluorescence series to their
+    plane segmentation or from a TimeIntervals table to its time series, are then pointed to the copies of the objects
+    they referenced.
+
+    Parameters:
+    -----------
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file holding the links.
+    remove_linked_files : bool, optional
+        Whether to delete the linked files once all their objects are copied. Defaults to True.
+
+    Returns:
+    --------
+    list of Path
+        The paths of the linked files.
+    """
+    nwbfile_path = Path(nwbfile_path)
+    linked_nwbfiles = dict()
+    try:
+        with h5py.File(nwbfile_path, mode="r+") as nwbfile:
+            copied_objects = []
+            for group_path in LINKED_GROUP_PATHS:
+                if group_path not in nwbfile:
+                    continue
+                group = nwbfile[group_path]
+                for name in list(group):
+                    link = group.get(name, getlink=True)
+                    if not isinstance(link, h5py.ExternalLink):
+                        continue
+                    linked_nwbfile_path = nwbfile_path.parent / link.filename
+                    if linked_nwbfile_path not in linked_nwbfiles:
+                        linked_nwbfiles[linked_nwbfile_path] = h5py.File(linked_nwbfile_path, mode="r")
+                    linked_object = linked_nwbfiles[linked_nwbfile_path][link.path]
+                    del group[name]
+                    # Without expand_refs, so that the objects referenced are not copied a second time
+                    linked_object.file.copy(linked_object, group, name=name)
+                    copied_objects.append((linked_object, group[name]))
+
+            # The references can point to any copied object, so they are rewritten once all of them are copied
+            for linked_object, copied_object in copied_objects:
+                _copy_object_references(linked_object, copied_object)
+    finally:
+        for linked_nwbfile in linked_nwbfiles.values():
+            linked_nwbfile.close()
+
+    if remove_linked_files:
+        for linked_nwbfile_path in linked_nwbfiles:
+            linked_nwbfile_path.unlink()
+    return list(linked_nwbfiles)
+
+
+def _copy_object_references(linked_object: h5py.HLObject, copied_object: h5py.HLObject) -> None:
+    """Point the references of a copied object and its members to the objects at the same paths in its new file."""
+    linked_objects = [("", linked_object)]
+    if isinstance(linked_object, h5py.Group):
+        linked_object.visititems(lambda name, member: linked_objects.append((name, member)))
+
+    for name, linked_member in linked_objects:
+        copied_member = copied_object[name] if name else copied_object
+        for attribute_name, value in linked_member.attrs.items():
+            if isinstance(value, h5py.Reference):
+                copied_reference = _get_copied_reference(value, linked_member.file, copied_member.file)
+                copied_member.attrs.create(attribute_name, copied_reference, dtype=h5py.ref_dtype)
+        if not isinstance(linked_member, h5py.Dataset):
+            continue
+        dtype = linked_member.dtype
+        field_names = dtype.names if dtype.names is not None else [None]
+        reference_field_names = [
+            field_name
+            for field_name in field_names
+            if h5py.check_dtype(ref=dtype if field_name is None else dtype.fields[field_name][0]) is h5py.Reference
+        ]
+        if not reference_field_names:
+            continue
+        data = linked_member[()]
+        for field_name in reference_field_names:
+            references = data if field_name is None else data[field_name]
+            # The rows of a TimeIntervals table usually reference the same few time series
+            copied_references = dict()
+            for index, reference in np.ndenumerate(references):
+                if reference not in copied_references:
+                    copied_references[reference] = _get_copied_reference(
+                        reference, linked_member.file, copied_member.file
+                    )
+                references[index] = copied_references[reference]
+        copied_member[()] = data
+
+
+def _get_copied_reference(reference: h5py.Reference, linked_file: h5py.File, file: h5py.File) -> h5py.Reference:
+    if not reference:
+        return reference
+    path = linked_file[reference].name
+    if path is None or path not in file:
+        raise ValueError(f"The object referenced in {linked_file.filename} at {path} was not copied to {file.filename}")
+    return file[path].ref
+
+
+def check_nwbfile_references(nwbfile_path: Union[str, Path]) -> None:
+    """
+    Read an NWB file with pynwb and check that the objects linked or referenced by its objects are part of it.
+
+    The links and object references of files written by `link_nwbfile_objects` or `consolidate_external_links` must
+    resolve to the objects of the NWB file, e.g. the imaging plane of the plane segmentation must be the one of the
+    NWB file, and not a copy read from another file or an anonymous object.
+
+    Parameters:
+    -----------
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file.
+
+    Raises:
+    -------
+    ValueError
+        If an object links to or references an object that is not part of the NWB file.
+    """
+    with NWBHDF5IO(Path(nwbfile_path), mode="r") as io:
+        nwbfile = io.read()
+        objects = list(nwbfile.all_children())
+        object_ids = {id(obj) for obj in objects}
+        problems = []
+        for obj in objects:
+            for field_name, value in obj.fields.items():
+                values = (
+                    value.values()
+                    if isinstance(value, dict)
+                    else value if isinstance(value, (list, tuple)) else [value]
+                )
+                for target in values:
+                    if isinstance(target, AbstractContainer) and id(target) not in object_ids:
+                        problems.append(f"'{field_name}' of {obj.name} ({type(obj).__name__}) to {target.name}")
+            if isinstance(obj, TimeSeriesReferenceVectorData) and len(obj.data):
+                for timeseries in {id(row[2]): row[2] for row in obj.data[:]}.values():
+                    if id(timeseries) not in object_ids:
+                        problems.append(f"rows of {obj.parent.name} to {timeseries.name}")
+    if problems:
+        raise ValueError(
+            f"Objects of {nwbfile_path} link to objects outside of the file: " + "; ".join(sorted(set(problems)))
+        )
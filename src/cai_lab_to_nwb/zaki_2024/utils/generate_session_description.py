@@ -1,11 +1,18 @@
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 import pandas as pd
 import re
 
 
-def generate_session_description(experiment_design_file_path: Union[Path, str], subject_id: str, session_id: str):
-    subjects_df = pd.read_excel(experiment_design_file_path)
+def generate_session_description(
+    experiment_design_file_path: Optional[Union[Path, str]],
+    subject_id: str,
+    session_id: str,
+    subjects_df: Optional[pd.DataFrame] = None,
+):
+    # The experiment design table can be passed already loaded, to read the file once for many sessions
+    if subjects_df is None:
+        subjects_df = pd.read_excel(experiment_design_file_path)
     subject_df = subjects_df[subjects_df["Mouse"] == subject_id]
     shock_amplitude = subject_df["Amplitude"].to_numpy()[0]
     shock_amplitude = float(re.findall(r"[-+]?\d*\.\d+|\d+", shock_amplitude)[0])
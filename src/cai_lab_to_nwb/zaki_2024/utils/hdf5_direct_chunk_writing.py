@@ -0,0 +1,179 @@
+import itertools
+import os
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterator, Optional, Union
+
+import h5py
+import numpy as np
+from hdmf.backends.hdf5 import H5DataIO
+from hdmf.data_utils import GenericDataChunkIterator
+from neuroconv.tools.nwb_helpers import configure_backend, get_default_backend_configuration
+from pynwb import NWBHDF5IO, NWBFile
+
+from cai_lab_to_nwb.zaki_2024.utils.chunked_writing import (
+    DEFAULT_MIN_PARALLEL_DATASET_BYTES,
+    DeferredDataChunkIterator,
+    iterate_source_blocks,
+    pop_large_time_series_datasets,
+)
+
+# Level of the gzip filter of the datasets written with direct chunk writes, the h5py default used by neuroconv
+DEFAULT_COMPRESSION_LEVEL = 4
+
+
+def iterate_chunk_selections(selection: tuple[slice, ...], chunk_shape: tuple) -> Iterator[tuple[slice, ...]]:
+    """Yield the selections of the chunks of a chunk-aligned selection, in row-major chunk order."""
+    chunk_starts = [range(axis.start, axis.stop, step) for axis, step in zip(selection, chunk_shape)]
+    for starts in itertools.product(*chunk_starts):
+        yield tuple(
+            slice(start, min(start + step, axis.stop)) for start, step, axis in zip(starts, chunk_shape, selection)
+        )
+
+
+def compress_chunk(data: np.ndarray, chunk_shape: tuple, compression_level: int = DEFAULT_COMPRESSION_LEVEL) -> bytes:
+    """
+    Encode a chunk as stored by the HDF5 gzip filter.
+
+    HDF5 stores the chunks at the edges of a dataset with their full shape, so smaller chunks are padded with zeros.
+
+    Parameters:
+    -----------
+    data : np.ndarray
+        The data of the chunk, with the dtype of the dataset.
+    chunk_shape : tuple
+        The chunk shape of the dataset.
+    compression_level : int, optional
+        The level of the gzip filter of the dataset, from 0 to 9.
+
+    Returns:
+    --------
+    bytes
+        The compressed chunk.
+    """
+    if data.shape != tuple(chunk_shape):
+        padded_data = np.zeros(chunk_shape, dtype=data.dtype)
+        padded_data[tuple(slice(0, length) for length in data.shape)] = data
+        data = padded_data
+    return zlib.compress(np.ascontiguousarray(data), compression_level)
+
+
+def write_direct_chunks(
+    dataset: h5py.Dataset,
+    source: Union[np.ndarray, GenericDataChunkIterator],
+    buffer_shape: tuple,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Write a dataset source into an HDF5 dataset, compressing its chunks from a thread pool.
+
+    The source is read one buffer at a time in the calling thread, and the chunks of each buffer are compressed
+    concurrently, since zlib releases the GIL. The compressed chunks are committed with HDF5 direct chunk writes
+    from the calling thread, in the order in which they are read, so HDF5 is never called from two threads and the
+    chunks are laid out in the file as with a serial write. At most two chunks per thread are in flight.
+
+    Parameters:
+    -----------
+    dataset : h5py.Dataset
+        The dataset to fill, with the shape of the source, chunked and with the gzip filter only.
+    source : Union[np.ndarray, GenericDataChunkIterator]
+        The data of the dataset. The buffers of an iterator must be aligned with the chunks of the dataset.
+    buffer_shape : tuple
+        Shape of the blocks in which an array source is read, a multiple of the chunk shape.
+    compression_level : int, optional
+        The level of the gzip filter of the dataset.
+    max_workers : int, optional
+        Number of threads compressing chunks. Defaults to the number of CPUs.
+    """
+    # The stored chunks are decoded by the filters of the dataset, so they must be exactly the ones encoded here
+    if dataset.compression != "gzip" or dataset.shuffle or dataset.fletcher32 or dataset.scaleoffset is not None:
+        raise ValueError(f"Direct chunk writes of '{dataset.name}' require a dataset with the gzip filter only")
+
+    max_workers = max_workers or os.cpu_count() or 1
+    pending_chunks = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for selection, data in iterate_source_blocks(source=source, buffer_shape=buffer_shape):
+            data = np.asarray(data, dtype=dataset.dtype)
+            for chunk_selection in iterate_chunk_selections(selection=selection, chunk_shape=dataset.chunks):
+                local_selection = tuple(
+                    slice(axis.start - block_axis.start, axis.stop - block_axis.start)
+                    for axis, block_axis in zip(chunk_selection, selection)
+                )
+                future = executor.submit(compress_chunk, data[local_selection], dataset.chunks, compression_level)
+                pending_chunks.append((tuple(axis.start for axis in chunk_selection), future))
+                while len(pending_chunks) > 2 * max_workers:
+                    chunk_offset, future = pending_chunks.popleft()
+                    dataset.id.write_direct_chunk(chunk_offset, future.result())
+        while pending_chunks:
+            chunk_offset, future = pending_chunks.popleft()
+            dataset.id.write_direct_chunk(chunk_offset, future.result())
+
+
+def write_nwbfile_with_direct_chunks(
+    nwbfile: NWBFile,
+    nwbfile_path: Union[str, Path],
+    max_workers: Optional[int] = None,
+    compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+    min_parallel_dataset_bytes: float = DEFAULT_MIN_PARALLEL_DATASET_BYTES,
+) -> list[str]:
+    """
+    Write an NWB file with the HDF5 backend, compressing the chunks of its large TimeSeries from a thread pool.
+
+    The datasets use the default HDF5 backend configuration of neuroconv. h5py compresses the chunks of a dataset
+    in the writing thread, which bounds the write of the imaging frames to one core, so the large TimeSeries data
+    (e.g. the imaging frames and EEG/EMG signals) are created empty with the gzip filter while the file is written,
+    and then filled with `write_direct_chunks`. The file is read with the standard gzip filter of HDF5.
+
+    Parameters:
+    -----------
+    nwbfile : NWBFile
+        The in-memory NWB file.
+    nwbfile_path : Union[str, Path]
+        Path of the NWB file, overwritten if it exists.
+    max_workers : int, optional
+        Number of threads compressing chunks. Defaults to the number of CPUs.
+    compression_level : int, optional
+        The level of the gzip filter of the datasets written with direct chunk writes.
+    min_parallel_dataset_bytes : float, optional
+        Size from which a dataset is written with direct chunk writes, in bytes.
+
+    Returns:
+    --------
+    list of str
+        Locations in the file of the datasets written with direct chunk writes.
+    """
+    backend_configuration = get_default_backend_configuration(nwbfile=nwbfile, backend="hdf5")
+    deferred_datasets = pop_large_time_series_datasets(
+        nwbfile=nwbfile, backend_configuration=backend_configuration, min_dataset_bytes=min_parallel_dataset_bytes
+    )
+    for dataset_configuration, _ in deferred_datasets:
+        deferred_iterator = DeferredDataChunkIterator(
+            dtype=dataset_configuration.dtype,
+            shape=dataset_configuration.full_shape,
+            chunk_shape=dataset_configuration.chunk_shape,
+        )
+        neurodata_object = nwbfile.objects[dataset_configuration.object_id]
+        neurodata_object.fields[dataset_configuration.dataset_name] = H5DataIO(
+            data=deferred_iterator,
+            chunks=dataset_configuration.chunk_shape,
+            compression="gzip",
+            compression_opts=compression_level,
+        )
+
+    configure_backend(nwbfile=nwbfile, backend_configuration=backend_configuration)
+    with NWBHDF5IO(str(nwbfile_path), mode="w") as io:
+        io.write(nwbfile)
+
+    with h5py.File(nwbfile_path, mode="r+") as file:
+        for dataset_configuration, source in deferred_datasets:
+            write_direct_chunks(
+                dataset=file[dataset_configuration.location_in_file],
+                source=source,
+                buffer_shape=dataset_configuration.buffer_shape,
+                compression_level=compression_level,
+                max_workers=max_workers,
+            )
+    return [dataset_configuration.location_in_file for dataset_configuration, _ in deferred_datasets]
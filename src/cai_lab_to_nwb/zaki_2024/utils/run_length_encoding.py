@@ -0,0 +1,35 @@
+import numpy as np
+
+
+def run_length_encode(values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Split a 1D array into runs of consecutive equal values.
+
+    Parameters:
+    -----------
+    values : np.ndarray
+        1D array of categorical codes (e.g. from `pd.factorize`) or a thresholded boolean array.
+
+    Returns:
+    --------
+    Tuple[np.ndarray, np.ndarray, np.ndarray]
+        The index of the first element of each run, the index one past the last element of each run and the value of
+        each run. Runs touching the beginning or the end of the array are included, so the runs always cover the
+        whole array.
+
+    Examples:
+    ---------
+    >>> run_length_encode(np.array([0, 0, 1, 1, 1, 0]))
+    (array([0, 2, 5]), array([2, 5, 6]), array([0, 1, 0]))
+    """
+    values = np.asarray(values)
+    assert values.ndim == 1, "Run length encoding is only defined for 1D arrays"
+    if values.size == 0:
+        empty_indices = np.array([], dtype=np.int64)
+        return empty_indices, empty_indices, values[:0]
+
+    change_indices = np.flatnonzero(values[1:] != values[:-1]) + 1
+    start_indices = np.concatenate(([0], change_indices))
+    stop_indices = np.concatenate((change_indices, [values.size]))
+
+    return start_indices, stop_indices, values[start_indices]
@@ -0,0 +1,272 @@
+import heapq
+import json
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+# Approximate conversion throughput of each input, in bytes per second of a single worker. They only need to be right
+# relative to each other to order the sessions, and are used as-is to predict the makespan.
+DEFAULT_THROUGHPUTS = dict(
+    avi=40e6,  # Miniscope and behavioral videos, decoded frame by frame
+    zarr=80e6,  # Minian segmentation and motion correction stores
+    edf=10e6,  # EDF files are decoded entirely, then sliced sample by sample to the session window
+)
+# Time spent on every session regardless of its size (imports, metadata, file creation), in seconds
+DEFAULT_SESSION_OVERHEAD = 10.0
+
+# Memory used by every session regardless of its size (interpreter, imported packages, NWB objects), in bytes
+DEFAULT_SESSION_BASELINE_MEMORY = 0.5e9
+# Size of the buffer used to stream the Miniscope frames into the NWB file, the default of the neuroconv iterators
+DEFAULT_IMAGING_BUFFER_GB = 1.0
+# Buffers of Miniscope frames decoded ahead of the buffer being written, the default of `session_to_nwb`
+DEFAULT_IMAGING_PREFETCH_BLOCKS = 1
+# Bytes held in memory by the EDF interface per sample of each channel: the float64 decoded data and its float32
+# copy for the 4 channels, the relative times and the datetime object of each sample used to slice the window
+EDF_BYTES_PER_SAMPLE = 4 * (8 + 4) + 8 + 64
+# Bytes held in memory by the multi-file EDF interface per sample of each channel over the week: the float32 data
+# of the 4 channels, copied again on every concatenation, and the relative time of each sample kept as a Python float
+MULTI_EDF_BYTES_PER_SAMPLE = 2 * 4 * 4 + 24 + 8
+# Bytes per sample of the EDF file being decoded on top of them: its float64 data, float32 copy and relative times
+MULTI_EDF_DECODING_BYTES_PER_SAMPLE = 4 * (8 + 4) + 8
+# Minian arrays loaded in memory by the segmentation extractor
+MINIAN_IN_MEMORY_FIELDS = ["A", "C", "S", "b", "b0", "f", "max_proj"]
+# The ROI image masks are transposed and copied into the plane segmentation
+MINIAN_MEMORY_FACTOR = 2.0
+
+
+def _get_folder_size(folder_path: Path, suffix: Optional[str] = None) -> int:
+    """Return the total size in bytes of the files under a folder, optionally only those with the given suffix."""
+    total_size = 0
+    for dir_path, _, file_names in os.walk(folder_path):
+        for file_name in file_names:
+            if suffix is None or file_name.lower().endswith(suffix):
+                total_size += os.stat(os.path.join(dir_path, file_name)).st_size
+    return total_size
+
+
+def _get_path_size(path: Optional[Union[str, Path]], suffix: Optional[str] = None) -> int:
+    if path is None:
+        return 0
+    path = Path(path)
+    if path.is_file():
+        return path.stat().st_size
+    if path.is_dir():
+        return _get_folder_size(path, suffix=suffix)
+    return 0
+
+
+def get_session_input_sizes(session_to_nwb_kwargs: dict) -> dict:
+    """
+    Return the size in bytes of the inputs of a session that dominate its conversion time.
+
+    Parameters:
+    -----------
+    session_to_nwb_kwargs : dict
+        The arguments of `session_to_nwb`.
+
+    Returns:
+    --------
+    dict
+        Bytes of AVI videos (Miniscope segments and behavioral video), Minian zarr stores and EDF file.
+    """
+    avi_bytes = _get_path_size(session_to_nwb_kwargs.get("imaging_folder_path"), suffix=".avi")
+    avi_bytes += _get_path_size(session_to_nwb_kwargs.get("video_file_path"))
+    zarr_bytes = _get_path_size(session_to_nwb_kwargs.get("minian_folder_path"))
+    edf_bytes = _get_path_size(session_to_nwb_kwargs.get("edf_file_path"))
+    return dict(avi=avi_bytes, zarr=zarr_bytes, edf=edf_bytes)
+
+
+def estimate_session_cost(
+    session_to_nwb_kwargs: dict,
+    throughputs: Optional[dict] = None,
+    session_overhead: float = DEFAULT_SESSION_OVERHEAD,
+) -> float:
+    """
+    Estimate the conversion time of a session from the size of its inputs.
+
+    Parameters:
+    -----------
+    session_to_nwb_kwargs : dict
+        The arguments of `session_to_nwb`.
+    throughputs : dict, optional
+        Bytes per second converted by one worker for each input kind ("avi", "zarr" and "edf"). Defaults to
+        `DEFAULT_THROUGHPUTS`.
+    session_overhead : float, optional
+        Fixed time spent on every session, in seconds.
+
+    Returns:
+    --------
+    float
+        Estimated conversion time in seconds.
+    """
+    throughputs = dict(DEFAULT_THROUGHPUTS, **(throughputs or dict()))
+    input_sizes = get_session_input_sizes(session_to_nwb_kwargs)
+    return session_overhead + sum(input_sizes[kind] / throughputs[kind] for kind in input_sizes)
+
+
+def _read_edf_num_samples(file_path: Union[str, Path]) -> int:
+    """Return the number of samples per channel of an EDF file, reading only its header."""
+    file_path = Path(file_path)
+    with open(file_path, "rb") as file:
+        header = file.read(256)
+        header_num_bytes = int(header[184:192])
+        num_records = int(header[236:244])
+        num_signals = int(header[252:256])
+        # The number of samples per record of each signal follows the label, transducer, physical dimension,
+        # physical and digital ranges and prefiltering fields of every signal
+        file.seek(256 + num_signals * (16 + 80 + 8 + 8 + 8 + 8 + 8 + 80))
+        samples_per_record = [int(file.read(8)) for _ in range(num_signals)]
+    if num_records < 0:
+        # The number of records is unknown while recording, it is deduced from the size of the 2-byte samples
+        num_records = (file_path.stat().st_size - header_num_bytes) // (2 * sum(samples_per_record))
+    return num_records * max(samples_per_record)
+
+
+def _get_zarr_array_num_bytes(zarr_array_path: Path) -> int:
+    """Return the uncompressed size of a zarr v2 array from its metadata."""
+    zarray_file_path = zarr_array_path / ".zarray"
+    if not zarray_file_path.is_file():
+        return 0
+    zarray = json.loads(zarray_file_path.read_text())
+    num_elements = 1
+    for dimension in zarray["shape"]:
+        num_elements *= dimension
+    # The dtype is a numpy type string such as "<f8" or "<M8[ns]", or a list of [name, dtype(, shape)] fields for
+    # structured arrays, which numpy expects as tuples
+    dtype = zarray["dtype"]
+    if isinstance(dtype, list):
+        dtype = [tuple(field) for field in dtype]
+    try:
+        item_size = np.dtype(dtype).itemsize
+    except (TypeError, ValueError):
+        # An overestimate only delays the session, an unknown dtype must not stop the scheduler
+        item_size = 8
+    return num_elements * item_size
+
+
+def estimate_session_peak_memory(
+    session_to_nwb_kwargs: dict,
+    baseline_memory: float = DEFAULT_SESSION_BASELINE_MEMORY,
+) -> float:
+    """
+    Estimate the peak memory of a session conversion from the headers and metadata of its inputs.
+
+    The Miniscope frames are streamed through a buffer of `imaging_iterator_options["buffer_gb"]` (given in the
+    arguments of the session, 1 GB by default) and `imaging_prefetch_blocks` more buffers decoded ahead of it, the
+    Minian arrays and the EDF channels are loaded whole. The behavioral video is linked externally and does not count.
+
+    Parameters:
+    -----------
+    session_to_nwb_kwargs : dict
+        The arguments of `session_to_nwb`.
+    baseline_memory : float, optional
+        Memory used by every session regardless of its inputs, in bytes.
+
+    Returns:
+    --------
+    float
+        Estimated peak memory in bytes.
+    """
+    peak_memory = baseline_memory
+
+    if session_to_nwb_kwargs.get("imaging_folder_path") is not None:
+        imaging_iterator_options = session_to_nwb_kwargs.get("imaging_iterator_options") or dict()
+        num_buffers = 1 + session_to_nwb_kwargs.get("imaging_prefetch_blocks", DEFAULT_IMAGING_PREFETCH_BLOCKS)
+        peak_memory += num_buffers * imaging_iterator_options.get("buffer_gb", DEFAULT_IMAGING_BUFFER_GB) * 1e9
+
+    minian_folder_path = session_to_nwb_kwargs.get("minian_folder_path")
+    if minian_folder_path is not None:
+        minian_num_bytes = sum(
+            _get_zarr_array_num_bytes(Path(minian_folder_path) / f"{field}.zarr" / field)
+            for field in MINIAN_IN_MEMORY_FIELDS
+        )
+        peak_memory += MINIAN_MEMORY_FACTOR * minian_num_bytes
+
+    edf_file_path = session_to_nwb_kwargs.get("edf_file_path")
+    if edf_file_path is not None and Path(edf_file_path).is_file():
+        peak_memory += EDF_BYTES_PER_SAMPLE * _read_edf_num_samples(edf_file_path)
+
+    return peak_memory
+
+
+def estimate_week_session_cost(
+    edf_file_paths: list[Union[str, Path]],
+    throughputs: Optional[dict] = None,
+    session_overhead: float = DEFAULT_SESSION_OVERHEAD,
+) -> float:
+    """
+    Estimate the conversion time of the week-long session of a subject from the size of its EDF files.
+
+    Parameters:
+    -----------
+    edf_file_paths : list of Union[str, Path]
+        The EDF files recorded during the week.
+    throughputs : dict, optional
+        See `estimate_session_cost`, only the "edf" throughput is used.
+    session_overhead : float, optional
+        Fixed time spent on every session, in seconds.
+
+    Returns:
+    --------
+    float
+        Estimated conversion time in seconds.
+    """
+    throughputs = dict(DEFAULT_THROUGHPUTS, **(throughputs or dict()))
+    edf_bytes = sum(_get_path_size(edf_file_path) for edf_file_path in edf_file_paths)
+    return session_overhead + edf_bytes / throughputs["edf"]
+
+
+def estimate_week_session_peak_memory(
+    edf_file_paths: list[Union[str, Path]],
+    baseline_memory: float = DEFAULT_SESSION_BASELINE_MEMORY,
+) -> float:
+    """
+    Estimate the peak memory of the conversion of a week-long session from the headers of its EDF files.
+
+    The channels of all the EDF files are concatenated in memory, and the peak is reached while the last files are
+    decoded on top of them. The cell registration tables are small and do not count.
+
+    Parameters:
+    -----------
+    edf_file_paths : list of Union[str, Path]
+        The EDF files recorded during the week.
+    baseline_memory : float, optional
+        Memory used by every session regardless of its inputs, in bytes.
+
+    Returns:
+    --------
+    float
+        Estimated peak memory in bytes.
+    """
+    num_samples_per_file = [
+        _read_edf_num_samples(edf_file_path) for edf_file_path in edf_file_paths if Path(edf_file_path).is_file()
+    ]
+    if not num_samples_per_file:
+        return baseline_memory
+    peak_memory = baseline_memory + MULTI_EDF_BYTES_PER_SAMPLE * sum(num_samples_per_file)
+    return peak_memory + MULTI_EDF_DECODING_BYTES_PER_SAMPLE * max(num_samples_per_file)
+
+
+def predict_makespan(costs: list[float], max_workers: int) -> float:
+    """
+    Simulate a pool of workers taking the jobs in the given order and return the time at which the last one ends.
+
+    Parameters:
+    -----------
+    costs : list of float
+        Cost of each job in submission order.
+    max_workers : int
+        Number of workers of the pool.
+
+    Returns:
+    --------
+    float
+        The predicted makespan, in the units of the costs.
+    """
+    worker_end_times = [0.0] * max(1, max_workers)
+    for cost in costs:
+        # Each job goes to the worker that becomes free first
+        heapq.heappush(worker_end_times, heapq.heappop(worker_end_times) + cost)
+    return max(worker_end_times)
@@ -1,11 +1,23 @@
-from typing import Union
+from typing import Optional, Union
 from pathlib import Path
 import pandas as pd
 from datetime import datetime
 import warnings
 
+from cai_lab_to_nwb.zaki_2024.utils.dataset_catalog import DatasetCatalog
 
-def get_session_times_df(subject_id: str, data_dir_path: Union[str, Path], session_ids: list = ()) -> pd.DataFrame:
+
+def _is_file(path: Path, catalog: Optional[DatasetCatalog]) -> bool:
+    return catalog.is_file(path) if catalog is not None else path.is_file()
+
+
+def _is_dir(path: Path, catalog: Optional[DatasetCatalog]) -> bool:
+    return catalog.is_dir(path) if catalog is not None else path.is_dir()
+
+
+def get_session_times_df(
+    subject_id: str, data_dir_path: Union[str, Path], session_ids: list = (), catalog: Optional[DatasetCatalog] = None
+) -> pd.DataFrame:
     """
     Retrieve a DataFrame containing session times for a given subject.
 
@@ -17,6 +29,8 @@ def get_session_times_df(subject_id: str, data_dir_path: Union[str, Path], sessi
         Path to the base data directory.
     session_ids : list, optional
         List of session types to filter. Defaults to an empty list.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -31,7 +45,7 @@ def get_session_times_df(subject_id: str, data_dir_path: Union[str, Path], sessi
 
     if "Ca_EEG3-" in subject_id:
         session_times_file_path = data_dir_path / "Ca_EEG_Experiment" / subject_id / f"{subject_id}_SessionTimes.csv"
-        assert session_times_file_path.is_file(), f"{session_times_file_path} does not exist"
+        assert _is_file(session_times_file_path, catalog), f"{session_times_file_path} does not exist"
         session_times_df = pd.read_csv(session_times_file_path)
         if session_ids:
             session_times_df = session_times_df[session_times_df["Session"].isin(session_ids)]
@@ -39,7 +53,7 @@ def get_session_times_df(subject_id: str, data_dir_path: Union[str, Path], sessi
 
     elif "Ca_EEG2-" in subject_id:
         session_times_file_path = data_dir_path / "Ca_EEG_Experiment" / subject_id / "Session_Timestamps.csv"
-        assert session_times_file_path.is_file(), f"{session_times_file_path} does not exist"
+        assert _is_file(session_times_file_path, catalog), f"{session_times_file_path} does not exist"
         session_times_df_original = pd.read_csv(session_times_file_path, header=None)
         session_names = session_times_df_original.iloc[0, 1:].tolist()  # Exclude first column
         session_times = session_times_df_original.iloc[1, 1:].tolist()  # Exclude first column
@@ -56,7 +70,9 @@ def get_session_times_df(subject_id: str, data_dir_path: Union[str, Path], sessi
         print(f"Invalid subject_id: {subject_id}")
 
 
-def get_experiment_dir_path(subject_id: str, session_id: str, data_dir_path: Union[str, Path]) -> Path:
+def get_experiment_dir_path(
+    subject_id: str, session_id: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
+) -> Path:
     """
     Construct the path to the experiment directory for a given subject and session.
 
@@ -68,6 +84,8 @@ def get_experiment_dir_path(subject_id: str, session_id: str, data_dir_path: Uni
         The ID of the session.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -89,11 +107,13 @@ def get_experiment_dir_path(subject_id: str, session_id: str, data_dir_path: Uni
         experiment_dir_path = (
             data_dir_path / "Ca_EEG_Experiment" / subject_id / f"{subject_id}_Sessions" / f"{subject_id}_{session_id}"
         )
-    assert experiment_dir_path.is_dir(), f"{experiment_dir_path} does not exist"
+    assert _is_dir(experiment_dir_path, catalog), f"{experiment_dir_path} does not exist"
     return experiment_dir_path
 
 
-def get_date_str_from_experiment_dir_path(experiment_dir_path: Union[str, Path]) -> Union[str, None]:
+def get_date_str_from_experiment_dir_path(
+    experiment_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
+) -> Union[str, None]:
     """
     Extract the date string from the name of the subdirectory in the experiment directory.
     This is meant to work only for offline sessions
@@ -102,6 +122,8 @@ def get_date_str_from_experiment_dir_path(experiment_dir_path: Union[str, Path])
     -----------
     experiment_dir_path : Union[str, Path]
         Path to the experiment directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -109,17 +131,23 @@ def get_date_str_from_experiment_dir_path(experiment_dir_path: Union[str, Path])
         The date string in the format "YYYY_MM_DD", or None if not found.
     """
 
-    for subdirectory in experiment_dir_path.iterdir():
-        if subdirectory.is_dir():
-            folder_name = subdirectory.name
-            try:
-                datetime.strptime(folder_name, "%Y_%m_%d")
-                return folder_name
-            except ValueError:
-                print(f"The folder name '{folder_name}' is NOT in the correct date format: '%Y_%m_%d'.")
-
-
-def get_edf_file_path(subject_id: str, date_str: str, data_dir_path: Union[str, Path]) -> Union[Path, None]:
+    experiment_dir_path = Path(experiment_dir_path)
+    if catalog is not None:
+        subdirectories = catalog.get_subdirectories(experiment_dir_path)
+    else:
+        subdirectories = [subdirectory for subdirectory in experiment_dir_path.iterdir() if subdirectory.is_dir()]
+    for subdirectory in subdirectories:
+        folder_name = subdirectory.name
+        try:
+            datetime.strptime(folder_name, "%Y_%m_%d")
+            return folder_name
+        except ValueError:
+            print(f"The folder name '{folder_name}' is NOT in the correct date format: '%Y_%m_%d'.")
+
+
+def get_edf_file_path(
+    subject_id: str, date_str: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
+) -> Union[Path, None]:
     """
     Retrieve the path to the EDF file for a given subject and date.
 
@@ -131,6 +159,8 @@ def get_edf_file_path(subject_id: str, date_str: str, data_dir_path: Union[str,
         The date string in "YYYY_MM_DD" format.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -142,7 +172,7 @@ def get_edf_file_path(subject_id: str, date_str: str, data_dir_path: Union[str,
         datetime_obj = datetime.strptime(date_str, "%Y_%m_%d")
         reformatted_date_str = datetime_obj.strftime("%m%d%y")
         edf_file_path = data_dir_path / "Ca_EEG_EDF" / f"{subject_id}_EDF" / f"{subject_id}_{reformatted_date_str}.edf"
-        if not edf_file_path.is_file():
+        if not _is_file(edf_file_path, catalog):
             warnings.warn(f"{edf_file_path} not found.")
             return None
         return edf_file_path
@@ -151,7 +181,7 @@ def get_edf_file_path(subject_id: str, date_str: str, data_dir_path: Union[str,
 
 
 def get_sleep_classification_file_path(
-    subject_id: str, session_id: str, data_dir_path: Union[str, Path]
+    subject_id: str, session_id: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
 ) -> Union[Path, None]:
     """
     Retrieve the path to the sleep classification file for a given subject and session.
@@ -164,6 +194,8 @@ def get_sleep_classification_file_path(
         The ID of the session.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -173,13 +205,15 @@ def get_sleep_classification_file_path(
     sleep_classification_file_path = (
         data_dir_path / "Ca_EEG_Sleep" / subject_id / "AlignedSleep" / f"{subject_id}_{session_id}_AlignedSleep.csv"
     )
-    if not sleep_classification_file_path.is_file():
+    if not _is_file(sleep_classification_file_path, catalog):
         warnings.warn(f"{sleep_classification_file_path} not found.")
         return None
     return sleep_classification_file_path
 
 
-def get_video_file_path(subject_id: str, session_id: str, data_dir_path: Union[str, Path]) -> Union[Path, None]:
+def get_video_file_path(
+    subject_id: str, session_id: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
+) -> Union[Path, None]:
     """
     Retrieve the path to the behavioral video file for a given subject and session.
 
@@ -191,6 +225,8 @@ def get_video_file_path(subject_id: str, session_id: str, data_dir_path: Union[s
         The ID of the session.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -198,16 +234,16 @@ def get_video_file_path(subject_id: str, session_id: str, data_dir_path: Union[s
         Path to the video file, or None if not found.
     """
 
-    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path)
+    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path, catalog=catalog)
     video_file_path = Path(experiment_dir_path) / f"{subject_id}_{session_id}.wmv"
-    if not video_file_path.is_file():
+    if not _is_file(video_file_path, catalog):
         warnings.warn(f"{video_file_path} not found.")
         return None
     return video_file_path
 
 
 def get_freezing_output_file_path(
-    subject_id: str, session_id: str, data_dir_path: Union[str, Path]
+    subject_id: str, session_id: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
 ) -> Union[Path, None]:
     """
     Retrieve the path to the freezing output file for a given subject and session.
@@ -220,6 +256,8 @@ def get_freezing_output_file_path(
         The ID of the session.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -227,16 +265,21 @@ def get_freezing_output_file_path(
         Path to the freezing output file, or None if not found.
     """
 
-    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path)
+    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path, catalog=catalog)
     freezing_output_file_path = Path(experiment_dir_path) / f"{subject_id}_{session_id}_FreezingOutput.csv"
-    if not freezing_output_file_path.is_file():
+    if not _is_file(freezing_output_file_path, catalog):
         warnings.warn(f"{freezing_output_file_path} not found.")
         return None
     return freezing_output_file_path
 
 
 def get_imaging_folder_path(
-    subject_id: str, session_id: str, data_dir_path: Union[str, Path], time_str: str, date_str: str
+    subject_id: str,
+    session_id: str,
+    data_dir_path: Union[str, Path],
+    time_str: str,
+    date_str: str,
+    catalog: Optional[DatasetCatalog] = None,
 ) -> Union[Path, None]:
     """
     Retrieve the path to the imaging folder for a given session.
@@ -253,6 +296,8 @@ def get_imaging_folder_path(
         The session start time.
     date_str : str
         The session date.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -260,18 +305,20 @@ def get_imaging_folder_path(
         Path to the imaging folder, or None if not found.
     """
 
-    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path)
+    experiment_dir_path = get_experiment_dir_path(subject_id, session_id, data_dir_path, catalog=catalog)
     try:
         imaging_folder_path = Path(experiment_dir_path) / date_str / time_str
     except:
         imaging_folder_path = Path(experiment_dir_path) / time_str
-    if not imaging_folder_path.is_dir():
+    if not _is_dir(imaging_folder_path, catalog):
         warnings.warn(f"{imaging_folder_path} not found.")
         return None
     return imaging_folder_path
 
 
-def get_miniscope_folder_path(subject_id: str, session_id: str, data_dir_path: Union[str, Path]) -> Union[Path, None]:
+def get_miniscope_folder_path(
+    subject_id: str, session_id: str, data_dir_path: Union[str, Path], catalog: Optional[DatasetCatalog] = None
+) -> Union[Path, None]:
     """
     Retrieve the path to the miniscope folder for a given subject and session.
 
@@ -283,6 +330,8 @@ def get_miniscope_folder_path(subject_id: str, session_id: str, data_dir_path: U
         The ID of the session.
     data_dir_path : Union[str, Path]
         Path to the base data directory.
+    catalog : DatasetCatalog, optional
+        Catalog of the data directory queried instead of the filesystem.
 
     Returns:
     --------
@@ -291,7 +340,7 @@ def get_miniscope_folder_path(subject_id: str, session_id: str, data_dir_path: U
     """
 
     minian_folder_path = data_dir_path / "Ca_EEG_Calcium" / subject_id / f"{subject_id}_{session_id}" / "minian"
-    if not minian_folder_path.is_dir():
+    if not _is_dir(minian_folder_path, catalog):
         warnings.warn(f"{minian_folder_path} not found.")
         return None
     return minian_folder_path
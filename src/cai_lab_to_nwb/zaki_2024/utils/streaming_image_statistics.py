@@ -0,0 +1,171 @@
+import threading
+from typing import Optional
+
+import numpy as np
+
+# Offsets of the neighbors of a pixel, one per pair of neighbors, whose correlations make the local correlation image
+_NEIGHBOR_OFFSETS = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+
+class StreamingImageStatistics:
+    """
+    Summary images and per-frame statistics of a video, accumulated from its frames read in consecutive blocks.
+
+    The statistics are accumulated while the frames are read for another purpose, e.g. while they are written to the
+    NWB file, so they cost no extra decoding. Each frame is counted once and in order: the frames of a block that
+    were already counted are skipped, and a block starting after the next frame to count is kept until the frames
+    before it are counted. Blocks may therefore arrive out of order, e.g. from the threads decoding them ahead of
+    the writer, at the cost of holding the blocks that arrived early.
+
+    The statistics are:
+        - the mean image and the maximum projection,
+        - the local correlation image: the mean correlation over time of each pixel with its 8 neighbors,
+        - the mean and standard deviation of the intensity and the number of saturated pixels of each frame.
+
+    Examples:
+    ---------
+    >>> statistics = StreamingImageStatistics(num_frames=1000, frame_shape=(600, 600), saturation_value=255)
+    >>> for start_frame in range(0, 1000, 100):
+    >>>     statistics.update(start_frame=start_frame, frames=video[start_frame : start_frame + 100])
+    >>> correlation_image = statistics.get_correlation_image()
+    """
+
+    def __init__(
+        self,
+        num_frames: int,
+        frame_shape: tuple[int, int],
+        saturation_value: Optional[float] = None,
+        frames_per_update: int = 64,
+    ):
+        """
+        Parameters:
+        -----------
+        num_frames : int
+            Number of frames of the video, frames read past it are ignored.
+        frame_shape : Tuple[int, int]
+            Shape of the frames, (height, width).
+        saturation_value : float, optional
+            Intensity from which a pixel is saturated. Defaults to the maximum of the dtype of the frames for integer
+            frames, and no pixel is saturated for float frames.
+        frames_per_update : int, optional
+            Number of frames converted to float at once, bounding the temporary memory of an update.
+        """
+        self.num_frames = num_frames
+        self.frame_shape = tuple(frame_shape)
+        self.saturation_value = saturation_value
+        self.frames_per_update = frames_per_update
+        self.num_counted_frames = 0
+        self._lock = threading.Lock()
+        # Blocks starting after the next frame to count, keyed by their start frame
+        self._pending_blocks = dict()
+
+        self._sum = np.zeros(self.frame_shape, dtype="float64")
+        self._sum_of_squares = np.zeros(self.frame_shape, dtype="float64")
+        self._max_projection = None
+        self._sums_of_neighbor_products = [
+            np.zeros(_get_neighbor_shape(self.frame_shape, offset), dtype="float64") for offset in _NEIGHBOR_OFFSETS
+        ]
+        self._frame_means = np.zeros(num_frames, dtype="float64")
+        self._frame_stds = np.zeros(num_frames, dtype="float64")
+        self._frame_num_saturated_pixels = np.zeros(num_frames, dtype="uint32")
+
+    @property
+    def is_complete(self) -> bool:
+        return self.num_counted_frames == self.num_frames
+
+    def update(self, start_frame: int, frames: np.ndarray) -> None:
+        """Count the frames of a block starting at `start_frame` that were not counted yet."""
+        with self._lock:
+            if start_frame > self.num_counted_frames:
+                if start_frame < self.num_frames:
+                    self._pending_blocks[start_frame] = frames
+                return
+            self._count_block(start_frame=start_frame, frames=frames)
+            while self._pending_blocks:
+                next_start_frame = min(self._pending_blocks)
+                if next_start_frame > self.num_counted_frames:
+                    break
+                self._count_block(start_frame=next_start_frame, frames=self._pending_blocks.pop(next_start_frame))
+
+    def _count_block(self, start_frame: int, frames: np.ndarray) -> None:
+        end_frame = min(start_frame + len(frames), self.num_frames)
+        if end_frame <= self.num_counted_frames:
+            return
+        frames = frames[self.num_counted_frames - start_frame : end_frame - start_frame]
+        for offset in range(0, len(frames), self.frames_per_update):
+            self._update_block(frames[offset : offset + self.frames_per_update])
+
+    def _update_block(self, frames: np.ndarray) -> None:
+        frame_indices = slice(self.num_counted_frames, self.num_counted_frames + len(frames))
+        saturation_value = self.saturation_value
+        if saturation_value is None and np.issubdtype(frames.dtype, np.integer):
+            saturation_value = np.iinfo(frames.dtype).max
+        if saturation_value is not None:
+            self._frame_num_saturated_pixels[frame_indices] = np.count_nonzero(frames >= saturation_value, axis=(1, 2))
+
+        block_max_projection = frames.max(axis=0)
+        if self._max_projection is None:
+            self._max_projection = block_max_projection
+        else:
+            np.maximum(self._max_projection, block_max_projection, out=self._max_projection)
+
+        frames = frames.astype("float32")
+        self._frame_means[frame_indices] = frames.mean(axis=(1, 2), dtype="float64")
+        self._frame_stds[frame_indices] = frames.std(axis=(1, 2), dtype="float64")
+        self._sum += frames.sum(axis=0, dtype="float64")
+        self._sum_of_squares += np.square(frames).sum(axis=0, dtype="float64")
+        for offset, sum_of_neighbor_products in zip(_NEIGHBOR_OFFSETS, self._sums_of_neighbor_products):
+            pixels, neighbors = _get_neighbor_selections(self.frame_shape, offset)
+            sum_of_neighbor_products += (frames[(slice(None),) + pixels] * frames[(slice(None),) + neighbors]).sum(
+                axis=0, dtype="float64"
+            )
+        self.num_counted_frames += len(frames)
+
+    def _check_complete(self) -> None:
+        if not self.is_complete:
+            raise ValueError(f"Only {self.num_counted_frames} of the {self.num_frames} frames were counted")
+
+    def get_mean_image(self) -> np.ndarray:
+        self._check_complete()
+        return self._sum / self.num_frames
+
+    def get_max_projection(self) -> np.ndarray:
+        self._check_complete()
+        return self._max_projection
+
+    def get_correlation_image(self) -> np.ndarray:
+        """Return the mean correlation of each pixel with its 8 neighbors, 0 for the pixels that never change."""
+        self._check_complete()
+        mean_image = self._sum / self.num_frames
+        std_image = np.sqrt(np.maximum(self._sum_of_squares / self.num_frames - mean_image**2, 0.0))
+
+        sum_of_correlations = np.zeros(self.frame_shape, dtype="float64")
+        num_neighbors = np.zeros(self.frame_shape, dtype="float64")
+        for offset, sum_of_neighbor_products in zip(_NEIGHBOR_OFFSETS, self._sums_of_neighbor_products):
+            pixels, neighbors = _get_neighbor_selections(self.frame_shape, offset)
+            covariance = sum_of_neighbor_products / self.num_frames - mean_image[pixels] * mean_image[neighbors]
+            std_product = std_image[pixels] * std_image[neighbors]
+            correlation = np.divide(covariance, std_product, out=np.zeros_like(covariance), where=std_product > 0)
+            # The correlation of a pair of neighbors counts for both of them
+            for selection in (pixels, neighbors):
+                sum_of_correlations[selection] += correlation
+                num_neighbors[selection] += 1
+        return sum_of_correlations / num_neighbors
+
+    def get_frame_statistics(self) -> dict:
+        """Return the mean and standard deviation of the intensity and the number of saturated pixels of each frame."""
+        self._check_complete()
+        return dict(mean=self._frame_means, std=self._frame_stds, num_saturated_pixels=self._frame_num_saturated_pixels)
+
+
+def _get_neighbor_shape(frame_shape: tuple[int, int], offset: tuple[int, int]) -> tuple[int, int]:
+    return frame_shape[0] - abs(offset[0]), frame_shape[1] - abs(offset[1])
+
+
+def _get_neighbor_selections(frame_shape: tuple[int, int], offset: tuple[int, int]) -> tuple:
+    """Return the selections of the pixels that have a neighbor at `offset`, and of these neighbors."""
+    pixels, neighbors = [], []
+    for length, axis_offset in zip(frame_shape, offset):
+        pixels.append(slice(max(0, -axis_offset), length - max(0, axis_offset)))
+        neighbors.append(slice(max(0, axis_offset), length - max(0, -axis_offset)))
+    return tuple(pixels), tuple(neighbors)
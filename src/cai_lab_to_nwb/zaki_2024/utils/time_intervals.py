@@ -0,0 +1,185 @@
+from typing import Optional
+
+import numpy as np
+from pynwb import TimeSeries
+from pynwb.base import TimeSeriesReference, TimeSeriesReferenceVectorData
+from pynwb.epoch import TimeIntervals
+from hdmf.common.table import VectorData, VectorIndex
+
+
+def get_time_series_index_ranges(
+    start_times: np.ndarray, stop_times: np.ndarray, time_series: TimeSeries
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Compute the index range of a TimeSeries covered by each interval.
+
+    This is the vectorized equivalent of the per-row computation done by `TimeIntervals.add_interval` when a
+    TimeSeries is passed in the `timeseries` argument.
+
+    Parameters:
+    -----------
+    start_times : np.ndarray
+        Start time of each interval in seconds.
+    stop_times : np.ndarray
+        Stop time of each interval in seconds.
+    time_series : TimeSeries
+        The TimeSeries referenced by the intervals, defined either by starting_time and rate or by timestamps.
+
+    Returns:
+    --------
+    Tuple[np.ndarray, np.ndarray]
+        The index of the first sample and the number of samples of the TimeSeries in each interval.
+    """
+    if time_series.starting_time is not None and time_series.rate:
+        start_indices = ((start_times - time_series.starting_time) * time_series.rate).astype(np.int64)
+        stop_indices = ((stop_times - time_series.starting_time) * time_series.rate).astype(np.int64)
+    elif time_series.timestamps is not None and len(time_series.timestamps) > 0:
+        timestamps = np.asarray(time_series.timestamps)
+        start_indices = np.searchsorted(timestamps, start_times, side="left")
+        stop_indices = np.searchsorted(timestamps, stop_times, side="left")
+    else:
+        raise ValueError("TimeSeries object must have timestamps or starting_time and rate")
+
+    return start_indices, stop_indices - start_indices
+
+
+def build_time_intervals(
+    name: str,
+    description: str,
+    start_times: np.ndarray,
+    stop_times: np.ndarray,
+    columns: Optional[dict] = None,
+    timeseries: Optional[list[TimeSeries]] = None,
+) -> TimeIntervals:
+    """
+    Build a TimeIntervals table from whole columns instead of adding the intervals one row at a time.
+
+    Parameters:
+    -----------
+    name : str
+        Name of the TimeIntervals table.
+    description : str
+        Description of the TimeIntervals table.
+    start_times : np.ndarray
+        Start time of each interval in seconds.
+    stop_times : np.ndarray
+        Stop time of each interval in seconds.
+    columns : dict, optional
+        Additional columns of the table, mapping the column name to a tuple with the column description and the
+        column data (one value per interval).
+    timeseries : list of TimeSeries, optional
+        TimeSeries referenced by every interval. The index range covered by each interval is computed for each
+        TimeSeries, as `TimeIntervals.add_interval` does.
+
+    Returns:
+    --------
+    TimeIntervals
+        The table with all the columns built at once.
+    """
+    start_times = np.asarray(start_times, dtype=np.float64)
+    stop_times = np.asarray(stop_times, dtype=np.float64)
+    assert start_times.shape == stop_times.shape, "start_times and stop_times must have the same length"
+    num_intervals = len(start_times)
+
+    column_descriptions = {column["name"]: column["description"] for column in TimeIntervals.__columns__}
+    table_columns = [
+        VectorData(name="start_time", description=column_descriptions["start_time"], data=start_times),
+        VectorData(name="stop_time", description=column_descriptions["stop_time"], data=stop_times),
+    ]
+
+    for column_name, (column_description, column_data) in (columns or dict()).items():
+        column_data = np.asarray(column_data)
+        assert len(column_data) == num_intervals, f"Column '{column_name}' must have one value per interval"
+        # Text columns are passed as lists of str, which is what the HDF5 and Zarr backends expect
+        if column_data.dtype.kind in ("U", "S", "O"):
+            column_data = column_data.astype(str).tolist()
+        table_columns.append(VectorData(name=column_name, description=column_description, data=column_data))
+
+    if timeseries and num_intervals > 0:
+        index_ranges = [get_time_series_index_ranges(start_times, stop_times, ts) for ts in timeseries]
+        references = [
+            TimeSeriesReference(int(start_indices[row]), int(counts[row]), ts)
+            for row in range(num_intervals)
+            for ts, (start_indices, counts) in zip(timeseries, index_ranges)
+        ]
+        timeseries_column = TimeSeriesReferenceVectorData(
+            name="timeseries", description=column_descriptions["timeseries"], data=references
+        )
+        timeseries_index = VectorIndex(
+            name="timeseries_index",
+            target=timeseries_column,
+            data=np.arange(1, num_intervals + 1, dtype=np.int64) * len(timeseries),
+        )
+        table_columns.extend([timeseries_column, timeseries_index])
+
+    return TimeIntervals(name=name, description=description, id=np.arange(num_intervals), columns=table_columns)
+
+
+def benchmark_build_time_intervals(num_intervals: int = 20_000, repeat: int = 3) -> dict:
+    """
+    Compare `build_time_intervals` against filling the same TimeIntervals with an `add_interval` loop.
+
+    Parameters:
+    -----------
+    num_intervals : int, optional
+        Number of intervals in the synthetic table. Defaults to 20 000, the order of magnitude of the state
+        transitions in a long sleep recording.
+    repeat : int, optional
+        Number of repetitions, the best time is reported. Defaults to 3.
+
+    Returns:
+    --------
+    dict
+        Best time in seconds of each method and the speedup of the columnar builder.
+    """
+    import time
+
+    rng = np.random.default_rng(seed=0)
+    durations = rng.uniform(1.0, 10.0, size=num_intervals)
+    start_times = np.cumsum(durations + rng.uniform(0.1, 1.0, size=num_intervals))
+    stop_times = start_times + durations
+    labels = rng.choice(["quiet wake", "rem", "sws", "wake"], size=num_intervals)
+    motion_series = TimeSeries(
+        name="MotionSeries", data=np.zeros(int(stop_times[-1] * 30.0) + 1), unit="n.a", rate=30.0
+    )
+
+    def add_interval_loop():
+        time_intervals = TimeIntervals(name="Intervals", description="Benchmark intervals")
+        time_intervals.add_column(name="state", description="State label")
+        for start_time, stop_time, label in zip(start_times, stop_times, labels):
+            time_intervals.add_interval(
+                start_time=start_time, stop_time=stop_time, state=label, timeseries=[motion_series]
+            )
+        return time_intervals
+
+    def columnar_builder():
+        return build_time_intervals(
+            name="Intervals",
+            description="Benchmark intervals",
+            start_times=start_times,
+            stop_times=stop_times,
+            columns=dict(state=("State label", labels)),
+            timeseries=[motion_series],
+        )
+
+    best_times = dict()
+    for method_name, method in dict(add_interval_loop=add_interval_loop, columnar_builder=columnar_builder).items():
+        elapsed_times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            method()
+            elapsed_times.append(time.perf_counter() - start)
+        best_times[method_name] = min(elapsed_times)
+
+    best_times["speedup"] = best_times["add_interval_loop"] / best_times["columnar_builder"]
+    return best_times
+
+
+if __name__ == "__main__":
+
+    num_intervals = 20_000
+    results = benchmark_build_time_intervals(num_intervals=num_intervals)
+    print(f"TimeIntervals with {num_intervals} rows:")
+    print(f"  add_interval loop: {results['add_interval_loop']:.3f} seconds")
+    print(f"  columnar builder:  {results['columnar_builder']:.3f} seconds")
+    print(f"  speedup: {results['speedup']:.1f}x")
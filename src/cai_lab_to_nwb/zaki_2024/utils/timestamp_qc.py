@@ -0,0 +1,127 @@
+from typing import Optional
+
+import numpy as np
+
+# Intervals longer than this factor times the nominal frame interval are gaps where frames were dropped
+DEFAULT_GAP_FACTOR = 1.5
+# Shortest interval between the frames of two recording bouts, much longer than the gaps of dropped frames
+DEFAULT_MIN_BOUT_GAP = 60.0
+# Description of each field of the summary returned by `analyze_frame_timestamps`
+FRAME_TIMESTAMPS_QC_DESCRIPTIONS = dict(
+    num_frames="The number of frames of the video files.",
+    num_timestamps="The number of timestamps of the timestamps file.",
+    num_duplicate_timestamps="The number of timestamps equal to the previous one.",
+    num_non_increasing_timestamps="The number of timestamps smaller than the previous one.",
+    num_bouts="The number of recording bouts, separated by intervals longer than the minimum bout gap.",
+    num_gaps="The number of frame intervals longer than the gap factor times the nominal frame interval, within bouts.",
+    max_gap="The longest frame interval of the gaps, in seconds.",
+    num_dropped_frames="The number of frames missing in the gaps, estimated from the nominal frame interval.",
+    nominal_interval="The frame interval expected from the frame rate of the acquisition, in seconds.",
+    median_interval="The median frame interval, in seconds.",
+    interval_std="The standard deviation of the frame intervals outside of the gaps, in seconds.",
+    max_interval_deviation="The largest deviation from the nominal interval outside of the gaps, in seconds.",
+)
+
+
+def analyze_frame_timestamps(
+    timestamps: np.ndarray,
+    num_frames: int,
+    nominal_rate: Optional[float] = None,
+    gap_factor: float = DEFAULT_GAP_FACTOR,
+    min_bout_gap: Optional[float] = DEFAULT_MIN_BOUT_GAP,
+) -> dict:
+    """
+    Check the timestamps of a video against its number of frames and the regularity of the frame intervals.
+
+    The analysis only uses the timestamps and the frame count from the headers of the video, so no frame is decoded.
+
+    Parameters:
+    -----------
+    timestamps : np.ndarray
+        The timestamp of each frame, in seconds.
+    num_frames : int
+        The number of frames of the video.
+    nominal_rate : float, optional
+        The frame rate of the acquisition, in Hz. Defaults to the inverse of the median frame interval.
+    gap_factor : float, optional
+        Intervals longer than `gap_factor` times the nominal frame interval count as gaps.
+    min_bout_gap : float, optional
+        Intervals longer than this, in seconds, separate recording bouts (see `segment_recording_bouts`) and are not
+        gaps of dropped frames. With None, the frames are a single bout.
+
+    Returns:
+    --------
+    dict
+        The QC summary, with the fields described in `FRAME_TIMESTAMPS_QC_DESCRIPTIONS`.
+    """
+    timestamps = np.asarray(timestamps, dtype="float64")
+    intervals = np.diff(timestamps)
+    positive_intervals = intervals[intervals > 0]
+    median_interval = float(np.median(positive_intervals)) if len(positive_intervals) else np.nan
+    nominal_interval = 1.0 / nominal_rate if nominal_rate else median_interval
+
+    is_bout_gap = intervals > min_bout_gap if min_bout_gap is not None else np.zeros(len(intervals), dtype=bool)
+    is_gap = (intervals > gap_factor * nominal_interval) & ~is_bout_gap
+    gap_intervals = intervals[is_gap]
+    regular_intervals = intervals[(intervals > 0) & ~is_gap & ~is_bout_gap]
+    return dict(
+        num_frames=int(num_frames),
+        num_timestamps=len(timestamps),
+        num_duplicate_timestamps=int(np.count_nonzero(intervals == 0)),
+        num_non_increasing_timestamps=int(np.count_nonzero(intervals < 0)),
+        num_bouts=int(np.count_nonzero(is_bout_gap)) + 1,
+        num_gaps=len(gap_intervals),
+        max_gap=float(gap_intervals.max()) if len(gap_intervals) else 0.0,
+        num_dropped_frames=int(np.sum(np.round(gap_intervals / nominal_interval) - 1)) if len(gap_intervals) else 0,
+        nominal_interval=nominal_interval,
+        median_interval=median_interval,
+        interval_std=float(regular_intervals.std()) if len(regular_intervals) else np.nan,
+        max_interval_deviation=(
+            float(np.abs(regular_intervals - nominal_interval).max()) if len(regular_intervals) else np.nan
+        ),
+    )
+
+
+def describe_frame_timestamps_issues(frame_timestamps_qc: dict) -> list[str]:
+    """Return a description of each issue found by `analyze_frame_timestamps`, empty if the timestamps are clean."""
+    issues = []
+    if frame_timestamps_qc["num_frames"] != frame_timestamps_qc["num_timestamps"]:
+        issues.append(
+            f"{frame_timestamps_qc['num_frames']} frames for {frame_timestamps_qc['num_timestamps']} timestamps"
+        )
+    if frame_timestamps_qc["num_duplicate_timestamps"]:
+        issues.append(f"{frame_timestamps_qc['num_duplicate_timestamps']} duplicate timestamps")
+    if frame_timestamps_qc["num_non_increasing_timestamps"]:
+        issues.append(f"{frame_timestamps_qc['num_non_increasing_timestamps']} timestamps going back in time")
+    if frame_timestamps_qc["num_gaps"]:
+        issues.append(
+            f"{frame_timestamps_qc['num_gaps']} gaps of up to {frame_timestamps_qc['max_gap']:.3f} s, about "
+            f"{frame_timestamps_qc['num_dropped_frames']} dropped frames"
+        )
+    return issues
+
+
+def segment_recording_bouts(
+    timestamps: np.ndarray, min_gap: float = DEFAULT_MIN_BOUT_GAP
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Split frames acquired in separate recording bouts, e.g. the TTL-gated bouts of the offline sessions, at the gaps
+    between their timestamps.
+
+    Parameters:
+    -----------
+    timestamps : np.ndarray
+        The timestamp of each frame, in seconds.
+    min_gap : float, optional
+        The shortest interval between two frames that separates two bouts, in seconds. It must be longer than the
+        gaps of dropped frames within a bout.
+
+    Returns:
+    --------
+    Tuple[np.ndarray, np.ndarray]
+        The index of the first frame (inclusive) and of the last frame (exclusive) of each bout.
+    """
+    bout_ends = np.flatnonzero(np.diff(timestamps) > min_gap) + 1
+    start_frames = np.concatenate([[0], bout_ends]).astype("int64")
+    stop_frames = np.concatenate([bout_ends, [len(timestamps)]]).astype("int64")
+    return start_frames, stop_frames
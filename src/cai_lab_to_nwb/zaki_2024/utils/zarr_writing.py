@@ -0,0 +1,128 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+import zarr
+from hdmf.data_utils import GenericDataChunkIterator
+from hdmf_zarr import NWBZarrIO, ZarrDataIO
+from neuroconv.tools.nwb_helpers import configure_backend, get_default_backend_configuration
+from pynwb import NWBFile
+
+from cai_lab_to_nwb.zaki_2024.utils.chunked_writing import (
+    DEFAULT_MIN_PARALLEL_DATASET_BYTES,
+    DeferredDataChunkIterator,
+    iterate_source_blocks,
+    pop_large_time_series_datasets,
+)
+
+
+def split_selection_by_chunks(selection: tuple[slice, ...], chunk_shape: tuple) -> list[tuple[slice, ...]]:
+    """Split a chunk-aligned selection along its first axis, in slabs one chunk thick."""
+    first_axis = selection[0]
+    return [
+        (slice(start, min(start + chunk_shape[0], first_axis.stop)),) + tuple(selection[1:])
+        for start in range(first_axis.start, first_axis.stop, chunk_shape[0])
+    ]
+
+
+def fill_zarr_array(
+    zarr_array: zarr.Array,
+    source: Union[np.ndarray, GenericDataChunkIterator],
+    buffer_shape: tuple,
+    max_workers: Optional[int] = None,
+) -> None:
+    """
+    Write a dataset source into a Zarr array, compressing and storing its chunks from a thread pool.
+
+    The source is read one buffer at a time in the calling thread, and each buffer is split in slabs of whole
+    chunks written concurrently, so that the next buffer is read while the previous one is being written. The
+    compressors release the GIL, so the chunks are compressed in parallel, and each chunk is written by a single
+    thread, so no chunk is read back and modified. At most two buffers are held in memory.
+
+    Parameters:
+    -----------
+    zarr_array : zarr.Array
+        The array to fill, with the shape of the source.
+    source : Union[np.ndarray, GenericDataChunkIterator]
+        The data of the array. The buffers of an iterator must be aligned with the chunks of the array.
+    buffer_shape : tuple
+        Shape of the blocks in which an array source is read, a multiple of the chunk shape.
+    max_workers : int, optional
+        Number of threads writing chunks. Defaults to the number of CPUs.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        previous_futures = []
+        for selection, data in iterate_source_blocks(source=source, buffer_shape=buffer_shape):
+            futures = []
+            for slab_selection in split_selection_by_chunks(selection=selection, chunk_shape=zarr_array.chunks):
+                offset = slab_selection[0].start - selection[0].start
+                slab_data = data[offset : offset + slab_selection[0].stop - slab_selection[0].start]
+                futures.append(executor.submit(zarr_array.__setitem__, slab_selection, slab_data))
+            # Bound the memory to two buffers: the one being written and the one just read
+            for future in wait(previous_futures).done:
+                future.result()
+            previous_futures = futures
+        for future in wait(previous_futures).done:
+            future.result()
+
+
+def write_nwbfile_to_zarr(
+    nwbfile: NWBFile,
+    nwbfile_path: Union[str, Path],
+    max_workers: Optional[int] = None,
+    min_parallel_dataset_bytes: float = DEFAULT_MIN_PARALLEL_DATASET_BYTES,
+) -> list[str]:
+    """
+    Write an NWB file with the Zarr backend, writing the chunks of its large TimeSeries from a thread pool.
+
+    The datasets use the default Zarr backend configuration of neuroconv. hdmf-zarr writes every dataset one chunk
+    after the other from a single thread, so the large TimeSeries data (e.g. the imaging frames and EEG/EMG
+    signals) are created empty while the file is written, and then filled with `fill_zarr_array`.
+
+    Parameters:
+    -----------
+    nwbfile : NWBFile
+        The in-memory NWB file.
+    nwbfile_path : Union[str, Path]
+        Path of the Zarr store of the NWB file, overwritten if it exists.
+    max_workers : int, optional
+        Number of threads writing chunks. Defaults to the number of CPUs.
+    min_parallel_dataset_bytes : float, optional
+        Size from which a dataset is written from the thread pool, in bytes.
+
+    Returns:
+    --------
+    list of str
+        Locations in the file of the datasets written from the thread pool.
+    """
+    backend_configuration = get_default_backend_configuration(nwbfile=nwbfile, backend="zarr")
+    deferred_datasets = pop_large_time_series_datasets(
+        nwbfile=nwbfile, backend_configuration=backend_configuration, min_dataset_bytes=min_parallel_dataset_bytes
+    )
+    for dataset_configuration, _ in deferred_datasets:
+        deferred_iterator = DeferredDataChunkIterator(
+            dtype=dataset_configuration.dtype,
+            shape=dataset_configuration.full_shape,
+            chunk_shape=dataset_configuration.chunk_shape,
+        )
+        neurodata_object = nwbfile.objects[dataset_configuration.object_id]
+        neurodata_object.fields[dataset_configuration.dataset_name] = ZarrDataIO(
+            data=deferred_iterator, **dataset_configuration.get_data_io_kwargs()
+        )
+
+    configure_backend(nwbfile=nwbfile, backend_configuration=backend_configuration)
+    with NWBZarrIO(str(nwbfile_path), mode="w") as io:
+        io.write(nwbfile)
+
+    root = zarr.open_group(str(nwbfile_path), mode="r+")
+    for dataset_configuration, source in deferred_datasets:
+        fill_zarr_array(
+            zarr_array=root[dataset_configuration.location_in_file],
+            source=source,
+            buffer_shape=dataset_configuration.buffer_shape,
+            max_workers=max_workers,
+        )
+    return [dataset_configuration.location_in_file for dataset_configuration, _ in deferred_datasets]
@@ -0,0 +1,147 @@
+"""Benchmark of the write throughput and output size of the HDF5 and Zarr write paths on a synthetic session."""
+
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+import h5py
+import numpy as np
+from neuroconv.tools.hdmf import SliceableDataChunkIterator
+from neuroconv.tools.nwb_helpers import configure_and_write_nwbfile
+from pynwb import NWBFile, TimeSeries
+from pynwb.testing.mock.file import mock_NWBFile
+
+from cai_lab_to_nwb.zaki_2024.utils.zarr_writing import write_nwbfile_to_zarr
+from cai_lab_to_nwb.zaki_2024.utils.hdf5_direct_chunk_writing import write_nwbfile_with_direct_chunks
+
+
+def make_synthetic_session_data(
+    num_frames: int = 3000,
+    frame_shape: tuple[int, int] = (600, 600),
+    num_edf_samples: int = 10_000_000,
+    seed: int = 0,
+) -> dict:
+    """Return Miniscope-like frames and EEG/EMG-like signals with the compressibility of real recordings.
+
+    The frames are a static background with slowly varying spots plus shot noise, the signals are a random walk
+    plus noise, so that the compressors do neither all nor none of the work.
+    """
+    random_number_generator = np.random.default_rng(seed)
+    rows, columns = np.mgrid[0 : frame_shape[0], 0 : frame_shape[1]]
+    background = 64 + 32 * np.sin(rows / 50.0) * np.cos(columns / 70.0)
+    frames = np.empty((num_frames, *frame_shape), dtype="uint8")
+    for frame_index in range(num_frames):
+        spots = 40 * np.sin(frame_index / 30.0 + rows / 15.0) * np.sin(columns / 15.0)
+        noise = random_number_generator.poisson(4, size=frame_shape)
+        frames[frame_index] = np.clip(background + spots + noise, 0, 255)
+
+    signals = dict()
+    for channel_name in ["Temp", "EEG", "EMG", "Activity"]:
+        random_walk = np.cumsum(random_number_generator.normal(size=num_edf_samples), dtype="float64")
+        noise = random_number_generator.normal(scale=0.1, size=num_edf_samples)
+        signals[channel_name] = (1e-6 * (random_walk + noise)).astype("float32")
+    return dict(frames=frames, signals=signals)
+
+
+def make_synthetic_nwbfile(session_data: dict) -> NWBFile:
+    """Build an in-memory NWB file with the synthetic imaging and EEG/EMG data, as written by the interfaces."""
+    nwbfile = mock_NWBFile()
+    nwbfile.add_acquisition(
+        TimeSeries(
+            name="OnePhotonSeries",
+            data=SliceableDataChunkIterator(data=session_data["frames"]),
+            unit="n.a.",
+            rate=30.0,
+        )
+    )
+    for channel_name, signal in session_data["signals"].items():
+        nwbfile.add_acquisition(TimeSeries(name=f"{channel_name}Signal", data=signal, unit="volts", rate=2000.0))
+    return nwbfile
+
+
+def _get_size(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(
+        os.stat(os.path.join(dir_path, file_name)).st_size
+        for dir_path, _, file_names in os.walk(path)
+        for file_name in file_names
+    )
+
+
+def benchmark_write_backends(
+    output_dir_path: Optional[Union[str, Path]] = None,
+    max_workers_options: tuple = (1, None),
+    **session_data_kwargs,
+) -> list[dict]:
+    """Write the same synthetic session with the default HDF5 write, the HDF5 direct chunk write and the Zarr backend.
+
+    The frames written with direct chunk writes are read back through the standard gzip filter of h5py and
+    compared with the source frames.
+
+    Parameters
+    ----------
+    output_dir_path : Union[str, Path], optional
+        Folder where the files are written, on the storage to benchmark. Defaults to a temporary folder.
+    max_workers_options : tuple, optional
+        Numbers of threads compressing the HDF5 direct chunks and writing the Zarr chunks to benchmark, None for the
+        number of CPUs.
+    session_data_kwargs
+        Size of the synthetic session, see `make_synthetic_session_data`.
+
+    Returns
+    -------
+    list of dict
+        The write path ("hdf5", "hdf5-direct" or "zarr"), number of threads, write time in seconds, throughput in
+        MB/s of uncompressed data and output size in bytes of every run.
+    """
+    session_data = make_synthetic_session_data(**session_data_kwargs)
+    num_bytes = session_data["frames"].nbytes + sum(signal.nbytes for signal in session_data["signals"].values())
+
+    temporary_dir_path = Path(tempfile.mkdtemp(dir=output_dir_path))
+    runs = [("hdf5", 1)]
+    runs += [("hdf5-direct", max_workers) for max_workers in max_workers_options]
+    runs += [("zarr", max_workers) for max_workers in max_workers_options]
+    results = []
+    try:
+        for backend, max_workers in runs:
+            nwbfile = make_synthetic_nwbfile(session_data)
+            nwbfile_path = temporary_dir_path / f"session_{backend}_{max_workers}.nwb"
+            start_time = time.perf_counter()
+            if backend == "zarr":
+                write_nwbfile_to_zarr(nwbfile=nwbfile, nwbfile_path=nwbfile_path, max_workers=max_workers)
+            elif backend == "hdf5-direct":
+                write_nwbfile_with_direct_chunks(nwbfile=nwbfile, nwbfile_path=nwbfile_path, max_workers=max_workers)
+            else:
+                configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
+            write_time = time.perf_counter() - start_time
+            if backend == "hdf5-direct":
+                with h5py.File(nwbfile_path, mode="r") as file:
+                    frames = file["acquisition/OnePhotonSeries/data"][:]
+                assert np.array_equal(frames, session_data["frames"]), "The direct chunks do not decode to the frames"
+            results.append(
+                dict(
+                    backend=backend,
+                    max_workers=max_workers or os.cpu_count(),
+                    write_time_seconds=write_time,
+                    throughput_mb_per_second=num_bytes / 1e6 / write_time,
+                    output_size_bytes=_get_size(nwbfile_path),
+                )
+            )
+    finally:
+        shutil.rmtree(temporary_dir_path, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+
+    results = benchmark_write_backends()
+    print(f"{'write path':>12} {'threads':>8} {'time (s)':>10} {'MB/s':>8} {'size (MB)':>10}")
+    for result in results:
+        print(
+            f"{result['backend']:>12} {result['max_workers']:>8} {result['write_time_seconds']:>10.1f} "
+            f"{result['throughput_mb_per_second']:>8.1f} {result['output_size_bytes'] / 1e6:>10.1f}"
+        )
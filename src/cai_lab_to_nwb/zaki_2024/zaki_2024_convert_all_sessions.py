@@ -1,15 +1,29 @@
 """Primary script to run to convert all sessions in a dataset using session_to_nwb."""
 
+import time
 from pathlib import Path
-from typing import Union
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Callable, Optional, Union
+from concurrent.futures import Future, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from pprint import pformat
 import traceback
 from tqdm import tqdm
 
 from neuroconv.utils import load_dict_from_file
 
-from cai_lab_to_nwb.zaki_2024.zaki_2024_convert_session import session_to_nwb
+from cai_lab_to_nwb.zaki_2024.zaki_2024_convert_session import session_to_nwb, get_nwbfile_path
+from cai_lab_to_nwb.zaki_2024.utils.conversion_manifest import (
+    build_conversion_manifest,
+    get_manifest_file_path,
+    is_conversion_up_to_date,
+    write_conversion_manifest,
+)
+from cai_lab_to_nwb.zaki_2024.utils.conversion_journal import ConversionJournal
+from cai_lab_to_nwb.zaki_2024.utils.session_scheduling import (
+    estimate_session_cost,
+    predict_makespan,
+    estimate_session_peak_memory,
+)
 
 
 def dataset_to_nwb(
@@ -19,6 +33,12 @@ def dataset_to_nwb(
     max_workers: int = 1,
     verbose: bool = True,
     stub_test: bool = False,
+    incremental: bool = False,
+    throughputs: Optional[dict] = None,
+    memory_budget_gb: Optional[float] = None,
+    imaging_iterator_options: Optional[dict] = None,
+    resume: bool = False,
+    max_retries: int = 1,
 ):
     """Convert the entire dataset to NWB.
 
@@ -32,6 +52,35 @@ def dataset_to_nwb(
         The number of workers to use for parallel processing, by default 1
     verbose : bool, optional
         Whether to print verbose output, by default True
+    stub_test : bool, optional
+        Whether to convert only a stub of each session, by default False
+    incremental : bool, optional
+        Whether to skip the sessions whose NWB file was converted from the same inputs, by default False.
+        A manifest with a fingerprint of the input files, the conversion parameters, the package versions and the
+        source code of the conversion is stored next to every NWB file converted successfully. In incremental mode,
+        sessions whose current fingerprint matches the stored one are skipped and the stale ones are converted again,
+        overwriting their NWB file.
+    throughputs : dict, optional
+        Bytes per second converted by one worker for each input kind ("avi", "zarr" and "edf"), used to estimate
+        the cost of each session. Sessions are submitted from the most to the least expensive, and the predicted
+        makespan is printed next to the actual one when `verbose` is True, to tune `max_workers` and the
+        throughputs themselves. Defaults to `utils.session_scheduling.DEFAULT_THROUGHPUTS`.
+    memory_budget_gb : float, optional
+        Memory available to the conversions running at the same time, in GB. The peak memory of each session is
+        estimated from its inputs and `imaging_iterator_options`, and the sessions are started in longest-job-first
+        order, each once the estimates of the running sessions leave room for it. A session larger than the whole
+        budget runs alone. By default, `max_workers` sessions always run.
+    imaging_iterator_options : dict, optional
+        Options of the iterator streaming the Miniscope frames of every session, e.g. `buffer_gb`. See
+        `session_to_nwb`.
+    resume : bool, optional
+        Whether to skip the sessions that the journal of a previous run records as done, by default False.
+        Every status change of every session (pending, running, done or failed, with the attempt number, duration
+        and error file) is appended to `conversion_journal.jsonl` in `output_dir_path`. Sessions that a previous run
+        left running or failed are converted again, overwriting their NWB file.
+    max_retries : int, optional
+        Number of times a failed session is submitted again in the same run, by default 1. Each failed attempt
+        writes its traceback to its own `ERROR_<nwbfile stem>_attempt<attempt>.txt` file in `data_dir_path`.
     """
     data_dir_path = Path(data_dir_path)
     output_dir_path = Path(output_dir_path)
@@ -39,41 +88,300 @@ def dataset_to_nwb(
         data_dir_path=data_dir_path,
     )
 
-    futures = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        for session_to_nwb_kwargs in session_to_nwb_kwargs_per_session:
-            session_to_nwb_kwargs["output_dir_path"] = output_dir_path
-            session_to_nwb_kwargs["verbose"] = verbose
-            session_to_nwb_kwargs["stub_test"] = stub_test
-            exception_file_path = data_dir_path / f"ERROR_<nwbfile_name>.txt"  # Add error file path here
-            futures.append(
-                executor.submit(
-                    safe_session_to_nwb,
-                    session_to_nwb_kwargs=session_to_nwb_kwargs,
-                    exception_file_path=exception_file_path,
-                )
+    jobs = []
+    for session_to_nwb_kwargs in session_to_nwb_kwargs_per_session:
+        session_to_nwb_kwargs["output_dir_path"] = output_dir_path
+        session_to_nwb_kwargs["verbose"] = verbose
+        session_to_nwb_kwargs["stub_test"] = stub_test
+        if imaging_iterator_options is not None:
+            session_to_nwb_kwargs["imaging_iterator_options"] = imaging_iterator_options
+        nwbfile_path = get_nwbfile_path(
+            output_dir_path=output_dir_path,
+            subject_id=session_to_nwb_kwargs["subject_id"],
+            session_id=session_to_nwb_kwargs["session_id"],
+            stub_test=stub_test,
+            backend=session_to_nwb_kwargs.get("backend", "hdf5"),
+        )
+        jobs.append(
+            dict(
+                kwargs=session_to_nwb_kwargs,
+                key=nwbfile_path.relative_to(output_dir_path).as_posix(),
+                nwbfile_path=nwbfile_path,
+                input_paths=None,
+                convert_function=session_to_nwb,
             )
-        for _ in tqdm(as_completed(futures), total=len(futures)):
-            pass
+        )
+
+    journal = ConversionJournal(output_dir_path / "conversion_journal.jsonl")
+    jobs_to_convert = select_jobs_to_convert(
+        jobs=jobs, latest_records=journal.get_latest_records() if resume else dict(), incremental=incremental
+    )
+    if verbose and (incremental or resume):
+        print(
+            f"Skipping {len(jobs) - len(jobs_to_convert)} finished sessions, converting {len(jobs_to_convert)} sessions"
+        )
+
+    for job in jobs_to_convert:
+        job["cost"] = estimate_session_cost(job["kwargs"], throughputs=throughputs)
+        job["peak_memory"] = estimate_session_peak_memory(job["kwargs"]) if memory_budget_gb is not None else 0.0
+    run_conversion_jobs(
+        jobs=jobs_to_convert,
+        data_dir_path=data_dir_path,
+        journal=journal,
+        max_workers=max_workers,
+        memory_budget_gb=memory_budget_gb,
+        max_retries=max_retries,
+        verbose=verbose,
+    )
 
 
-def safe_session_to_nwb(*, session_to_nwb_kwargs: dict, exception_file_path: Union[Path, str]):
+def select_jobs_to_convert(*, jobs: list[dict], latest_records: dict, incremental: bool) -> list[dict]:
+    """Return the conversion jobs that are not finished yet.
+
+    A job is finished when the journal records it as done, or in incremental mode when its NWB file was converted from
+    the current inputs. Jobs whose NWB file may be stale or partial are set to overwrite it.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        The conversion jobs, see `run_conversion_jobs`.
+    latest_records : dict
+        The last journal record of each job, keyed by job key. Empty when not resuming a previous run.
+    incremental : bool
+        Whether to skip the jobs whose NWB file is up to date with their manifest.
+
+    Returns
+    -------
+    list of dict
+        The jobs to convert, in the given order.
+    """
+    jobs_to_convert = []
+    for job in jobs:
+        latest_status = latest_records.get(job["key"], dict()).get("status")
+        if latest_status == "done":
+            continue
+        if incremental:
+            manifest = build_conversion_manifest(job["kwargs"], input_paths=job["input_paths"])
+            if is_conversion_up_to_date(job["nwbfile_path"], manifest):
+                continue
+            job["kwargs"]["overwrite"] = True
+        if latest_status in ("running", "failed"):
+            # A previous run stopped in the middle of this job and may have left a partial file behind
+            job["kwargs"]["overwrite"] = True
+        jobs_to_convert.append(job)
+    return jobs_to_convert
+
+
+def run_conversion_jobs(
+    *,
+    jobs: list[dict],
+    data_dir_path: Path,
+    journal: ConversionJournal,
+    max_workers: int = 1,
+    memory_budget_gb: Optional[float] = None,
+    max_retries: int = 1,
+    verbose: bool = True,
+) -> dict:
+    """Run conversion jobs in a process pool, recording every status change in the journal.
+
+    Jobs are submitted from the most to the least expensive, so that no long job is left running alone at the end of
+    the batch. A job that does not fit in the memory left by the running jobs waits for them to finish, and the jobs
+    after it wait as well, so that it is not starved by smaller jobs. A job larger than the whole budget runs alone.
+    Failed jobs are submitted again with `overwrite=True` until they reach `max_retries` retries, and each failed
+    attempt writes its traceback to its own `ERROR_<nwbfile stem>_attempt<attempt>.txt` file in `data_dir_path`.
+    A worker process that dies, e.g. killed by the OOM killer, breaks the process pool: the jobs that did not finish
+    before it broke are recorded as failed attempts, and the next jobs are submitted to a new pool.
+
+    Parameters
+    ----------
+    jobs : list of dict
+        The conversion jobs, each with the arguments of the conversion function (`kwargs`), the key of the job in
+        the journal (`key`), the path of its NWB file (`nwbfile_path`), the inputs of its manifest (`input_paths`,
+        None for the arguments ending in `_path`), the conversion function (`convert_function`), its estimated
+        duration in seconds (`cost`) and its estimated peak memory in bytes (`peak_memory`).
+    data_dir_path : Path
+        The directory where the error files are written.
+    journal : ConversionJournal
+        The journal of the batch.
+    max_workers : int, optional
+        The number of workers to use for parallel processing, by default 1
+    memory_budget_gb : float, optional
+        Memory available to the jobs running at the same time, in GB. By default, `max_workers` jobs always run.
+    max_retries : int, optional
+        Number of times a failed job is submitted again, by default 1.
+    verbose : bool, optional
+        Whether to print the predicted and actual makespan, by default True
+
+    Returns
+    -------
+    dict
+        The last status of each job ("done" or "failed"), its number of attempts and the duration of its last attempt
+        in seconds, keyed by job key.
+    """
+    jobs = sorted(jobs, key=lambda job: job["cost"], reverse=True)
+    if verbose:
+        predicted_makespan = predict_makespan([job["cost"] for job in jobs], max_workers=max_workers)
+        print(f"Predicted makespan with {max_workers} workers: {predicted_makespan / 60:.1f} minutes")
+
+    memory_budget = float("inf") if memory_budget_gb is None else memory_budget_gb * 1e9
+    pending_jobs = []
+    for job in jobs:
+        journal.record(job["key"], status="pending")
+        pending_jobs.append(dict(job, attempt=1))
+
+    results = dict()
+    start_time = time.perf_counter()
+    running_jobs = dict()  # Future -> job and the time it was submitted
+
+    def record_attempt(job: dict, submission_time: float, exception_file_path: Optional[Union[Path, str]]) -> None:
+        duration = time.perf_counter() - submission_time
+        if exception_file_path is None:
+            journal.record(job["key"], status="done", attempt=job["attempt"], duration_seconds=duration)
+            results[job["key"]] = dict(status="done", attempts=job["attempt"], duration_seconds=duration)
+            progress_bar.update(1)
+            return
+
+        will_retry = job["attempt"] <= max_retries
+        journal.record(
+            job["key"],
+            status="failed",
+            attempt=job["attempt"],
+            duration_seconds=duration,
+            error=str(exception_file_path),
+            will_retry=will_retry,
+        )
+        if will_retry:
+            # The failed attempt may have left a partial file behind
+            retry_kwargs = dict(job["kwargs"], overwrite=True)
+            pending_jobs.append(dict(job, kwargs=retry_kwargs, attempt=job["attempt"] + 1))
+        else:
+            results[job["key"]] = dict(status="failed", attempts=job["attempt"], duration_seconds=duration)
+            progress_bar.update(1)
+
+    def get_exception_file_path(future: Future) -> Optional[Union[Path, str]]:
+        try:
+            return future.result()
+        except Exception as exception:  # e.g. BrokenProcessPool, or the arguments of the job could not be pickled
+            return repr(exception)
+
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        with tqdm(total=len(pending_jobs)) as progress_bar:
+            while pending_jobs or running_jobs:
+                is_pool_broken = False
+                # Admit the pending jobs in longest-job-first order while they fit in the memory left
+                memory_in_use = sum(job["peak_memory"] for job, _ in running_jobs.values())
+                for job in list(pending_jobs):
+                    if len(running_jobs) >= max_workers:
+                        break
+                    # The next jobs wait for the memory of the first job that does not fit, so that smaller jobs
+                    # do not keep taking the memory it needs. A job larger than the whole budget is admitted alone,
+                    # otherwise it would never run
+                    if memory_in_use + job["peak_memory"] > memory_budget and running_jobs:
+                        break
+                    exception_file_path = (
+                        data_dir_path / f"ERROR_{job['nwbfile_path'].stem}_attempt{job['attempt']}.txt"
+                    )
+                    try:
+                        future = executor.submit(
+                            safe_session_to_nwb,
+                            session_to_nwb_kwargs=job["kwargs"],
+                            exception_file_path=exception_file_path,
+                            nwbfile_path=job["nwbfile_path"],
+                            input_paths=job["input_paths"],
+                            convert_function=job["convert_function"],
+                        )
+                    except BrokenProcessPool:
+                        # A worker died since the last jobs finished, the job stays pending for the next pool
+                        is_pool_broken = True
+                        break
+                    journal.record(job["key"], status="running", attempt=job["attempt"])
+                    running_jobs[future] = (job, time.perf_counter())
+                    memory_in_use += job["peak_memory"]
+                    pending_jobs.remove(job)
+
+                if not is_pool_broken:
+                    done_futures, _ = wait(running_jobs, return_when=FIRST_COMPLETED)
+                    for future in done_futures:
+                        job, submission_time = running_jobs.pop(future)
+                        exception_file_path = get_exception_file_path(future)
+                        is_pool_broken |= isinstance(future.exception(), BrokenProcessPool)
+                        record_attempt(job, submission_time, exception_file_path)
+
+                if is_pool_broken:
+                    # A worker process died, e.g. killed by the OOM killer, which breaks the whole pool: the jobs in
+                    # flight are lost with it, and the next jobs are submitted to a new pool. Jobs may also have
+                    # finished since the last wait, so the outcome of each one is read once the pool is shut down
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    for future, (job, submission_time) in list(running_jobs.items()):
+                        del running_jobs[future]
+                        if future.done():
+                            exception_file_path = get_exception_file_path(future)
+                        else:
+                            exception_file_path = "BrokenProcessPool: a worker process died during the job"
+                        record_attempt(job, submission_time, exception_file_path)
+                    executor = ProcessPoolExecutor(max_workers=max_workers)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    if verbose:
+        print(f"Actual makespan with {max_workers} workers: {(time.perf_counter() - start_time) / 60:.1f} minutes")
+    return results
+
+
+def safe_session_to_nwb(
+    *,
+    session_to_nwb_kwargs: dict,
+    exception_file_path: Union[Path, str],
+    nwbfile_path: Optional[Union[Path, str]] = None,
+    input_paths: Optional[list] = None,
+    convert_function: Callable = session_to_nwb,
+) -> Optional[Path]:
     """Convert a session to NWB while handling any errors by recording error messages to the exception_file_path.
 
+    The manifest of the inputs is stored next to the NWB file once the conversion succeeds, and removed before it
+    starts, so a failed conversion is never considered up to date.
+
     Parameters
     ----------
     session_to_nwb_kwargs : dict
         The arguments for session_to_nwb.
     exception_file_path : Path
         The path to the file where the exception messages will be saved.
+    nwbfile_path : Path, optional
+        The path of the NWB file written by the conversion. Defaults to the path of the session given by
+        `get_nwbfile_path`.
+    input_paths : list, optional
+        The inputs of the manifest, see `build_conversion_manifest`.
+    convert_function : Callable, optional
+        The conversion function called with `session_to_nwb_kwargs`, e.g. the `session_to_nwb` of the week-long
+        session. Defaults to `session_to_nwb`.
+
+    Returns
+    -------
+    Path or None
+        The path of the file with the exception messages if the conversion failed, None otherwise.
     """
     exception_file_path = Path(exception_file_path)
     try:
-        session_to_nwb(**session_to_nwb_kwargs)
+        if nwbfile_path is None:
+            nwbfile_path = get_nwbfile_path(
+                output_dir_path=session_to_nwb_kwargs["output_dir_path"],
+                subject_id=session_to_nwb_kwargs["subject_id"],
+                session_id=session_to_nwb_kwargs["session_id"],
+                stub_test=session_to_nwb_kwargs.get("stub_test", False),
+                backend=session_to_nwb_kwargs.get("backend", "hdf5"),
+            )
+        # The fingerprint is taken before converting, so inputs modified during the conversion are seen as stale
+        manifest = build_conversion_manifest(session_to_nwb_kwargs, input_paths=input_paths)
+        get_manifest_file_path(nwbfile_path).unlink(missing_ok=True)
+        convert_function(**session_to_nwb_kwargs)
+        write_conversion_manifest(nwbfile_path, manifest)
     except Exception as e:
         with open(exception_file_path, mode="w") as f:
             f.write(f"session_to_nwb_kwargs: \n {pformat(session_to_nwb_kwargs)}\n\n")
             f.write(traceback.format_exc())
+        return exception_file_path
+    return None
 
 
 def get_session_to_nwb_kwargs_per_session(
@@ -123,10 +431,12 @@ if __name__ == "__main__":
     max_workers = 1
     verbose = False
     stub_test = False
+    incremental = True
     dataset_to_nwb(
         data_dir_path=data_dir_path,
         output_dir_path=output_dir_path,
         max_workers=max_workers,
         verbose=verbose,
         stub_test=stub_test,
+        incremental=incremental,
     )
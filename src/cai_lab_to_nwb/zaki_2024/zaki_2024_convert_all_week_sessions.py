@@ -0,0 +1,166 @@
+"""Primary script to run to convert the week-long session of all subjects in a dataset using session_to_nwb."""
+
+from pathlib import Path
+from typing import Optional, Union
+
+from natsort import natsorted
+
+from cai_lab_to_nwb.zaki_2024.zaki_2024_convert_week_session import session_to_nwb, get_nwbfile_path, get_input_paths
+from cai_lab_to_nwb.zaki_2024.zaki_2024_convert_all_sessions import select_jobs_to_convert, run_conversion_jobs
+from cai_lab_to_nwb.zaki_2024.utils.conversion_journal import ConversionJournal
+from cai_lab_to_nwb.zaki_2024.utils.session_scheduling import (
+    estimate_week_session_cost,
+    estimate_week_session_peak_memory,
+)
+
+
+def week_dataset_to_nwb(
+    *,
+    data_dir_path: Union[str, Path],
+    output_dir_path: Union[str, Path],
+    subject_ids: Optional[list[str]] = None,
+    max_workers: int = 1,
+    verbose: bool = True,
+    stub_test: bool = False,
+    incremental: bool = False,
+    throughputs: Optional[dict] = None,
+    memory_budget_gb: Optional[float] = None,
+    resume: bool = False,
+    max_retries: int = 1,
+) -> dict:
+    """Convert the week-long session of every subject of the dataset to NWB.
+
+    The week-long sessions are run with the same scheduling, error handling and skip-if-done semantics as the
+    sessions of `dataset_to_nwb`, see its documentation for the details of each option.
+
+    Parameters
+    ----------
+    data_dir_path : Union[str, Path]
+        The path to the directory containing the raw data.
+    output_dir_path : Union[str, Path]
+        The path to the directory where the NWB files will be saved.
+    subject_ids : list of str, optional
+        The subjects to convert. Defaults to all the subjects of `Ca_EEG_Design.xlsx` in `data_dir_path`.
+    max_workers : int, optional
+        The number of workers to use for parallel processing, by default 1
+    verbose : bool, optional
+        Whether to print verbose output, by default True
+    stub_test : bool, optional
+        Whether to convert only a stub of each session, by default False
+    incremental : bool, optional
+        Whether to skip the subjects whose NWB file was converted from the same EDF files, cell registration results
+        and session notes, by default False.
+    throughputs : dict, optional
+        Bytes per second converted by one worker for each input kind, only "edf" is used to estimate the cost of each
+        session. Defaults to `utils.session_scheduling.DEFAULT_THROUGHPUTS`.
+    memory_budget_gb : float, optional
+        Memory available to the conversions running at the same time, in GB. The peak memory of each session is
+        estimated from the headers of its EDF files, which are all loaded in memory. By default, `max_workers`
+        sessions always run.
+    resume : bool, optional
+        Whether to skip the subjects that the journal of a previous run records as done, by default False. The journal
+        is `week_conversion_journal.jsonl` in `output_dir_path`.
+    max_retries : int, optional
+        Number of times a failed session is submitted again in the same run, by default 1.
+
+    Returns
+    -------
+    dict
+        The last status, number of attempts and duration in seconds of each session converted in this run, keyed by
+        the path of its NWB file relative to `output_dir_path`.
+    """
+    data_dir_path = Path(data_dir_path)
+    output_dir_path = Path(output_dir_path)
+    if subject_ids is None:
+        subject_ids = get_subject_ids(data_dir_path=data_dir_path)
+
+    jobs = []
+    for subject_id in subject_ids:
+        session_to_nwb_kwargs = dict(
+            data_dir_path=data_dir_path,
+            output_dir_path=output_dir_path,
+            subject_id=subject_id,
+            stub_test=stub_test,
+            verbose=verbose,
+        )
+        nwbfile_path = get_nwbfile_path(output_dir_path=output_dir_path, subject_id=subject_id, stub_test=stub_test)
+        input_paths = get_input_paths(data_dir_path=data_dir_path, subject_id=subject_id)
+        edf_file_paths = natsorted(input_paths["edf_folder_path"].glob("*.edf"))
+        jobs.append(
+            dict(
+                kwargs=session_to_nwb_kwargs,
+                key=nwbfile_path.relative_to(output_dir_path).as_posix(),
+                nwbfile_path=nwbfile_path,
+                # The data directory holds the whole dataset, only the folders read for the subject are inputs
+                input_paths=list(input_paths.values()),
+                convert_function=session_to_nwb,
+                cost=estimate_week_session_cost(edf_file_paths, throughputs=throughputs),
+                peak_memory=estimate_week_session_peak_memory(edf_file_paths) if memory_budget_gb is not None else 0.0,
+            )
+        )
+
+    journal = ConversionJournal(output_dir_path / "week_conversion_journal.jsonl")
+    jobs_to_convert = select_jobs_to_convert(
+        jobs=jobs, latest_records=journal.get_latest_records() if resume else dict(), incremental=incremental
+    )
+    if verbose and (incremental or resume):
+        print(
+            f"Skipping {len(jobs) - len(jobs_to_convert)} finished subjects, converting {len(jobs_to_convert)} subjects"
+        )
+
+    results = run_conversion_jobs(
+        jobs=jobs_to_convert,
+        data_dir_path=data_dir_path,
+        journal=journal,
+        max_workers=max_workers,
+        memory_budget_gb=memory_budget_gb,
+        max_retries=max_retries,
+        verbose=verbose,
+    )
+    if verbose:
+        for key, result in sorted(results.items()):
+            print(
+                f"{key}: {result['status']} after {result['attempts']} attempt(s), "
+                f"last attempt took {result['duration_seconds'] / 60:.1f} minutes"
+            )
+    return results
+
+
+def get_subject_ids(*, data_dir_path: Union[str, Path]) -> list[str]:
+    """Get the IDs of the subjects of the dataset from the experiment design file.
+
+    Parameters
+    ----------
+    data_dir_path : Union[str, Path]
+        The path to the directory containing the raw data and `Ca_EEG_Design.xlsx`.
+
+    Returns
+    -------
+    list[str]
+        The IDs of the subjects.
+    """
+    import pandas as pd
+
+    subjects_df = pd.read_excel(Path(data_dir_path) / "Ca_EEG_Design.xlsx")
+    return subjects_df["Mouse"].tolist()
+
+
+if __name__ == "__main__":
+
+    # Parameters for conversion
+    data_dir_path = Path("D:/Cai-CN-data-share/")
+    output_dir_path = Path("D:/cai_lab_conversion_nwb/")
+    max_workers = 2
+    memory_budget_gb = 32
+    verbose = False
+    stub_test = False
+    incremental = True
+    week_dataset_to_nwb(
+        data_dir_path=data_dir_path,
+        output_dir_path=output_dir_path,
+        max_workers=max_workers,
+        memory_budget_gb=memory_budget_gb,
+        verbose=verbose,
+        stub_test=stub_test,
+        incremental=incremental,
+    )
@@ -3,16 +3,30 @@
 import time
 import pytz
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 from datetime import datetime, timedelta
 
 from neuroconv.utils import load_dict_from_file, dict_deep_update
+from neuroconv.tools.nwb_helpers import configure_and_write_nwbfile
 
 from cai_lab_to_nwb.zaki_2024.zaki_2024_nwbconverter import Zaki2024NWBConverter
-from cai_lab_to_nwb.zaki_2024.utils import get_session_slicing_time_range, get_session_run_time
+from cai_lab_to_nwb.zaki_2024.utils import get_session_slicing_time_range, get_session_run_time, ConversionProfiler
+from cai_lab_to_nwb.zaki_2024.utils.zarr_writing import write_nwbfile_to_zarr
+from cai_lab_to_nwb.zaki_2024.utils.hdf5_direct_chunk_writing import write_nwbfile_with_direct_chunks
 from cai_lab_to_nwb.zaki_2024.interfaces.miniscope_imaging_interface import get_miniscope_folder_path
 
 
+def get_nwbfile_path(
+    output_dir_path: Union[str, Path], subject_id: str, session_id: str, stub_test: bool = False, backend: str = "hdf5"
+) -> Path:
+    """Return the path of the NWB file written by `session_to_nwb` for a session."""
+    output_dir_path = Path(output_dir_path)
+    if stub_test:
+        output_dir_path = output_dir_path / "nwb_stub"
+    suffix = ".nwb.zarr" if backend == "zarr" else ".nwb"
+    return output_dir_path / f"sub-{subject_id}_ses-{session_id}{suffix}"
+
+
 def session_to_nwb(
     output_dir_path: Union[str, Path],
     subject_id: str,
@@ -31,6 +45,16 @@ def session_to_nwb(
     edf_file_path: Union[str, Path] = None,
     sleep_classification_file_path: Union[str, Path] = None,
     shock_stimulus: dict = None,
+    max_workers: Optional[int] = None,
+    profile: bool = False,
+    imaging_iterator_options: Optional[dict] = None,
+    imaging_prefetch_blocks: int = 1,
+    compute_imaging_statistics: bool = False,
+    imaging_frame_count_mismatch: str = "raise",
+    write_by_modality: bool = False,
+    consolidate: bool = False,
+    backend: str = "hdf5",
+    parallel_compression: bool = False,
 ):
     """
     Converts data from an experimental session into NWB (Neurodata Without Borders) format using the `Zaki2024NWBConverter`.
@@ -74,6 +98,41 @@ def session_to_nwb(
         Path to a file containing sleep classification data. If None, sleep classification data will not be included.
     shock_stimulus : dict, optional
         Dictionary specifying shock stimulus times for fear conditioning sessions. If None, shock stimulus data will not be included.
+    max_workers : int, optional
+        Number of threads used to initialize the interfaces and to prefetch their source data before writing.
+        Defaults to one thread per interface. With the Zarr backend or `parallel_compression`, also the number of
+        threads compressing the chunks of the imaging and EEG/EMG data, by default the number of CPUs.
+    profile : bool, optional
+        If True, the wall time, CPU time, peak memory and I/O of each stage of the conversion (interface
+        construction, data prefetch, metadata, temporal alignment, `add_to_nwbfile` of each interface and the
+        final write) are saved in a JSON report next to the NWB file, named `<nwbfile stem>.profile.json`.
+    imaging_iterator_options : dict, optional
+        Options of the iterator streaming the Miniscope frames into the NWB file, e.g. `buffer_gb` to bound the
+        memory used by the imaging data. Defaults to the neuroconv iterator defaults.
+    imaging_prefetch_blocks : int, optional
+        Number of buffers of Miniscope frames decoded in a background thread while the current buffer is written,
+        each using `buffer_gb` of memory. With 0, the frames are decoded and written in turn. Default is 1.
+    compute_imaging_statistics : bool, optional
+        If True, the mean image, maximum projection and local correlation image of the Miniscope frames, and the
+        mean, standard deviation and number of saturated pixels of each frame, are computed from the frames decoded
+        for the write and added to the "miniscope_qc" processing module once the file is written. Default is False.
+    imaging_frame_count_mismatch : {"raise", "trim"}, optional
+        What to do when the Miniscope .avi files and "timeStamps.csv" disagree on the number of frames: raise a
+        ValueError before writing, or cut the frames and timestamps to the shorter of the two. Default is "raise".
+    write_by_modality : bool, optional
+        If True, the imaging, segmentation, EEG/EMG and behavior data are written in parallel by separate processes,
+        each to its own `<nwbfile stem>.<modality>.nwb` file next to the NWB file, which links them with HDF5
+        external links. Default is False.
+    consolidate : bool, optional
+        If True with `write_by_modality`, the data of the modalities are copied into the NWB file once written, and
+        their files removed, producing a single self-contained file. Default is False.
+    backend : {"hdf5", "zarr"}, optional
+        The storage backend of the NWB file. With "zarr", the session is written to a `.nwb.zarr` folder and the
+        chunks of the imaging and EEG/EMG data are compressed and written from a thread pool. Default is "hdf5".
+    parallel_compression : bool, optional
+        If True with the "hdf5" backend, the chunks of the imaging and EEG/EMG data are gzip-compressed from a thread
+        pool and committed in order with HDF5 direct chunk writes, instead of being compressed by h5py in the writing
+        thread. The file is read with the standard gzip filter. Default is False.
 
     Raises
     ------
@@ -89,6 +148,11 @@ def session_to_nwb(
     - Supports integrating multiple data modalities, each with its own conversion options.
     - If a specific data source is not provided (set to None), it will be excluded from the conversion.
     - Logs the total time taken for the conversion process if `verbose` is True.
+    - With `profile=True`, `write_by_modality=True`, `parallel_compression=True` or the "zarr" backend the conversion
+      always writes a new file, so `overwrite` must be True if it already exists.
+    - Without consolidation, the files of the modalities must be kept and moved along with the NWB file.
+    - Writing by modality links the files with HDF5 external links, so it only supports the "hdf5" backend. The
+      modalities are then written by separate processes, and `parallel_compression` is not used.
 
     Examples
     --------
@@ -114,12 +178,16 @@ def session_to_nwb(
         print(f"Converting session {session_id} for subject {subject_id}")
         start = time.time()
 
-    output_dir_path = Path(output_dir_path)
-    if stub_test:
-        output_dir_path = output_dir_path / "nwb_stub"
-    output_dir_path.mkdir(parents=True, exist_ok=True)
-
-    nwbfile_path = output_dir_path / f"sub-{subject_id}_ses-{session_id}.nwb"
+    assert backend in ("hdf5", "zarr"), f"Unknown backend '{backend}', expected 'hdf5' or 'zarr'"
+    assert not (write_by_modality and backend == "zarr"), "Writing by modality is only supported by the hdf5 backend"
+    nwbfile_path = get_nwbfile_path(
+        output_dir_path=output_dir_path,
+        subject_id=subject_id,
+        session_id=session_id,
+        stub_test=stub_test,
+        backend=backend,
+    )
+    nwbfile_path.parent.mkdir(parents=True, exist_ok=True)
 
     source_data = dict()
     conversion_options = dict()
@@ -132,7 +200,17 @@ def session_to_nwb(
         assert miniscope_folder_path.is_dir(), f"{miniscope_folder_path} does not exist"
 
         source_data.update(dict(MiniscopeImaging=dict(folder_path=miniscope_folder_path)))
-        conversion_options.update(dict(MiniscopeImaging=dict(stub_test=stub_test)))
+        conversion_options.update(
+            dict(
+                MiniscopeImaging=dict(
+                    stub_test=stub_test,
+                    iterator_options=imaging_iterator_options,
+                    prefetch_blocks=imaging_prefetch_blocks,
+                    compute_summary_statistics=compute_imaging_statistics,
+                    frame_count_mismatch=imaging_frame_count_mismatch,
+                )
+            )
+        )
 
     # Add Segmentation and Motion Correction
     if minian_folder_path:
@@ -223,10 +301,19 @@ def session_to_nwb(
             ShockStimuli=shock_stimulus,
         )
 
-    converter = Zaki2024NWBConverter(source_data=source_data, verbose=verbose)
+    profiler = ConversionProfiler() if profile else None
+    converter = Zaki2024NWBConverter(
+        source_data=source_data, verbose=verbose, max_workers=max_workers, profiler=profiler
+    )
+    # Read and prepare the source data of all the modalities concurrently before the serial NWB assembly. When writing
+    # by modality, every worker process reads the data of its own interfaces, so the parent process does not
+    if not write_by_modality:
+        with converter.profile_stage("prefetch_data"):
+            converter.prefetch_data()
 
     # Add datetime to conversion
-    metadata = converter.get_metadata()
+    with converter.profile_stage("get_metadata"):
+        metadata = converter.get_metadata()
     # if session_start_time has been already set from other interfaces do not override
     if not metadata["NWBFile"]["session_start_time"]:
         datetime_str = date_str + " " + time_str
@@ -246,9 +333,41 @@ def session_to_nwb(
     metadata["NWBFile"]["session_id"] = session_id
 
     # Run conversion
-    converter.run_conversion(
-        metadata=metadata, nwbfile_path=nwbfile_path, conversion_options=conversion_options, overwrite=overwrite
-    )
+    if write_by_modality:
+        assert overwrite or not nwbfile_path.exists(), f"{nwbfile_path} already exists, set overwrite=True"
+        converter.run_conversion_by_modality(
+            nwbfile_path=nwbfile_path, metadata=metadata, conversion_options=conversion_options, consolidate=consolidate
+        )
+    elif profiler is None and backend == "hdf5" and not parallel_compression:
+        converter.run_conversion(
+            metadata=metadata, nwbfile_path=nwbfile_path, conversion_options=conversion_options, overwrite=overwrite
+        )
+    else:
+        assert overwrite or not nwbfile_path.exists(), f"{nwbfile_path} already exists, set overwrite=True"
+        # Assemble the file in memory and write it separately, so that the write is recorded as its own stage.
+        # The checks and the alignment are the ones of run_conversion
+        converter.validate_metadata(metadata=metadata)
+        converter.validate_conversion_options(conversion_options=conversion_options)
+        converter.temporally_align_data_interfaces(metadata=metadata, conversion_options=conversion_options)
+        nwbfile = converter.create_nwbfile(metadata=metadata, conversion_options=conversion_options)
+        with converter.profile_stage("write_nwbfile"):
+            if backend == "zarr":
+                write_nwbfile_to_zarr(nwbfile=nwbfile, nwbfile_path=nwbfile_path, max_workers=max_workers)
+            elif parallel_compression:
+                write_nwbfile_with_direct_chunks(nwbfile=nwbfile, nwbfile_path=nwbfile_path, max_workers=max_workers)
+            else:
+                configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
+    # Written by the process of the imaging modality when writing by modality
+    if not write_by_modality:
+        converter.append_imaging_summary_statistics(nwbfile_path=nwbfile_path, backend=backend)
+    if profiler is not None:
+        profiler.write_report(
+            nwbfile_path.with_suffix(".profile.json"),
+            nwbfile_path=nwbfile_path,
+            subject_id=subject_id,
+            session_id=session_id,
+            stub_test=stub_test,
+        )
 
     if verbose:
         stop_time = time.time()
@@ -3,9 +3,12 @@
 import time
 from natsort import natsorted
 from pathlib import Path
-from typing import Union
+from typing import Optional, Union
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+
+import pandas as pd
 from mne.io import read_raw_edf
 
 from neuroconv.utils import load_dict_from_file, dict_deep_update
@@ -19,16 +22,181 @@ from cai_lab_to_nwb.zaki_2024.utils import (
     get_experiment_dir_path,
     get_date_str_from_experiment_dir_path,
 )
+from cai_lab_to_nwb.zaki_2024.utils.time_intervals import build_time_intervals
+from cai_lab_to_nwb.zaki_2024.utils.zarr_writing import write_nwbfile_to_zarr
 from cai_lab_to_nwb.zaki_2024.interfaces.miniscope_imaging_interface import get_miniscope_folder_path
 from cai_lab_to_nwb.zaki_2024.zaki_2024_nwbconverter import Zaki2024NWBConverter
 
 
+def get_nwbfile_path(
+    output_dir_path: Union[str, Path], subject_id: str, stub_test: bool = False, backend: str = "hdf5"
+) -> Path:
+    """Return the path of the NWB file written by `session_to_nwb` for the week-long session of a subject."""
+    output_dir_path = Path(output_dir_path)
+    if stub_test:
+        output_dir_path = output_dir_path / "nwb_stub"
+    suffix = ".nwb.zarr" if backend == "zarr" else ".nwb"
+    return output_dir_path / f"sub-{subject_id}_ses-Week{suffix}"
+
+
+def get_input_paths(data_dir_path: Union[str, Path], subject_id: str) -> dict:
+    """
+    Return the folders read by `session_to_nwb` for the week-long session of a subject.
+
+    They are the folder of the EDF files, the folder of the cell registration results and the experiment folder of the
+    subject, where the session notes and Miniscope timestamps defining the epochs are stored.
+    """
+    data_dir_path = Path(data_dir_path)
+    return dict(
+        edf_folder_path=data_dir_path / "Ca_EEG_EDF" / (subject_id + "_EDF"),
+        cell_registration_folder_path=data_dir_path / f"Ca_EEG_Calcium/{subject_id}/SpatialFootprints",
+        experiment_dir_path=data_dir_path / "Ca_EEG_Experiment" / subject_id,
+    )
+
+
+def resolve_session_epoch(
+    subject_id: str,
+    session_id: str,
+    date_str: Optional[str],
+    time_str: str,
+    data_dir_path: Path,
+    session_start_time: datetime,
+) -> dict:
+    """
+    Resolve the time range of one session of the week, relative to the start of the week-long recording.
+
+    The range is taken from the Miniscope metadata and timestamps of the session. Sessions without imaging data
+    fall back to the start date and time of the session and the run time in its notes (.txt file).
+
+    Parameters
+    ----------
+    subject_id : str
+        Identifier of the subject.
+    session_id : str
+        Identifier of the session.
+    date_str : str, optional
+        Date of the session in the format 'YYYY_MM_DD'. If None, it is taken from the experiment folder.
+    time_str : str
+        Start time of the session in the format 'HH_MM_SS'.
+    data_dir_path : Path
+        Path to the root directory containing all session data for the subject.
+    session_start_time : datetime
+        Start time of the week-long recording.
+
+    Returns
+    -------
+    dict
+        The `session_id`, the `start_time` and `stop_time` in seconds, the `time_source` used ("miniscope" or
+        "session_notes") and the `fallback_reason`, the error that prevented the use of the Miniscope data or None.
+    """
+    experiment_dir_path = get_experiment_dir_path(
+        subject_id=subject_id, session_id=session_id, data_dir_path=data_dir_path
+    )
+    if date_str is None:
+        date_str = get_date_str_from_experiment_dir_path(experiment_dir_path=experiment_dir_path)
+    reference_time = session_start_time.replace(tzinfo=None)
+
+    try:
+        folder_path = get_imaging_folder_path(
+            subject_id=subject_id,
+            session_id=session_id,
+            data_dir_path=data_dir_path,
+            time_str=time_str,
+            date_str=date_str,
+        )
+        assert folder_path is not None, "Imaging folder not found"
+        miniscope_folder_path = get_miniscope_folder_path(folder_path)
+        miniscope_metadata_json = folder_path / "metaData.json"
+        assert miniscope_metadata_json.exists(), f"General metadata json not found in {folder_path}"
+        timestamps_file_path = miniscope_folder_path / "timeStamps.csv"
+        assert timestamps_file_path.exists(), f"Miniscope timestamps file not found in {miniscope_folder_path}"
+
+        start_datetime_timestamp, stop_datetime_timestamp = get_session_slicing_time_range(
+            miniscope_metadata_json=miniscope_metadata_json, timestamps_file_path=timestamps_file_path
+        )
+        return dict(
+            session_id=session_id,
+            start_time=(start_datetime_timestamp - reference_time).total_seconds(),
+            stop_time=(stop_datetime_timestamp - reference_time).total_seconds(),
+            time_source="miniscope",
+            fallback_reason=None,
+        )
+    # Some sessions may not have imaging data, so we extract the run time from the session notes (.txt file)
+    # and use the data string and time string to retrieve the start datetime of the session
+    except Exception as exception:
+        fallback_reason = repr(exception)
+
+    datetime_str = date_str + " " + time_str
+    start_datetime_timestamp = datetime.strptime(datetime_str, "%Y_%m_%d %H_%M_%S")
+
+    txt_file_path = experiment_dir_path / f"{subject_id}_{session_id}.txt"
+    session_run_time = get_session_run_time(txt_file_path=txt_file_path)
+
+    start_time = (start_datetime_timestamp - reference_time).total_seconds()
+    return dict(
+        session_id=session_id,
+        start_time=start_time,
+        stop_time=start_time + session_run_time,
+        time_source="session_notes",
+        fallback_reason=fallback_reason,
+    )
+
+
+def resolve_session_epochs(
+    subject_id: str,
+    session_times_df: pd.DataFrame,
+    data_dir_path: Path,
+    session_start_time: datetime,
+    max_workers: int = 8,
+) -> list[dict]:
+    """
+    Resolve the time range of all the sessions of the week concurrently, see `resolve_session_epoch`.
+
+    Parameters
+    ----------
+    subject_id : str
+        Identifier of the subject.
+    session_times_df : pd.DataFrame
+        Session names, dates and times, as returned by `get_session_times_df`.
+    data_dir_path : Path
+        Path to the root directory containing all session data for the subject.
+    session_start_time : datetime
+        Start time of the week-long recording.
+    max_workers : int, optional
+        Number of sessions resolved concurrently. Default is 8.
+
+    Returns
+    -------
+    list of dict
+        The epoch of each session, in the order of `session_times_df`.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                resolve_session_epoch,
+                subject_id=subject_id,
+                session_id=session_id,
+                date_str=date_str,
+                time_str=time_str,
+                data_dir_path=data_dir_path,
+                session_start_time=session_start_time,
+            )
+            for session_id, date_str, time_str in zip(
+                session_times_df["Session"], session_times_df["Date"], session_times_df["Time"]
+            )
+        ]
+        return [future.result() for future in futures]
+
+
 def session_to_nwb(
     data_dir_path: Union[str, Path],
     output_dir_path: Union[str, Path],
     subject_id: str,
     stub_test: bool = False,
+    overwrite: bool = False,
     verbose: bool = True,
+    backend: str = "hdf5",
+    max_workers: Optional[int] = None,
 ):
     """
     Convert a week-long experimental session into an NWB file using the NWBConverter.
@@ -47,8 +215,15 @@ def session_to_nwb(
         Identifier for the subject whose data is being converted.
     stub_test : bool, optional
         If True, perform a quick test conversion using a subset of the data. Default is False.
+    overwrite : bool, optional
+        If True, overwrites an existing NWB file of the session. Default is False.
     verbose : bool, optional
         If True, print detailed progress information. Default is True.
+    backend : {"hdf5", "zarr"}, optional
+        The storage backend of the NWB file. With "zarr", the session is written to a `.nwb.zarr` folder and the
+        chunks of the EEG/EMG data are compressed and written from a thread pool. Default is "hdf5".
+    max_workers : int, optional
+        Number of threads writing the chunks of the Zarr datasets. Defaults to the number of CPUs.
 
     Data Streams
     ------------
@@ -71,7 +246,8 @@ def session_to_nwb(
 
     Output
     ------
-    - An NWB file named `sub-<subject_id>_ses-Week.nwb` is saved in the `output_dir_path`.
+    - An NWB file named `sub-<subject_id>_ses-Week.nwb` (`.nwb.zarr` with the "zarr" backend) is saved in the
+      `output_dir_path`.
 
     Examples
     --------
@@ -101,18 +277,19 @@ def session_to_nwb(
         start = time.time()
 
     data_dir_path = Path(data_dir_path)
-    output_dir_path = Path(output_dir_path)
-    if stub_test:
-        output_dir_path = output_dir_path / "nwb_stub"
-    output_dir_path.mkdir(parents=True, exist_ok=True)
-
-    nwbfile_path = output_dir_path / f"sub-{subject_id}_ses-Week.nwb"
+    assert backend in ("hdf5", "zarr"), f"Unknown backend '{backend}', expected 'hdf5' or 'zarr'"
+    nwbfile_path = get_nwbfile_path(
+        output_dir_path=output_dir_path, subject_id=subject_id, stub_test=stub_test, backend=backend
+    )
+    assert overwrite or not nwbfile_path.exists(), f"{nwbfile_path} already exists, set overwrite=True to replace it"
+    nwbfile_path.parent.mkdir(parents=True, exist_ok=True)
+    input_paths = get_input_paths(data_dir_path=data_dir_path, subject_id=subject_id)
 
     source_data = dict()
     conversion_options = dict()
 
     # Add EEG, EMG, Temperature and Activity signals
-    edf_folder_path = data_dir_path / "Ca_EEG_EDF" / (subject_id + "_EDF")
+    edf_folder_path = input_paths["edf_folder_path"]
     edf_file_paths = natsorted(edf_folder_path.glob("*.edf"))
     assert edf_file_paths, f"No .edf files found in {edf_folder_path}"
 
@@ -126,7 +303,7 @@ def session_to_nwb(
     conversion_options.update(dict(MultiEDFSignals=dict(stub_test=stub_test)))
 
     # Add Cross session cell registration
-    main_folder = data_dir_path / f"Ca_EEG_Calcium/{subject_id}/SpatialFootprints"
+    main_folder = input_paths["cell_registration_folder_path"]
     pattern = re.compile(r"^CellRegResults_OfflineDay(\d+)Session(\d+)$")
 
     file_paths = []
@@ -170,54 +347,35 @@ def session_to_nwb(
     # Add epochs table to store time range of conditioning and offline sessions
     session_times_df = get_session_times_df(subject_id=subject_id, data_dir_path=data_dir_path)
 
-    # Add columns to TimeIntervals
-    nwbfile.add_epoch_column(name="session_ids", description="ID of the session")
-
-    for session_id, date_str, time_str in zip(
-        session_times_df["Session"], session_times_df["Date"], session_times_df["Time"]
-    ):
-        experiment_dir_path = get_experiment_dir_path(
-            subject_id=subject_id, session_id=session_id, data_dir_path=data_dir_path
-        )
-        if date_str is None:
-            date_str = get_date_str_from_experiment_dir_path(experiment_dir_path=experiment_dir_path)
-        try:
-            folder_path = get_imaging_folder_path(
-                subject_id=subject_id,
-                session_id=session_id,
-                data_dir_path=data_dir_path,
-                time_str=time_str,
-                date_str=date_str,
-            )
-            miniscope_folder_path = get_miniscope_folder_path(folder_path)
-            miniscope_metadata_json = folder_path / "metaData.json"
-            assert miniscope_metadata_json.exists(), f"General metadata json not found in {folder_path}"
-            timestamps_file_path = miniscope_folder_path / "timeStamps.csv"
-            assert timestamps_file_path.exists(), f"Miniscope timestamps file not found in {miniscope_folder_path}"
-
-            start_datetime_timestamp, stop_datetime_timestamp = get_session_slicing_time_range(
-                miniscope_metadata_json=miniscope_metadata_json, timestamps_file_path=timestamps_file_path
-            )
-
-            start_time = (start_datetime_timestamp - session_start_time.replace(tzinfo=None)).total_seconds()
-            stop_time = (stop_datetime_timestamp - session_start_time.replace(tzinfo=None)).total_seconds()
-
-        # Some sessions may not have imaging data, so we extract the run time from the session notes (.txt file)
-        # and use the data string and time string to retrieve the start datetime of the session
-        except:
-            datetime_str = date_str + " " + time_str
-            start_datetime_timestamp = datetime.strptime(datetime_str, "%Y_%m_%d %H_%M_%S")
-
-            txt_file_path = experiment_dir_path / f"{subject_id}_{session_id}.txt"
-            session_run_time = get_session_run_time(txt_file_path=txt_file_path)
-
-            start_time = (start_datetime_timestamp - session_start_time.replace(tzinfo=None)).total_seconds()
-            stop_time = start_time + session_run_time
-
-        nwbfile.add_epoch(start_time=start_time, stop_time=stop_time, session_ids=session_id)
+    # Resolve the time range of every session concurrently, then add all the epochs at once
+    session_epochs = resolve_session_epochs(
+        subject_id=subject_id,
+        session_times_df=session_times_df,
+        data_dir_path=data_dir_path,
+        session_start_time=session_start_time,
+    )
+    if verbose:
+        for session_epoch in session_epochs:
+            if session_epoch["fallback_reason"] is not None:
+                print(
+                    f"Epoch of session {session_epoch['session_id']} taken from the session notes: "
+                    f"{session_epoch['fallback_reason']}"
+                )
+    nwbfile.epochs = build_time_intervals(
+        name="epochs",
+        description="experimental epochs",
+        start_times=[session_epoch["start_time"] for session_epoch in session_epochs],
+        stop_times=[session_epoch["stop_time"] for session_epoch in session_epochs],
+        columns=dict(
+            session_ids=("ID of the session", [session_epoch["session_id"] for session_epoch in session_epochs])
+        ),
+    )
 
     # Run conversion
-    configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
+    if backend == "zarr":
+        write_nwbfile_to_zarr(nwbfile=nwbfile, nwbfile_path=nwbfile_path, max_workers=max_workers)
+    else:
+        configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
 
     if verbose:
         stop_time = time.time()
@@ -237,9 +395,11 @@ if __name__ == "__main__":
     output_dir_path = Path("D:/cai_lab_conversion_nwb/")
     subject_id = "Ca_EEG3-4"
     stub_test = False
+    overwrite = True
     session_to_nwb(
         data_dir_path=data_dir_path,
         output_dir_path=output_dir_path,
         stub_test=stub_test,
         subject_id=subject_id,
+        overwrite=overwrite,
     )
@@ -1,10 +1,25 @@
 """Primary NWBConverter class for this dataset."""
 
+import inspect
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from copy import deepcopy
 from datetime import timedelta
+from pathlib import Path
+from typing import Optional, Union
 
+import numpy as np
 from neuroconv import NWBConverter
 from neuroconv.datainterfaces import VideoInterface
-from neuroconv.utils.dict import DeepDict
+from neuroconv.tools.nwb_helpers import (
+    configure_and_write_nwbfile,
+    get_default_nwbfile_metadata,
+    make_nwbfile_from_metadata,
+)
+from neuroconv.utils.dict import DeepDict, dict_deep_update
+from pydantic import ConfigDict, validate_call
+from pynwb import NWBFile, NWBHDF5IO
 
 from cai_lab_to_nwb.zaki_2024.interfaces import (
     MinianSegmentationInterface,
@@ -17,6 +32,19 @@ from cai_lab_to_nwb.zaki_2024.interfaces import (
     Zaki2024ShockStimuliInterface,
     Zaki2024CellRegistrationInterface,
 )
+from cai_lab_to_nwb.zaki_2024.utils.conversion_profiling import ConversionProfiler
+from cai_lab_to_nwb.zaki_2024.utils.external_links import (
+    check_nwbfile_references,
+    consolidate_external_links,
+    link_nwbfile_objects,
+)
+
+
+def _set_video_time_shift(video_interface: VideoInterface, time_shift: float) -> None:
+    # The behavioral video of a session is a single file, so shifting its starting time avoids extracting the
+    # timestamps of every frame. A shifted video is therefore written with starting time and rate, where it used to be
+    # written with the shifted timestamps extracted from the file
+    video_interface.set_aligned_segment_starting_times(aligned_segment_starting_times=[time_shift])
 
 
 class Zaki2024NWBConverter(NWBConverter):
@@ -35,66 +63,319 @@ class Zaki2024NWBConverter(NWBConverter):
         CellRegistration=Zaki2024CellRegistrationInterface,
     )
 
-    def get_metadata(self) -> DeepDict:
-        metadata = super().get_metadata()
+    # Interfaces from other packages that do not implement `set_aligned_time_shift`
+    time_shift_setters = dict(Video=_set_video_time_shift)
+
+    # Interfaces written to the same file by `run_conversion_by_modality`. Each processing module is written by the
+    # interfaces of a single modality, so that the NWB file of the session can link it whole.
+    modality_interface_names = dict(
+        imaging=["MiniscopeImaging"],
+        segmentation=["MinianSegmentation", "MinianMotionCorrection"],
+        ephys=["EDFSignals", "MultiEDFSignals"],
+        behavior=["Video", "FreezingBehavior", "ShockStimuli", "SleepClassification"],
+        cell_registration=["CellRegistration"],
+    )
+
+    @validate_call(config=ConfigDict(arbitrary_types_allowed=True))
+    def __init__(
+        self,
+        source_data: dict[str, dict],
+        verbose: bool = False,
+        max_workers: Optional[int] = None,
+        profiler: Optional[ConversionProfiler] = None,
+        time_shift: Optional[float] = None,
+    ):
+        """
+        Validate the source data and initialize the data interfaces.
+
+        The interfaces are constructed concurrently, as most constructors only open and scan their source files. As in
+        `NWBConverter`, the arguments are validated and `verbose` is passed to the interfaces that accept it, and the
+        source data is also validated against the source schema of the converter.
+
+        Parameters
+        ----------
+        source_data : dict
+            Source data of each data interface, keyed by interface name.
+        verbose : bool, default: False
+            Whether to print status messages.
+        max_workers : int, optional
+            Number of threads used to construct the interfaces and in `prefetch_data`. Defaults to one thread per
+            interface.
+        profiler : ConversionProfiler, optional
+            If given, the construction of the interfaces, the temporal alignment and the `add_to_nwbfile` call of
+            each interface are recorded as stages of the profiler.
+        time_shift : float, optional
+            Time shift of the session, in seconds. Defaults to the one computed from the MiniscopeImaging interface,
+            set it when converting a subset of the interfaces of a session without it.
+        """
+        self.verbose = verbose
+        self.max_workers = max_workers
+        self.profiler = profiler
+        self.source_data = source_data
+        self.time_shift = time_shift
+        self._validate_source_data(source_data=source_data, verbose=self.verbose)
+
+        interface_names = [name for name in self.data_interface_classes if name in source_data]
+        max_workers = self._get_max_workers(len(interface_names))
+        with self.profile_stage("interface_construction"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict()
+            for name in interface_names:
+                interface_class = self.data_interface_classes[name]
+                interface_kwargs = dict(source_data[name])
+                if "verbose" in inspect.signature(interface_class.__init__).parameters:
+                    interface_kwargs["verbose"] = verbose
+                futures[name] = executor.submit(interface_class, **interface_kwargs)
+            self.data_interface_objects = {name: future.result() for name, future in futures.items()}
 
+        # Per-interface metadata and original timestamps, resolved at most once for the lifetime of a conversion
+        self._interface_metadata = dict()
+        self._interface_original_timestamps = dict()
+
+    def profile_stage(self, name: str):
+        """Return a context manager recording `name` as a stage of the profiler, if any."""
+        return self.profiler.stage(name) if self.profiler is not None else nullcontext()
+
+    def _get_max_workers(self, num_tasks: int) -> int:
+        return max(1, min(num_tasks, self.max_workers or num_tasks))
+
+    def prefetch_data(self) -> None:
+        """
+        Read and prepare the source data of all the interfaces concurrently, ahead of the serial NWB assembly.
+
+        The metadata of every interface, the original imaging timestamps and the data cached by the interfaces
+        exposing a `prefetch_data` method (e.g. decoded EDF channels, parsed csv tables) are loaded in a thread
+        pool. Most of that work is file I/O or decoding that releases the GIL, so the preparation takes about as
+        long as the slowest modality instead of the sum of all of them.
+        """
+        tasks = [(self.get_interface_metadata, interface_name) for interface_name in self.data_interface_objects]
         if "MiniscopeImaging" in self.data_interface_objects:
-            imaging_interface = self.data_interface_objects["MiniscopeImaging"]
-            imaging_timestamps = imaging_interface.get_original_timestamps()
-            # If the first timestamp in the imaging data is negative, adjust the session start time
-            # to ensure all timestamps are positive. This is done by shifting the session start time
-            # backward by the absolute value of the negative timestamp.
-            if imaging_timestamps[0] < 0.0:
-                time_shift = timedelta(seconds=abs(imaging_timestamps[0]))
-                session_start_time = imaging_interface.get_metadata()["NWBFile"]["session_start_time"]
-                metadata["NWBFile"].update(session_start_time=session_start_time - time_shift)
+            tasks.append((self.get_interface_original_timestamps, "MiniscopeImaging"))
+        for data_interface in self.data_interface_objects.values():
+            if hasattr(data_interface, "prefetch_data"):
+                tasks.append((lambda interface: interface.prefetch_data(), data_interface))
+
+        with ThreadPoolExecutor(max_workers=self._get_max_workers(len(tasks))) as executor:
+            futures = [executor.submit(task, argument) for task, argument in tasks]
+            for future in futures:
+                future.result()
+
+    def get_interface_metadata(self, interface_name: str) -> DeepDict:
+        """Return the metadata of one data interface, reading its source files only the first time."""
+        if interface_name not in self._interface_metadata:
+            self._interface_metadata[interface_name] = self.data_interface_objects[interface_name].get_metadata()
+        return deepcopy(self._interface_metadata[interface_name])
+
+    def get_interface_original_timestamps(self, interface_name: str) -> np.ndarray:
+        """Return the original timestamps of one data interface, reading its source files only the first time.
+
+        The returned array is shared between calls and must not be modified in place.
+        """
+        if interface_name not in self._interface_original_timestamps:
+            data_interface = self.data_interface_objects[interface_name]
+            self._interface_original_timestamps[interface_name] = data_interface.get_original_timestamps()
+        return self._interface_original_timestamps[interface_name]
+
+    def clear_cache(self, interface_name: Optional[str] = None) -> None:
+        """Invalidate the cached metadata and original timestamps of one data interface, or of all of them."""
+        interface_names = list(self.data_interface_objects) if interface_name is None else [interface_name]
+        for name in interface_names:
+            self._interface_metadata.pop(name, None)
+            self._interface_original_timestamps.pop(name, None)
+
+    def get_metadata(self) -> DeepDict:
+        metadata = get_default_nwbfile_metadata()
+        for interface_name in self.data_interface_objects:
+            metadata = dict_deep_update(metadata, self.get_interface_metadata(interface_name))
+
+        # If the first timestamp in the imaging data is negative, adjust the session start time
+        # to ensure all timestamps are positive. This is done by shifting the session start time
+        # backward by the absolute value of the negative timestamp.
+        time_shift = self.get_time_shift()
+        if time_shift > 0.0:
+            session_start_time = self.get_interface_metadata("MiniscopeImaging")["NWBFile"]["session_start_time"]
+            metadata["NWBFile"].update(session_start_time=session_start_time - timedelta(seconds=time_shift))
         return metadata
 
+    def get_time_shift(self) -> float:
+        """Return the time shift that makes the first imaging timestamp non-negative, in seconds."""
+        if self.time_shift is not None:
+            return self.time_shift
+        if "MiniscopeImaging" not in self.data_interface_objects:
+            return 0.0
+        first_imaging_timestamp = self.get_interface_original_timestamps("MiniscopeImaging")[0]
+        return abs(first_imaging_timestamp) if first_imaging_timestamp < 0.0 else 0.0
+
     def temporally_align_data_interfaces(self, metadata: dict | None = None, conversion_options: dict | None = None):
-        if "MiniscopeImaging" in self.data_interface_objects:
-            imaging_interface = self.data_interface_objects["MiniscopeImaging"]
-            imaging_timestamps = imaging_interface.get_original_timestamps()
-            # Align the starting times of all data interfaces when the imaging data's first timestamp is negative.
-            # This is done by calculating a time shift based on the absolute value of the first negative timestamp.
-            # The time shift is applied to all relevant data interfaces to ensure temporal alignment.
-            if imaging_timestamps[0] < 0.0:
-                time_shift = abs(imaging_timestamps[0])
-                imaging_interface.set_aligned_timestamps(imaging_timestamps + time_shift)
-                if "MinianSegmentation" in self.data_interface_objects:
-                    segmentation_interface = self.data_interface_objects["MinianSegmentation"]
-                    segmentation_timestamps = segmentation_interface.get_original_timestamps()
-                    segmentation_interface.set_aligned_timestamps(segmentation_timestamps + time_shift)
-
-                # if "MinianMotionCorrection" in self.data_interface_objects:
-                #     motion_correction_interface = self.data_interface_objects["MinianMotionCorrection"]
-                #     motion_correction_timestamps = motion_correction_interface.get_original_timestamps()
-                #     motion_correction_interface.set_aligned_timestamps(motion_correction_timestamps + time_shift)
-
-                if "SleepClassification" in self.data_interface_objects:
-                    sleep_classification_interface = self.data_interface_objects["SleepClassification"]
-                    start_times, stop_times, sleep_states = sleep_classification_interface.get_sleep_states_times()
-                    start_times += time_shift
-                    stop_times += time_shift
-                    sleep_classification_interface.set_aligned_interval_times(
-                        start_times=start_times, stop_times=stop_times
-                    )
-                if "EDFSignals" in self.data_interface_objects:
-                    edf_signals_interface = self.data_interface_objects["EDFSignals"]
-                    edf_signals_interface.set_aligned_starting_time(time_shift)
-
-                if "FreezingBehavior" in self.data_interface_objects:
-                    freezing_behavior_interface = self.data_interface_objects["FreezingBehavior"]
-                    start_times, stop_times = freezing_behavior_interface.get_interval_times()
-                    start_times += time_shift
-                    stop_times += time_shift
-                    freezing_behavior_interface.set_aligned_interval_times(
-                        start_times=start_times, stop_times=stop_times
+        # Align the starting times of all data interfaces when the imaging data's first timestamp is negative.
+        # The time shift is recorded by each interface and only applied when its data is written, so no timestamps
+        # are read or copied here. Interfaces exposing `set_aligned_time_shift` are aligned automatically, those
+        # listed in `time_shift_setters` are aligned with the registered setter, the rest keep their own times.
+        # As the session start time is moved back by the time shift, every interface with times is shifted, including
+        # MultiEDFSignals, which the per-interface alignment used to leave unshifted.
+        with self.profile_stage("temporal_alignment"):
+            time_shift = self.get_time_shift()
+            if time_shift == 0.0:
+                return
+
+            for interface_name, data_interface in self.data_interface_objects.items():
+                if interface_name in self.time_shift_setters:
+                    self.time_shift_setters[interface_name](data_interface, time_shift)
+                elif hasattr(data_interface, "set_aligned_time_shift"):
+                    data_interface.set_aligned_time_shift(time_shift)
+
+    def add_to_nwbfile(self, nwbfile: NWBFile, metadata, conversion_options: Optional[dict] = None) -> None:
+        conversion_options = conversion_options or dict()
+        for interface_name, data_interface in self.data_interface_objects.items():
+            with self.profile_stage(f"add_to_nwbfile:{interface_name}"):
+                data_interface.add_to_nwbfile(
+                    nwbfile=nwbfile, metadata=metadata, **conversion_options.get(interface_name, dict())
+                )
+
+    def append_imaging_summary_statistics(self, nwbfile_path: Union[str, Path], backend: str = "hdf5") -> bool:
+        """
+        Append the summary statistics of the imaging frames, accumulated while they were written, to the NWB file.
+
+        The frames are only decoded when the NWB file is written, so the statistics requested with the
+        `compute_summary_statistics` conversion option of the MiniscopeImaging interface are added to the file once
+        it is written, in append mode.
+
+        Parameters
+        ----------
+        nwbfile_path : Union[str, Path]
+            Path of the NWB file written with the MiniscopeImaging interface.
+        backend : {"hdf5", "zarr"}, default: "hdf5"
+            The backend of the NWB file.
+
+        Returns
+        -------
+        bool
+            Whether summary statistics were appended. They are not if the frames were not all read in order, with a
+            warning.
+        """
+        imaging_interface = self.data_interface_objects.get("MiniscopeImaging")
+        if imaging_interface is None or imaging_interface.summary_statistics is None:
+            return False
+        summary_statistics = imaging_interface.summary_statistics
+        if not summary_statistics.is_complete:
+            # The NWB file is already written, so it is kept without the statistics
+            warnings.warn(
+                f"The summary statistics of the imaging frames are not appended to {nwbfile_path}: only "
+                f"{summary_statistics.num_counted_frames} of the {summary_statistics.num_frames} frames were counted.",
+                UserWarning,
+            )
+            return False
+
+        if backend == "zarr":
+            from hdmf_zarr import NWBZarrIO
+
+            io = NWBZarrIO(str(nwbfile_path), mode="r+")
+        else:
+            io = NWBHDF5IO(str(nwbfile_path), mode="a")
+        with self.profile_stage("append_imaging_summary_statistics"), io:
+            nwbfile = io.read()
+            imaging_interface.add_summary_statistics_to_nwbfile(nwbfile=nwbfile)
+            io.write(nwbfile)
+        return True
+
+    def get_modality_nwbfile_paths(self, nwbfile_path: Union[str, Path]) -> dict:
+        """Return the path of the file written by `run_conversion_by_modality` for each modality of the session."""
+        nwbfile_path = Path(nwbfile_path)
+        return {
+            modality: nwbfile_path.with_name(f"{nwbfile_path.stem}.{modality}.nwb")
+            for modality, interface_names in self.modality_interface_names.items()
+            if any(interface_name in self.data_interface_objects for interface_name in interface_names)
+        }
+
+    def run_conversion_by_modality(
+        self,
+        nwbfile_path: Union[str, Path],
+        metadata: dict,
+        conversion_options: Optional[dict] = None,
+        consolidate: bool = False,
+    ) -> dict:
+        """
+        Write each modality of the session to its own NWB file in parallel, and link them from the NWB file.
+
+        The interfaces of each modality of `modality_interface_names` are converted by a separate process, with the
+        same metadata and time shift, to `<nwbfile stem>.<modality>.nwb` next to the NWB file. The NWB file then holds
+        the session metadata and external links to the data of every modality, so the session takes about as long
+        to write as its largest modality instead of the sum of all of them. The NWB file is read back with pynwb once
+        linked, and once consolidated, to check that its links and object references resolve to its own objects.
+
+        Parameters
+        ----------
+        nwbfile_path : Union[str, Path]
+            Path of the NWB file of the session, overwritten if it exists.
+        metadata : dict
+            Metadata of the session, as returned by `get_metadata` and edited.
+        conversion_options : dict, optional
+            Conversion options of each data interface, keyed by interface name.
+        consolidate : bool, default: False
+            Whether to copy the data of every modality into the NWB file once they are all written, and delete the
+            files of the modalities, to produce a single self-contained file.
+
+        Returns
+        -------
+        dict
+            The path of the file of each modality, keyed by modality. They no longer exist if `consolidate` is True.
+        """
+        nwbfile_path = Path(nwbfile_path)
+        conversion_options = conversion_options or dict()
+        # The files of the modalities are assembled without validation, the metadata of the session is validated here
+        self.validate_metadata(metadata=metadata)
+        self.validate_conversion_options(conversion_options=conversion_options)
+        modality_nwbfile_paths = self.get_modality_nwbfile_paths(nwbfile_path)
+        time_shift = self.get_time_shift()
+
+        with self.profile_stage("write_modality_nwbfiles"):
+            max_workers = self._get_max_workers(len(modality_nwbfile_paths))
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = []
+                for modality, modality_nwbfile_path in modality_nwbfile_paths.items():
+                    interface_names = [
+                        interface_name
+                        for interface_name in self.modality_interface_names[modality]
+                        if interface_name in self.data_interface_objects
+                    ]
+                    futures.append(
+                        executor.submit(
+                            _write_modality_nwbfile,
+                            source_data={name: self.source_data[name] for name in interface_names},
+                            conversion_options={
+                                name: conversion_options[name] for name in interface_names if name in conversion_options
+                            },
+                            metadata=metadata,
+                            time_shift=time_shift,
+                            nwbfile_path=modality_nwbfile_path,
+                            verbose=self.verbose,
+                        )
                     )
-                    starting_time = freezing_behavior_interface.get_starting_time()
-                    freezing_behavior_interface.set_aligned_starting_time(starting_time + time_shift)
-
-                if "Video" in self.data_interface_objects:
-                    video_interface = self.data_interface_objects["Video"]
-                    video_timestamps = video_interface.get_original_timestamps()
-                    aligned_video_timestamps = video_timestamps + time_shift
-                    video_interface.set_aligned_timestamps(aligned_video_timestamps)
+                for future in futures:
+                    future.result()
+
+        with self.profile_stage("link_modality_nwbfiles"):
+            configure_and_write_nwbfile(
+                nwbfile=make_nwbfile_from_metadata(metadata=metadata), backend="hdf5", output_filepath=nwbfile_path
+            )
+            link_nwbfile_objects(nwbfile_path=nwbfile_path, linked_nwbfile_paths=list(modality_nwbfile_paths.values()))
+            check_nwbfile_references(nwbfile_path=nwbfile_path)
+
+        if consolidate:
+            with self.profile_stage("consolidate_modality_nwbfiles"):
+                consolidate_external_links(nwbfile_path=nwbfile_path, remove_linked_files=True)
+                check_nwbfile_references(nwbfile_path=nwbfile_path)
+        return modality_nwbfile_paths
+
+
+def _write_modality_nwbfile(
+    source_data: dict, conversion_options: dict, metadata: dict, time_shift: float, nwbfile_path: Path, verbose: bool
+) -> None:
+    """Convert a subset of the interfaces of a session to their own NWB file, in a worker process."""
+    converter = Zaki2024NWBConverter(source_data=source_data, verbose=verbose, time_shift=time_shift)
+    # The metadata of the session holds the fields of every modality, which the metadata schema of a subset of the
+    # interfaces rejects, so the file is assembled without `run_conversion` and its validation
+    converter.temporally_align_data_interfaces(metadata=metadata, conversion_options=conversion_options)
+    nwbfile = converter.create_nwbfile(metadata=metadata, conversion_options=conversion_options)
+    configure_and_write_nwbfile(nwbfile=nwbfile, backend="hdf5", output_filepath=nwbfile_path)
+    # The interfaces of the worker saw the frames, so the imaging statistics are appended to the file of the modality
+    converter.append_imaging_summary_statistics(nwbfile_path=nwbfile_path)